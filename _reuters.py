@@ -4,18 +4,25 @@ import os
 import sys
 
 def usage():
-	print >> sys.stderr, """Usage: _reuters.py CONTEXT PREFIX DIR BLOCK_SIZE"""
+	print >> sys.stderr, """Usage: _reuters.py CONTEXT PREFIX DIR BLOCK_SIZE [WORKERS]
+WORKERS > 1 parses the files in that many processes (0 means one per CPU)"""
 	sys.exit(1)
 
 try:
-	context,prefix,dir,block_size = sys.argv[1:]
+	context,prefix,dir,block_size = sys.argv[1:5]
+	workers = 1
+	if len(sys.argv) > 5: workers = int(sys.argv[5])
 except:
 	usage()
 
+def runAnalysis(p,outputPrefix,fileList):
+	if workers == 1: p.runAnalysisOnFileList(outputPrefix,fileList)
+	else: p.runParallelAnalysisOnFileList(outputPrefix,fileList,workers or None)
+
 block_size = int(block_size)
 if block_size == -1:
 	p = analysis.ReutersCorpusParser(context)
-	p.runAnalysisOnFileList(prefix,lazy.recursiveListdir(dir,True))
+	runAnalysis(p,prefix,lazy.recursiveListdir(dir,True))
 else:
 	passCount = 0
 	continueProcessing = True
@@ -25,7 +32,7 @@ else:
 		sys.stderr.write("Starting pass #%d" % passCount)
 		p = analysis.ReutersCorpusParser(context)
 		fileList = itertools.islice(fileGenerator,0,block_size)
-		p.runAnalysisOnFileList(prefix + "-%d" % passCount,fileList)
+		runAnalysis(p,prefix + "-%d" % passCount,fileList)
 		sys.stderr.write(" DONE\n")
 		try:
 			fileGenerator.peek()
@@ -0,0 +1,9 @@
+"""
+Benchmarks for LEIF
+
+corpus.ZipfianCorpus generates reproducible streams of AnalyzedDocuments, and
+run.py builds an index from one and measures it, writing the results as JSON:
+
+	python -m benchmarks.run --documents 20000 --output results.json
+	python -m benchmarks.run --documents 20000 --compare results.json
+"""
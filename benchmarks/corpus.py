@@ -0,0 +1,74 @@
+"""
+A synthetic corpus whose term frequencies follow Zipf's law
+
+Documents are laid out like the analyzed Reuters newsitems: a document element
+whose extent covers every position, split into paragraph elements, each element
+sharing its position with the first word it holds.
+"""
+import bisect
+import random
+from leif import analysis, data, termdict
+
+DocumentElementName = "newsitem"
+ParagraphElementName = "p"
+
+class ZipfianCorpus(object):
+	"""Generates AnalyzedDocuments over a vocabulary of vocabularySize words
+	The word of rank r is drawn with probability proportional to 1 / r**skew, document
+	lengths are drawn around meanDocumentLength and paragraphs around meanParagraphLength.
+	The same seed always generates the same documents"""
+	__slots__ = ["vocabularySize","skew","meanDocumentLength","meanParagraphLength","seed","termWords","cumulativeWeights"]
+	def __init__(self,_vocabularySize=10000,_skew=1.0,_meanDocumentLength=200,_meanParagraphLength=40,_seed=1):
+		self.vocabularySize = _vocabularySize
+		self.skew = _skew
+		self.meanDocumentLength = _meanDocumentLength
+		self.meanParagraphLength = _meanParagraphLength
+		self.seed = _seed
+		self.termWords = dict()
+		for termWord in [DocumentElementName,ParagraphElementName] + map(self.termWordOfRank,xrange(1,_vocabularySize + 1)):
+			self.termWords[termWord] = len(self.termWords)
+		self.cumulativeWeights = list()
+		totalWeight = 0.0
+		for rank in xrange(1,_vocabularySize + 1):
+			totalWeight += 1.0 / rank ** _skew
+			self.cumulativeWeights.append(totalWeight)
+
+	def termWordOfRank(self,rank):
+		"""rank 1 is the most frequent word"""
+		return "w%d" % rank
+
+	def drawRank(self,randomSource):
+		return bisect.bisect_left(self.cumulativeWeights,randomSource.random() * self.cumulativeWeights[-1]) + 1
+
+	def generateAnalyzedDocuments(self,documentCount,firstDocId=0):
+		randomSource = random.Random(self.seed)
+		_termId = self.termWords.__getitem__
+		for docId in xrange(firstDocId,firstDocId + documentCount):
+			documentLength = max(1,int(randomSource.expovariate(1.0 / self.meanDocumentLength)))
+			analyzedDocument = data.AnalyzedDocument(docId)
+			paragraphRemaining = 0
+			for position in xrange(documentLength):
+				analyzedTerm = data.AnalyzedTerm()
+				if position == 0: analyzedTerm.addTermIdWithOptionalExtent(_termId(DocumentElementName),documentLength)
+				if paragraphRemaining == 0:
+					paragraphRemaining = min(documentLength - position,max(1,int(randomSource.expovariate(1.0 / self.meanParagraphLength))))
+					analyzedTerm.addTermIdWithOptionalExtent(_termId(ParagraphElementName),paragraphRemaining)
+				paragraphRemaining -= 1
+				analyzedTerm.addTermIdWithOptionalExtent(_termId(self.termWordOfRank(self.drawRank(randomSource))))
+				analyzedDocument.appendAnalyzedTerm(analyzedTerm)
+			yield analyzedDocument
+
+	def writeAnalysisFiles(self,outputPrefix,documentCount,firstDocId=0):
+		"""writes outputPrefix.docs and outputPrefix.alphabet, just as analysis.ReutersCorpusParser does"""
+		outputFile = analysis.AnalyzedDocumentsWriter(outputPrefix + ".docs")
+		for analyzedDocument in self.generateAnalyzedDocuments(documentCount,firstDocId):
+			outputFile.write(analyzedDocument)
+		outputFile.close()
+		termdict.saveAlphabet(self.termWords,outputPrefix + ".alphabet")
+
+	def __repr__(self):
+		return "#ZC(vocabulary=%d,skew=%s,length=%d,seed=%d)" % (self.vocabularySize,self.skew,self.meanDocumentLength,self.seed)
+
+def postingCount(analyzedDocument):
+	"""the postings ReverseIndex.post() will make for analyzedDocument"""
+	return sum([len(analyzedTerm.instanceSet) for analyzedTerm in analyzedDocument.analyzedTermList])
@@ -0,0 +1,289 @@
+"""
+Builds an index from a ZipfianCorpus and measures it
+
+Measures ingest throughput, merge cost per GrowthStrategyFixedBuffer level, the
+size on disk, the time to open the index again and the latency of queries per
+operator type. Results are written as JSON, --compare checks them against an
+earlier run and exits with status 1 when anything got worse by more than the
+tolerance.
+"""
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from benchmarks import corpus
+from leif import index, query
+
+ResultsFormatVersion = 1
+
+# template, number of words it takes
+QueryTemplates = {
+	"Term": ('(Term,"%s")',1),
+	"And": ('(And,(Term,"%s"),(Term,"%s"))',2),
+	"Or": ('(Or,(Term,"%s"),(Term,"%s"))',2),
+	"Andnot": ('(Andnot,(Term,"%s"),(Term,"%s"))',2),
+	"Before": ('(Before,(Term,"%s"),(Term,"%s"))',2),
+	"After": ('(After,(Term,"%s"),(Term,"%s"))',2),
+	"Within": ('(Within,5,(Term,"%s"),(Term,"%s"))',2),
+	"Minoc": ('(Minoc,2,(Term,"%s"),(Term,"%s"),(Term,"%s"))',3),
+	"Scope": ('(Scope,(Term,"' + corpus.DocumentElementName + '"),(Term,"%s"))',1),
+}
+
+def percentile(sortedValues,p):
+	if not sortedValues: return 0.0
+	return sortedValues[min(len(sortedValues) - 1,int(p * len(sortedValues)))]
+
+def makeQueries(zipfianCorpus,queriesPerOperator,seed):
+	"""returns {rator: [queryString]}, words are drawn log-uniformly from the 1000 most frequent
+	so that every query mixes common and uncommon words"""
+	randomSource = random.Random(seed)
+	maxRank = min(1000,zipfianCorpus.vocabularySize)
+	def _termWord():
+		return zipfianCorpus.termWordOfRank(int(maxRank ** randomSource.random()))
+	queries = dict()
+	for rator,(template,wordCount) in sorted(QueryTemplates.items()):
+		queries[rator] = [template % tuple([_termWord() for i in xrange(wordCount)]) for q in xrange(queriesPerOperator)]
+	return queries
+
+def waitForIngest(reverseIndex,postingCount):
+	"""the posting thread has indexed postingCount postings once its counter says so"""
+	while reverseIndex.ingestStatistics.postingsIndexed < postingCount:
+		time.sleep(0.01)
+
+def directorySize(path):
+	return sum([os.path.getsize(os.path.join(path,fileName)) for fileName in os.listdir(path)])
+
+def benchmarkIngest(zipfianCorpus,documentCount,path,bufferSize,growthFactor):
+	reverseIndex = index.ReverseIndex(path,"bench","bench")
+	reverseIndex.growthStrategy = index.GrowthStrategyFixedBuffer(bufferSize,growthFactor)
+	reverseIndex.partitions[0].termInstanceLimit = reverseIndex.growthStrategy.computeTermInstanceLimitForPartitionK(0)
+
+	postingCount = 0
+	startTime = time.time()
+	for analyzedDocument in zipfianCorpus.generateAnalyzedDocuments(documentCount):
+		postingCount += corpus.postingCount(analyzedDocument)
+		reverseIndex.post(analyzedDocument)
+	waitForIngest(reverseIndex,postingCount)
+	ingestSeconds = time.time() - startTime
+
+	writeStartTime = time.time()
+	reverseIndex.writeToDisk()
+	writeSeconds = time.time() - writeStartTime
+
+	stats = reverseIndex.stats()
+	return {
+		"ingest": {
+			"documents": documentCount,
+			"postings": postingCount,
+			"seconds": ingestSeconds,
+			"documentsPerSecond": documentCount / max(ingestSeconds,1e-9),
+			"postingsPerSecond": postingCount / max(ingestSeconds,1e-9),
+			"writeToDiskSeconds": writeSeconds,
+		},
+		"merges": {
+			"count": stats["merges"]["count"],
+			"seconds": stats["merges"]["seconds"],
+			"bytesRead": stats["merges"]["bytesRead"],
+			"bytesWritten": stats["merges"]["bytesWritten"],
+			"writeAmplification": stats["merges"]["writeAmplification"],
+			"levels": stats["merges"]["levels"],
+		},
+		"disk": {
+			"bytes": directorySize(path),
+			"partitions": [dict([(key,partition[key]) for key in ("name","termInstances","bytes")]) for partition in stats["partitions"]],
+		},
+	}
+
+def benchmarkStartup(path):
+	startTime = time.time()
+	reverseIndex = index.ReverseIndex(path,"bench","bench")
+	return reverseIndex,{"seconds": time.time() - startTime}
+
+def benchmarkQueries(reverseIndex,termWords,queries,repeat):
+	"""every query is run repeat times, matches are consumed and their positions realized"""
+	results = dict()
+	for rator,queryStrings in sorted(queries.items()):
+		latencies = list()
+		matchCount = 0
+		for queryString in queryStrings:
+			preparedQuery = query.prepareQuery(queryString)
+			for r in xrange(repeat):
+				environment = query.makeInitialEnvironmentFromReverseIndex(reverseIndex,termWords)
+				startTime = time.time()
+				matches = 0
+				for computedMatch in preparedQuery.execute(environment):
+					computedMatch.termInstanceVectors
+					matches += 1
+				latencies.append(time.time() - startTime)
+			matchCount += matches
+		latencies.sort()
+		results[rator] = {
+			"queries": len(queryStrings),
+			"runs": len(latencies),
+			"matches": matchCount,
+			"mean": sum(latencies) / max(len(latencies),1),
+			"p50": percentile(latencies,0.50),
+			"p90": percentile(latencies,0.90),
+			"p99": percentile(latencies,0.99),
+			"max": latencies and latencies[-1] or 0.0,
+		}
+	return results
+
+def runBenchmarks(parameters,path):
+	zipfianCorpus = corpus.ZipfianCorpus(parameters["vocabulary"],parameters["skew"],parameters["documentLength"],parameters["paragraphLength"],parameters["seed"])
+	results = {
+		"version": ResultsFormatVersion,
+		"time": time.time(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"parameters": parameters,
+	}
+	print >> sys.stderr, "Benchmark: ingesting %d documents of %s" % (parameters["documents"],repr(zipfianCorpus))
+	results.update(benchmarkIngest(zipfianCorpus,parameters["documents"],path,parameters["bufferSize"],parameters["growthFactor"]))
+	reverseIndex,results["startup"] = benchmarkStartup(path)
+	print >> sys.stderr, "Benchmark: running queries"
+	queries = makeQueries(zipfianCorpus,parameters["queries"],parameters["seed"])
+	results["queries"] = benchmarkQueries(reverseIndex,zipfianCorpus.termWords,queries,parameters["repeat"])
+	return results
+
+# metric path, True when larger is better
+ComparedMetrics = [
+	(("ingest","documentsPerSecond"),True),
+	(("ingest","postingsPerSecond"),True),
+	(("ingest","writeToDiskSeconds"),False),
+	(("merges","seconds"),False),
+	(("merges","bytesWritten"),False),
+	(("disk","bytes"),False),
+	(("startup","seconds"),False),
+]
+
+def compareResults(previousResults,results,tolerance):
+	"""returns (lines,regressionCount) comparing the metrics both results hold"""
+	def _lookup(results,metricPath):
+		for key in metricPath:
+			if not isinstance(results,dict) or key not in results: return None
+			results = results[key]
+		return results
+	metrics = list(ComparedMetrics)
+	for rator in sorted(results.get("queries",{})):
+		metrics.append((("queries",rator,"p50"),False))
+		metrics.append((("queries",rator,"p99"),False))
+
+	lines = list()
+	regressionCount = 0
+	for metricPath,largerIsBetter in metrics:
+		previousValue,value = _lookup(previousResults,metricPath),_lookup(results,metricPath)
+		if previousValue is None or value is None: continue
+		if not previousValue:
+			change = 0.0
+		else:
+			change = (float(value) - previousValue) / previousValue
+		worse = largerIsBetter and -change or change
+		flag = ""
+		if worse > tolerance:
+			flag = "REGRESSION"
+			regressionCount += 1
+		lines.append("%-28s %14.6g %14.6g %+8.1f%% %s" % (".".join(metricPath),previousValue,value,change * 100.0,flag))
+	return lines,regressionCount
+
+def main(argv=None):
+	if argv is None: argv = sys.argv
+	def usage():
+		print >> sys.stderr, """Usage: python -m benchmarks.run [OPTIONS]
+
+--documents N   Documents to index (default 5000)
+--vocabulary N  Distinct words (default 10000)
+--skew S        Zipf exponent of the word frequencies (default 1.0)
+--document-length N
+                Mean words per document (default 200)
+--paragraph-length N
+                Mean words per paragraph element (default 40)
+--seed N        Seed of the corpus and the queries (default 1)
+--buffer-size N GrowthStrategyFixedBuffer buffer size in TermInstances (default 65536)
+--growth-factor N
+                GrowthStrategyFixedBuffer growth factor (default 3)
+--queries N     Queries per operator type (default 20)
+--repeat N      Runs of every query (default 3)
+--path DIR      Build the index in DIR, which is kept (default a temporary directory)
+--output FILE   Write the results to FILE (default stdout)
+--compare FILE  Compare the results with an earlier results FILE
+--tolerance T   Relative change counted as a regression by --compare (default 0.2)
+"""
+		sys.exit(2)
+
+	try:
+		options,other_args = getopt.getopt(argv[1:],"",["documents=","vocabulary=","skew=","document-length=","paragraph-length=","seed=","buffer-size=","growth-factor=","queries=","repeat=","path=","output=","compare=","tolerance="])
+	except getopt.GetoptError, e:
+		print >> sys.stderr, e.msg
+		usage()
+
+	parameters = {
+		"documents": 5000,
+		"vocabulary": 10000,
+		"skew": 1.0,
+		"documentLength": 200,
+		"paragraphLength": 40,
+		"seed": 1,
+		"bufferSize": 65536,
+		"growthFactor": 3,
+		"queries": 20,
+		"repeat": 3,
+	}
+	parameterOptions = {
+		"--documents": ("documents",int),
+		"--vocabulary": ("vocabulary",int),
+		"--skew": ("skew",float),
+		"--document-length": ("documentLength",int),
+		"--paragraph-length": ("paragraphLength",int),
+		"--seed": ("seed",int),
+		"--buffer-size": ("bufferSize",int),
+		"--growth-factor": ("growthFactor",int),
+		"--queries": ("queries",int),
+		"--repeat": ("repeat",int),
+	}
+	path = None
+	outputFile = None
+	compareFile = None
+	tolerance = 0.2
+	for option,value in options:
+		if option in parameterOptions:
+			parameterName,parameterType = parameterOptions[option]
+			parameters[parameterName] = parameterType(value)
+		elif option == "--path":
+			path = value
+		elif option == "--output":
+			outputFile = value
+		elif option == "--compare":
+			compareFile = value
+		elif option == "--tolerance":
+			tolerance = float(value)
+
+	temporaryPath = None
+	if path is None:
+		path = temporaryPath = tempfile.mkdtemp(prefix="leif-bench-")
+	elif not os.path.exists(path):
+		os.makedirs(path)
+	try:
+		results = runBenchmarks(parameters,path)
+	finally:
+		if temporaryPath is not None: shutil.rmtree(temporaryPath,True)
+
+	resultsText = json.dumps(results,indent=1,sort_keys=True)
+	if outputFile is None:
+		print resultsText
+	else:
+		open(outputFile,"w").write(resultsText + "\n")
+
+	if compareFile is not None:
+		lines,regressionCount = compareResults(json.load(open(compareFile)),results,tolerance)
+		print >> sys.stderr, "\n".join(lines)
+		print >> sys.stderr, "%d regression(s) beyond %.0f%%" % (regressionCount,tolerance * 100.0)
+		if regressionCount: sys.exit(1)
+
+if __name__ == "__main__":
+	main()
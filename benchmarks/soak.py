@@ -0,0 +1,341 @@
+"""
+A mixed workload soak test: queries while documents are being indexed and merged
+
+One thread keeps posting ZipfianCorpus documents while query threads run queries
+through reduceTopLevel. Every query records its latency and whether a merge ran
+while it did, boolean queries are also checked against a brute-force oracle, and
+a monitor thread samples memory and ingest progress. Results are written as JSON:
+
+	python -m benchmarks.soak --seconds 300 --query-threads 4 --output soak.json
+
+Documents are indexed in docId order, so the documents whose postings have all
+been indexed are always a prefix of the corpus. A query is correct when it
+returns exactly the oracle's answer on the documents indexed before it started,
+and nothing beyond the document being indexed by the time it finished.
+"""
+import bisect
+import getopt
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from benchmarks import corpus
+from benchmarks.run import percentile
+from leif import index, query
+
+MismatchExamples = 10 # mismatching queries kept in the results
+ErrorExamples = 10
+
+def residentSetSize():
+	"""current resident set size in bytes, the peak where /proc is not available"""
+	try:
+		for line in open("/proc/self/status"):
+			if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def latencySummary(latencies):
+	latencies = sorted(latencies)
+	return {
+		"count": len(latencies),
+		"p50": percentile(latencies,0.50),
+		"p99": percentile(latencies,0.99),
+		"p999": percentile(latencies,0.999),
+		"max": latencies and latencies[-1] or 0.0,
+	}
+
+class BooleanOracle(object):
+	"""Answers Term, And, Or and Andnot expression trees by scanning the words of every document"""
+	__slots__ = ["documentWords"]
+	def __init__(self):
+		self.documentWords = list() # docId -> frozenset of termWords
+
+	def addDocument(self,termWords):
+		self.documentWords.append(frozenset(termWords))
+
+	def matches(self,expressionTree,words):
+		rator,rands = expressionTree[0],expressionTree[1:]
+		if rator == "Term": return rands[0] in words
+		if rator == "And": return all([self.matches(rand,words) for rand in rands])
+		if rator == "Or": return any([self.matches(rand,words) for rand in rands])
+		if rator == "Andnot": return self.matches(rands[0],words) and not any([self.matches(rand,words) for rand in rands[1:]])
+		raise ValueError("BooleanOracle cannot answer %s" % rator)
+
+	def docIds(self,expressionTree,documentCount):
+		"""the matching docIds among the first documentCount documents"""
+		return [docId for docId in xrange(documentCount) if self.matches(expressionTree,self.documentWords[docId])]
+
+class SoakTest(object):
+	def __init__(self,parameters,path):
+		self.parameters = parameters
+		self.corpus = corpus.ZipfianCorpus(parameters["vocabulary"],parameters["skew"],parameters["documentLength"],parameters["paragraphLength"],parameters["seed"])
+		self.reverseIndex = index.ReverseIndex(path,"soak","soak")
+		self.reverseIndex.growthStrategy = index.GrowthStrategyFixedBuffer(parameters["bufferSize"],parameters["growthFactor"])
+		self.reverseIndex.partitions[0].termInstanceLimit = self.reverseIndex.growthStrategy.computeTermInstanceLimitForPartitionK(0)
+		self.termWordOfTermId = dict([(termId,termWord) for termWord,termId in self.corpus.termWords.items()])
+		self.oracle = BooleanOracle()
+		self.cumulativePostings = list() # docId -> postings of documents 0..docId
+		self.stopEvent = threading.Event()
+		self.lock = threading.Lock()
+		self.latencies = dict() # rator -> [seconds]
+		self.mergeLatencies = list() # queries that overlapped a merge
+		self.quietLatencies = list()
+		self.checkedCount = 0
+		self.mismatches = list()
+		self.mismatchCount = 0
+		self.errors = list()
+		self.errorCount = 0
+		self.timeline = list()
+
+	def indexedDocumentCount(self):
+		"""documents whose postings have all been indexed"""
+		return bisect.bisect_right(self.cumulativePostings,self.reverseIndex.ingestStatistics.postingsIndexed)
+
+	def _ingestThread(self):
+		postingCount = 0
+		documentRate = self.parameters["documentRate"]
+		startTime = time.time()
+		for postedCount,analyzedDocument in enumerate(self.corpus.generateAnalyzedDocuments(self.parameters["documents"])):
+			if self.stopEvent.isSet(): break
+			# keep the backlog bounded, so that query latency is measured against a live index
+			while postedCount - self.indexedDocumentCount() > self.parameters["maxBacklog"] and not self.stopEvent.isSet():
+				time.sleep(0.005)
+			if documentRate:
+				delay = startTime + float(postedCount) / documentRate - time.time()
+				if delay > 0: time.sleep(delay)
+			termWords = set()
+			for analyzedTerm in analyzedDocument.analyzedTermList:
+				for termId,extent in analyzedTerm.instanceSet:
+					termWords.add(self.termWordOfTermId[termId])
+			self.oracle.addDocument(termWords)
+			postingCount += corpus.postingCount(analyzedDocument)
+			self.cumulativePostings.append(postingCount)
+			self.reverseIndex.post(analyzedDocument)
+
+	def _makeQuery(self,randomSource):
+		maxRank = min(1000,self.corpus.vocabularySize)
+		_termWord = lambda: self.corpus.termWordOfRank(int(maxRank ** randomSource.random()))
+		rator = randomSource.choice(["Term","And","Or","Andnot","Before","Within"])
+		if rator == "Term": return '(Term,"%s")' % _termWord()
+		if rator == "Within": return '(Within,5,(Term,"%s"),(Term,"%s"))' % (_termWord(),_termWord())
+		return '(%s,(Term,"%s"),(Term,"%s"))' % (rator,_termWord(),_termWord())
+
+	def _queryThread(self,threadIndex):
+		randomSource = random.Random(self.parameters["seed"] * 1000 + threadIndex)
+		while not self.stopEvent.isSet():
+			queryString = self._makeQuery(randomSource)
+			expressionTree = query.getExpressionTreeFromString(queryString)
+			rator = expressionTree[0]
+			documentCountBefore = self.indexedDocumentCount()
+			mergeCountBefore = self.reverseIndex.ingestStatistics.mergeCount
+			startTime = time.time()
+			try:
+				environment = query.makeInitialEnvironmentFromReverseIndex(self.reverseIndex,self.corpus.termWords)
+				docIds = [computedMatch.docId for computedMatch in query.reduceTopLevel(expressionTree,environment)]
+			except Exception, e:
+				self.lock.acquire()
+				try:
+					self.errorCount += 1
+					if len(self.errors) < ErrorExamples: self.errors.append({"query": queryString,"error": "%s: %s" % (e.__class__.__name__,e)})
+				finally:
+					self.lock.release()
+				continue
+			latency = time.time() - startTime
+			documentCountAfter = self.indexedDocumentCount()
+			# merges run one at a time, so one that was running or started meanwhile shows up here
+			duringMerge = self.reverseIndex.ingestStatistics.mergesStarted > mergeCountBefore
+
+			mismatch = None
+			if rator in ("Term","And","Or","Andnot"):
+				expectedDocIds = self.oracle.docIds(expressionTree,documentCountBefore)
+				settledDocIds = [docId for docId in docIds if docId < documentCountBefore]
+				# the document being indexed when the query finished may already show up
+				unexpectedDocIds = [docId for docId in docIds if docId > documentCountAfter]
+				if settledDocIds != expectedDocIds or unexpectedDocIds:
+					mismatch = {
+						"query": queryString,
+						"indexedDocuments": [documentCountBefore,documentCountAfter],
+						"missing": sorted(set(expectedDocIds) - set(settledDocIds))[:20],
+						"unexpected": (sorted(set(settledDocIds) - set(expectedDocIds)) + unexpectedDocIds)[:20],
+						"duplicated": len(settledDocIds) - len(set(settledDocIds)),
+					}
+
+			self.lock.acquire()
+			try:
+				self.latencies.setdefault(rator,list()).append(latency)
+				if duringMerge: self.mergeLatencies.append(latency)
+				else: self.quietLatencies.append(latency)
+				if rator in ("Term","And","Or","Andnot"): self.checkedCount += 1
+				if mismatch is not None:
+					self.mismatchCount += 1
+					if len(self.mismatches) < MismatchExamples: self.mismatches.append(mismatch)
+			finally:
+				self.lock.release()
+
+	def _monitorThread(self,startTime):
+		while not self.stopEvent.isSet():
+			ingestStatistics = self.reverseIndex.ingestStatistics
+			self.lock.acquire()
+			try:
+				queryCount = sum(map(len,self.latencies.values()))
+			finally:
+				self.lock.release()
+			self.timeline.append({
+				"seconds": time.time() - startTime,
+				"residentBytes": residentSetSize(),
+				"documentsIndexed": self.indexedDocumentCount(),
+				"postingsIndexed": ingestStatistics.postingsIndexed,
+				"merges": ingestStatistics.mergeCount,
+				"partitions": len(self.reverseIndex.partitions),
+				"postingQueueDepth": self.reverseIndex.postingQueue.qsize(),
+				"queries": queryCount,
+			})
+			self.stopEvent.wait(self.parameters["sampleInterval"])
+
+	def run(self):
+		startTime = time.time()
+		threads = [threading.Thread(target = self._ingestThread,name = "SoakIngest")]
+		threads += [threading.Thread(target = self._queryThread,name = "SoakQuery%d" % threadIndex,args = (threadIndex,)) for threadIndex in xrange(self.parameters["queryThreads"])]
+		threads.append(threading.Thread(target = self._monitorThread,name = "SoakMonitor",args = (startTime,)))
+		for thread in threads:
+			thread.setDaemon(True)
+			thread.start()
+		try:
+			self.stopEvent.wait(self.parameters["seconds"])
+		except KeyboardInterrupt:
+			pass
+		self.stopEvent.set()
+		for thread in threads: thread.join()
+
+		stats = self.reverseIndex.stats()
+		allLatencies = list()
+		for latencies in self.latencies.values(): allLatencies += latencies
+		return {
+			"parameters": self.parameters,
+			"seconds": time.time() - startTime,
+			"latency": latencySummary(allLatencies),
+			"latencyByOperator": dict([(rator,latencySummary(latencies)) for rator,latencies in self.latencies.items()]),
+			"latencyDuringMerges": latencySummary(self.mergeLatencies),
+			"latencyWithoutMerges": latencySummary(self.quietLatencies),
+			"correctness": {
+				"checked": self.checkedCount,
+				"mismatches": self.mismatchCount,
+				"examples": self.mismatches,
+			},
+			"errors": {
+				"count": self.errorCount,
+				"examples": self.errors,
+			},
+			"ingest": {
+				"documentsIndexed": self.indexedDocumentCount(),
+				"postingsIndexed": stats["postingsIndexed"],
+				"documentsPerSecond": stats["documentsPerSecond"],
+				"merges": stats["merges"]["count"],
+				"mergeSeconds": stats["merges"]["seconds"],
+			},
+			"timeline": self.timeline,
+		}
+
+def main(argv=None):
+	if argv is None: argv = sys.argv
+	def usage():
+		print >> sys.stderr, """Usage: python -m benchmarks.soak [OPTIONS]
+
+--seconds S     How long to run (default 60)
+--query-threads N
+                Threads running queries (default 4)
+--documents N   Most documents to post (default 1000000)
+--document-rate N
+                Documents posted per second, 0 posts as fast as the index takes them (default 0)
+--max-backlog N Most documents posted but not yet indexed (default 200)
+--vocabulary N  Distinct words (default 10000)
+--skew S        Zipf exponent of the word frequencies (default 1.0)
+--document-length N
+                Mean words per document (default 200)
+--seed N        Seed of the corpus and the queries (default 1)
+--buffer-size N GrowthStrategyFixedBuffer buffer size in TermInstances (default 65536)
+--growth-factor N
+                GrowthStrategyFixedBuffer growth factor (default 3)
+--sample-interval S
+                Seconds between memory samples (default 1)
+--path DIR      Build the index in DIR, which is kept (default a temporary directory)
+--output FILE   Write the results to FILE (default stdout)
+
+Exits with status 1 when any query returned a wrong result or failed.
+"""
+		sys.exit(2)
+
+	parameters = {
+		"seconds": 60.0,
+		"queryThreads": 4,
+		"documents": 1000000,
+		"documentRate": 0,
+		"maxBacklog": 200,
+		"vocabulary": 10000,
+		"skew": 1.0,
+		"documentLength": 200,
+		"paragraphLength": 40,
+		"seed": 1,
+		"bufferSize": 65536,
+		"growthFactor": 3,
+		"sampleInterval": 1.0,
+	}
+	parameterOptions = {
+		"--seconds": ("seconds",float),
+		"--query-threads": ("queryThreads",int),
+		"--documents": ("documents",int),
+		"--document-rate": ("documentRate",float),
+		"--max-backlog": ("maxBacklog",int),
+		"--vocabulary": ("vocabulary",int),
+		"--skew": ("skew",float),
+		"--document-length": ("documentLength",int),
+		"--seed": ("seed",int),
+		"--buffer-size": ("bufferSize",int),
+		"--growth-factor": ("growthFactor",int),
+		"--sample-interval": ("sampleInterval",float),
+	}
+	try:
+		options,other_args = getopt.getopt(argv[1:],"",[option[2:] + "=" for option in parameterOptions] + ["path=","output="])
+	except getopt.GetoptError, e:
+		print >> sys.stderr, e.msg
+		usage()
+
+	path = None
+	outputFile = None
+	for option,value in options:
+		if option in parameterOptions:
+			parameterName,parameterType = parameterOptions[option]
+			parameters[parameterName] = parameterType(value)
+		elif option == "--path":
+			path = value
+		elif option == "--output":
+			outputFile = value
+
+	temporaryPath = None
+	if path is None:
+		path = temporaryPath = tempfile.mkdtemp(prefix="leif-soak-")
+	elif not os.path.exists(path):
+		os.makedirs(path)
+	try:
+		results = SoakTest(parameters,path).run()
+	finally:
+		if temporaryPath is not None: shutil.rmtree(temporaryPath,True)
+
+	resultsText = json.dumps(results,indent=1,sort_keys=True)
+	if outputFile is None:
+		print resultsText
+	else:
+		open(outputFile,"w").write(resultsText + "\n")
+	print >> sys.stderr, "Soak: %d queries p50 %.4fs p99 %.4fs p999 %.4fs, %d/%d wrong, %d failed" % (
+		results["latency"]["count"],results["latency"]["p50"],results["latency"]["p99"],results["latency"]["p999"],
+		results["correctness"]["mismatches"],results["correctness"]["checked"],results["errors"]["count"])
+	if results["correctness"]["mismatches"] or results["errors"]["count"]: sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -1,8 +1,19 @@
+import analysis
+import batch
+import cache
 import data
+import forward
 import getopt
 import index
+import ingest
+import lazy
+import optimize
 import query
+import rank
+import server
 import sys
+import telemetry
+import termdict
 import time
 import unindex
 
@@ -16,20 +27,68 @@ Usage: python leif OPTIONS
 OPTIONS:
 
 --update        Indexer will read in new AnalyzedDocuments and update the index
---data FILE     If running an Update, data is loaded from FILE (a pickle of a list of AnalyzedDocument objects)
+--data FILE     If running an Update, data is loaded from FILE (a .docs file written by the analysis)
+--ingest DIR    Indexer will analyze the Reuters Corpus XML files under DIR and index them directly,
+                writing the alphabet to the --alphabet FILE as it grows
+                --workers N parses in N processes (0 means one per CPU, default 1)
+--context FILE  If running an Ingest, the analysis context (default: the alphabet FILE + ".context")
+--queue-size N  If running an Ingest, documents buffered ahead of the indexer (default 256)
+--alphabet-interval S
+                If running an Ingest, seconds between saves of the alphabet (default 30)
+--stats-file FILE
+                If running an Update, append index statistics to FILE as JSON lines
+--stats-interval S
+                Seconds between lines of the stats file (default 10)
+--profile-ingest
+                If running an Update, sample the ingest threads and print where they spent their time
+--forward-index If running an Update or an Ingest into an empty index, also keep every document in a
+                forward index, which --unindex and --snippets then read (an index that has one always keeps it up)
+--biword-words FILE
+                If running an Update or an Ingest into an empty index, also index the pairs of adjacent
+                words holding one of the termWords in FILE (one per line), Phrase queries read them
+
+--query-file FILE
+                Evaluate every query in FILE (one per line) and write JSON lines to stdout
+--workers N     If running a query file, evaluate with N workers (default: one per CPU)
+--threads       If running a query file, the workers are threads rather than processes
+
+--serve HOST:PORT
+                Serve JSON line queries to many concurrent clients (see leif/server.py)
+                --workers N sets the number of query worker threads (default 4)
 
 --unindex       Indexer will generate source documents (or a best approximation)
 --where DIR     If running an Unindex, source documents are created in DIR
+--sort-memory N If running an Unindex of an index without a forward index, sort the postings in runs
+                of about N bytes (default 67108864)
+                --workers N writes the documents in N processes (0 means one per CPU, default 1)
 
---alphabet FILE Pickled termWord hash (generated when the analyzedDocuments were)
+--optimize      Indexer will merge every partition into one, results still report the docIds
+                documents were posted with
+--cluster       If running an Optimize, renumber the documents so that similar ones get nearby docIds
+--order-file FILE
+                If running an Optimize, renumber the documents in the order of the docIds in FILE
+                (one per line), documents it does not list follow
+
+--alphabet FILE termWord dictionary (generated when the analyzedDocuments were)
 --path PATH     Index is located at PATH
 --prefix PREFIX Index uses PREFIX in file names
 --key KEY       Associate KEY with prefix to prevent opening incorrect Index data
+
+--cache-size N  Query mode caches up to N bytes of query results (0 disables, default 33554432)
+--postings-cache-size N
+                Query mode caches up to N bytes of decoded postings for hot terms (0 disables, default 67108864)
+--rank K        Query mode ranks the Terms of each query with BM25 and prints the top K docIds
+--page-size N   Query mode pauses after every N matches, answering n stops the query early
+--snippets      Query mode prints the matched words of every match in context, from the forward index
+--max-seconds S Query and serve modes stop a query after S seconds, printing its partial result
+--max-postings N
+                Query and serve modes stop a query once it has decoded N postings
+--max-matches N Query and serve modes stop a query once its operators have produced N intermediate matches
 """
 		sys.exit(1)
 	
 	try:
-		options,other_args = getopt.getopt(argv[1:],"",["update","unindex","where=","alphabet=","data=","path=","prefix=","key="])
+		options,other_args = getopt.getopt(argv[1:],"",["update","unindex","where=","alphabet=","data=","path=","prefix=","key=","cache-size=","postings-cache-size=","rank=","page-size=","query-file=","workers=","threads","serve=","max-seconds=","max-postings=","max-matches=","stats-file=","stats-interval=","profile-ingest","ingest=","context=","queue-size=","alphabet-interval=","forward-index","snippets","sort-memory=","biword-words=","optimize","cluster","order-file="])
 	except getopt.GetoptError, e:
 		print e.msg
 		usage()
@@ -41,10 +100,41 @@ OPTIONS:
 	path = "."
 	prefix = "no-set-prefix"
 	key = "no-set-key"
+	cacheSize = 32 * 1024 * 1024
+	postingsCacheSize = 64 * 1024 * 1024
+	rankTopK = None
+	pageSize = None
+	queryFile = None
+	workerCount = None
+	useThreads = False
+	serveAddress = None
+	budgetLimits = [None,None,None] # seconds,postings,intermediate matches
+	statsFile = None
+	statsInterval = 10.0
+	profileIngest = False
+	ingestDir = None
+	contextPath = None
+	queueSize = 256
+	alphabetInterval = 30.0
+	useForwardIndex = False
+	showSnippets = False
+	sortMemory = unindex.DefaultSortMemory
+	biwordWordsFile = None
+	clusterDocIds = False
+	orderFile = None
 
 	for option,value in options:
 		if option == "--update":
 			mode = "UPDATE"
+		elif option == "--ingest":
+			mode = "INGEST"
+			ingestDir = value
+		elif option == "--context":
+			contextPath = value
+		elif option == "--queue-size":
+			queueSize = int(value)
+		elif option == "--alphabet-interval":
+			alphabetInterval = float(value)
 		elif option == "--unindex":
 			mode = "UNINDEX"
 		elif option == "--where":
@@ -59,59 +149,181 @@ OPTIONS:
 			prefix = value
 		elif option == "--key":
 			key = value
+		elif option == "--cache-size":
+			cacheSize = int(value)
+		elif option == "--postings-cache-size":
+			postingsCacheSize = int(value)
+		elif option == "--rank":
+			rankTopK = int(value)
+		elif option == "--page-size":
+			pageSize = int(value)
+		elif option == "--query-file":
+			mode = "BATCH"
+			queryFile = value
+		elif option == "--workers":
+			workerCount = int(value)
+		elif option == "--threads":
+			useThreads = True
+		elif option == "--serve":
+			mode = "SERVE"
+			serveAddress = value
+		elif option == "--max-seconds":
+			budgetLimits[0] = float(value)
+		elif option == "--max-postings":
+			budgetLimits[1] = int(value)
+		elif option == "--max-matches":
+			budgetLimits[2] = int(value)
+		elif option == "--stats-file":
+			statsFile = value
+		elif option == "--stats-interval":
+			statsInterval = float(value)
+		elif option == "--profile-ingest":
+			profileIngest = True
+		elif option == "--forward-index":
+			useForwardIndex = True
+		elif option == "--snippets":
+			showSnippets = True
+		elif option == "--sort-memory":
+			sortMemory = int(value)
+		elif option == "--biword-words":
+			biwordWordsFile = value
+		elif option == "--optimize":
+			mode = "OPTIMIZE"
+		elif option == "--cluster":
+			clusterDocIds = True
+		elif option == "--order-file":
+			orderFile = value
 		else:
 			print >> sys.stderr, "Unknown option: %s" % option
 			usage()
 	
 	if alphabet is None: usage()
-	import cPickle as pickle
 	if mode == "UPDATE" and analyzedDocFile is None: usage()
 
-	termWords = pickle.load(open(alphabet))
+	if mode != "INGEST": termWords = termdict.openAlphabet(alphabet)
+	else: parser = ingest.openParser(contextPath or alphabet + ".context",alphabet)
 
-	reverseIndex = index.ReverseIndex(path,prefix,key)
+	biwordTermIds = None
+	if biwordWordsFile is not None and mode in ("UPDATE","INGEST"):
+		biwordWords = [line.strip() for line in open(biwordWordsFile) if line.strip()]
+		if mode == "INGEST": biwordTermIds = [parser.getTermWordTermId(termWord.decode("utf-8")) for termWord in biwordWords]
+		else: biwordTermIds = [termWords[termWord] for termWord in biwordWords if termWord in termWords]
+
+	if mode not in ("QUERY","SERVE"): postingsCacheSize = 0
+	documentQueueSize = postingQueueSize = 0
+	if mode == "INGEST": documentQueueSize,postingQueueSize = queueSize,queueSize * 256
+	reverseIndex = index.ReverseIndex(path,prefix,key,postingsCacheSize,documentQueueSize,postingQueueSize,useForwardIndex,biwordTermIds)
 	reverseIndex.growthStrategy = index.GrowthStrategyFixedBuffer(1024,3)
+	if mode == "INGEST" and not ingest.parserCoversIndex(parser,reverseIndex):
+		print >> sys.stderr, "The index at %s holds termIds missing from the analysis context and the alphabet %s, refusing to ingest into it" % (path,alphabet)
+		sys.exit(1)
 
-	if mode == "UPDATE":
-		analysisFile = open(analyzedDocFile)
-		while 1:
-			try:
-				analyzedDocument = pickle.load(analysisFile)
+	if mode in ("UPDATE","INGEST"):
+		statisticsDumper = None
+		if statsFile is not None: statisticsDumper = telemetry.StatisticsDumper(reverseIndex,open(statsFile,"a"),statsInterval).start()
+		ingestProfiler = None
+		if profileIngest: ingestProfiler = reverseIndex.startIngestProfiler()
+		if mode == "INGEST":
+			ingest.ingestFileList(parser,reverseIndex,lazy.recursiveListdir(ingestDir,True),alphabet,workerCount is None and 1 or workerCount or None,alphabetInterval)
+		else:
+			for analyzedDocument in analysis.readAnalyzedDocuments(analyzedDocFile):
 				reverseIndex.post(analyzedDocument)
-			except EOFError:
-				break
 
-		analysisFile.close()
 		reverseIndex.writeToDisk()
+		if statisticsDumper is not None: statisticsDumper.stop()
+		if ingestProfiler is not None:
+			ingestProfiler.stop()
+			print >> sys.stderr, "\n".join(ingestProfiler.report())
+		ingestStatistics = reverseIndex.ingestStatistics
+		print >> sys.stderr, "Indexed %d documents, %d postings, %d merges in %.2fs, write amplification %.2f" % (
+			ingestStatistics.documentsPosted,ingestStatistics.postingsIndexed,ingestStatistics.mergeCount,ingestStatistics.mergeSeconds,ingestStatistics.writeAmplification)
+	elif mode == "BATCH":
+		queryStrings = open(queryFile)
+		batch.runQueryBatch(reverseIndex,termWords,queryStrings,sys.stdout,workerCount,useThreads)
+		queryStrings.close()
+	elif mode == "SERVE":
+		server.serveReverseIndex(serveAddress,reverseIndex,termWords,workerCount or 4,budgetLimits)
 	elif mode == "UNINDEX":
-		unindex.unindexReverseIndex(termWords,reverseIndex,unindexDir)
+		unindex.unindexReverseIndex(termWords,reverseIndex,unindexDir,sortMemory,workerCount is None and 1 or workerCount or None)
+	elif mode == "OPTIMIZE":
+		docIdOrder = None
+		if orderFile is not None: docIdOrder = optimize.readDocIdOrder(reverseIndex,orderFile)
+		elif clusterDocIds: docIdOrder = optimize.clusterDocIdOrder(reverseIndex)
+		try:
+			optimize.optimizeReverseIndex(reverseIndex,docIdOrder)
+		except ValueError, e:
+			print >> sys.stderr, e
+			sys.exit(1)
 	elif mode == "QUERY":
 		print >> sys.stderr, "LEIF: Query Test Mode"
-		def reverseIndexLookupFunction(_termWord):
-			def computedMatchGenerator(_termWord):
-				if _termWord in termWords:
-					for docIdTermInstanceVector in reverseIndex.lookupTermId(termWords[_termWord]):
-						if docIdTermInstanceVector.docId is not None:
-							yield data.ComputedMatch(docIdTermInstanceVector.docId,list(docIdTermInstanceVector.termInstancesGenerator))
-		
-			return data.ComputedMatchVector(computedMatchGenerator(_termWord))
-			
+		resultCache = None
+		if cacheSize > 0: resultCache = cache.QueryResultCache(cacheSize)
+		termWordOfTermId = None
+		if showSnippets:
+			if reverseIndex.forwardIndex is None:
+				print >> sys.stderr, "No forward index at %s, snippets are off" % path
+			else:
+				termWordOfTermId = forward.invertAlphabet(termWords)
+
 		while 1:
 			try:
 				queryString = raw_input("query> ")
+				# "count (...)" and "exists (...)" only report whether and how often the query matches
+				# "explain (...)" and "explain count (...)" print the plan annotated with what each node cost
+				queryCommand = None
+				if queryString.split(None,1)[:1] in (["count"],["exists"],["explain"]):
+					queryCommand,queryString = queryString.split(None,1)
+					if queryCommand == "explain" and queryString.split(None,1)[:1] == ["count"]:
+						queryCommand,queryString = "explain count",queryString.split(None,1)[1]
 				queryExpression = query.getExpressionTreeFromString(queryString)
-				queryResult = query.reduceTopLevel(queryExpression,query.makeInitialEnvironmentFromLookupFunction(reverseIndexLookupFunction))
-				if queryResult:
-					for computedMatch in queryResult:
-						print computedMatch
+				if rankTopK is not None:
+					termIds = [termWords[termWord] for termWord in query.collectTermWords(queryExpression) if termWord in termWords]
+					for score,docId in rank.rankTermIds(reverseIndex,termIds,rankTopK):
+						print "%d\t%.4f" % (reverseIndex.externalDocId(docId),score)
+					continue
+				queryEnvironment = query.makeInitialEnvironmentFromReverseIndex(reverseIndex,termWords)
+				budget = None
+				if budgetLimits != [None,None,None]: budget = data.QueryBudget(*budgetLimits)
+				if queryCommand in ("explain","explain count"):
+					if queryExpression is not None:
+						startTime = time.time()
+						analyzedPlan = query.PreparedQuery(queryExpression).explainAnalyze(queryEnvironment,queryCommand == "explain" and "matches" or "count",budget)
+						print "\n".join(analyzedPlan.format())
+						print "Total: %d matches in %.3fms" % (analyzedPlan.rowsOut,(time.time() - startTime) * 1000.0)
+				elif queryCommand == "count":
+					print query.countTopLevel(queryExpression,queryEnvironment,budget)
+				elif queryCommand == "exists":
+					print query.existsTopLevel(queryExpression,queryEnvironment,budget)
+				elif resultCache is None:
+					queryResult = query.reduceTopLevel(queryExpression,queryEnvironment,budget)
 				else:
+					queryResult = query.reduceTopLevelWithCache(queryExpression,queryEnvironment,resultCache,reverseIndex.generation,budget)
+				if queryCommand is None and queryResult:
+					for matchCount,computedMatch in enumerate(queryResult):
+						print "#CM(%d):%s" % (reverseIndex.externalDocId(computedMatch.docId),repr(computedMatch.termInstanceVectors))
+						if termWordOfTermId is not None:
+							snippet = forward.makeSnippet(reverseIndex.forwardIndex,termWordOfTermId,computedMatch)
+							if snippet is not None: print "    %s" % snippet
+						if pageSize and (matchCount + 1) % pageSize == 0:
+							try:
+								if raw_input("-- more? [Y/n] ").strip().lower().startswith("n"): break
+							except EOFError:
+								break
+				elif queryCommand is None:
 					print >> sys.stderr, "Sorry, reducer returned: %s" % repr(queryResult)
+				if budget is not None and budget.exceeded:
+					print >> sys.stderr, "Budget exceeded, the result above is partial: %s" % budget.exceededReason
 			except EOFError:
 				break
 			except SyntaxError, e:
 				print >> sys.stderr, e
 				continue
 
+		if resultCache is not None:
+			print >> sys.stderr, "Query cache: %s" % repr(resultCache.stats())
+		if reverseIndex.postingsCache is not None:
+			print >> sys.stderr, "Postings cache: %s" % repr(reverseIndex.postingsCache.stats())
+
 if __name__ == "__main__":
 	useProfiler = False
 	for argIndex,arg in enumerate(sys.argv):
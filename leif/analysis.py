@@ -1,8 +1,13 @@
+import collections
 import cPickle as pickle
 import data
+import itertools
+import mmap
+import multiprocessing
 import os
 import pickle_tools
 import sys
+import termdict
 import xml.sax.handler
 
 def deadSimpleNormalizer(inputString):
@@ -13,6 +18,45 @@ def deadSimpleNormalizer(inputString):
 		else:
 			yield token
 
+AnalyzedDocumentsMagic = "LEIFADF\x01" # starts a .docs file of packed documents, anything else is a stream of pickles
+
+class AnalyzedDocumentsWriter(object):
+	"""Writes a .docs file of data.PackedAnalyzedDocument records"""
+	__slots__ = ["outputFile"]
+	def __init__(self,path):
+		self.outputFile = open(path,"wb")
+		self.outputFile.write(AnalyzedDocumentsMagic)
+	
+	def write(self,analyzedDocument):
+		self.outputFile.write(data.PackedAnalyzedDocument.pack(analyzedDocument))
+	
+	def close(self):
+		self.outputFile.close()
+
+def readAnalyzedDocuments(path):
+	"""yields the documents of a .docs file in order
+	A packed file is mmapped and yields data.PackedAnalyzedDocuments which decode in place,
+	the mapping lives as long as any of them does. Older files, pickled AnalyzedDocuments, are still read"""
+	inputFile = open(path,"rb")
+	try:
+		if inputFile.read(len(AnalyzedDocumentsMagic)) != AnalyzedDocumentsMagic:
+			inputFile.seek(0)
+			while 1:
+				try:
+					yield pickle.load(inputFile)
+				except EOFError:
+					return
+		size = os.fstat(inputFile.fileno()).st_size
+		if size == len(AnalyzedDocumentsMagic): return
+		buffer = mmap.mmap(inputFile.fileno(),0,access=mmap.ACCESS_READ)
+	finally:
+		inputFile.close()
+	offset = len(AnalyzedDocumentsMagic)
+	while offset < size:
+		analyzedDocument = data.PackedAnalyzedDocument(buffer,offset)
+		offset += analyzedDocument.size
+		yield analyzedDocument
+
 class ReutersCorpusParser(object):
 	class ReutersCorpusHandler(xml.sax.ContentHandler):
 		"""Can parse Reuters Corpus XML into an intermediate S-expr format, which is then converted to AnalyzedDcouments and termWords"""
@@ -40,23 +84,94 @@ class ReutersCorpusParser(object):
 				self.termTree.append(node)
 				self.nodeStack = None
 
-	def __init__(self,contextPath):
+	class StreamingReutersCorpusHandler(xml.sax.ContentHandler):
+		"""Builds the AnalyzedDocument while parsing, with no intermediate tree
+		Each element gets a position, shared with its first word when the element starts with
+		text. The element's extent, the number of positions it covers, is known once it ends,
+		so open elements are kept on a stack of (analyzedTerm,termId,startPosition)"""
+		def __init__(self,termIdFunction):
+			xml.sax.ContentHandler.__init__(self)
+			self.termIdFunction = termIdFunction
+			self.analyzedDocument = data.AnalyzedDocument(None)
+			self.elementStack = list()
+			self.pendingCharacters = list()
+			self.openElementTerm = None # the AnalyzedTerm of an element which has no content yet
+		
+		def _flushCharacters(self):
+			"""tokenizes the text since the last tag, characters() may split a token across calls"""
+			if not self.pendingCharacters: return
+			text = "".join(self.pendingCharacters)
+			self.pendingCharacters = list()
+			analyzedTermList = self.analyzedDocument.analyzedTermList
+			for token in deadSimpleNormalizer(text):
+				if self.openElementTerm is not None:
+					analyzedTerm = self.openElementTerm
+					self.openElementTerm = None
+				else:
+					analyzedTerm = data.AnalyzedTerm()
+					analyzedTermList.append(analyzedTerm)
+				analyzedTerm.addTermIdWithOptionalExtent(self.termIdFunction(token))
+		
+		def startElement(self,name,attributes):
+			self._flushCharacters()
+			if name == "newsitem": self.analyzedDocument.docId = int(attributes["itemid"])
+			analyzedTerm = data.AnalyzedTerm()
+			self.elementStack.append((analyzedTerm,self.termIdFunction(name),len(self.analyzedDocument.analyzedTermList)))
+			self.analyzedDocument.appendAnalyzedTerm(analyzedTerm)
+			self.openElementTerm = analyzedTerm
+		
+		def characters(self,content):
+			self.pendingCharacters.append(content)
+		
+		def endElement(self,name):
+			self._flushCharacters()
+			self.openElementTerm = None
+			analyzedTerm,termId,startPosition = self.elementStack.pop()
+			analyzedTerm.addTermIdWithOptionalExtent(termId,len(self.analyzedDocument.analyzedTermList) - startPosition)
+
+	def __init__(self,contextPath,_streaming=True):
 		self.path = contextPath
+		self.streaming = _streaming # False analyzes through the ReutersCorpusHandler termTree
 		self.nextTermId = 0
 		self.termWords = dict()
 		self.parser = xml.sax.make_parser()
 		self.handler = None
 
-		if os.path.exists(self.path):	pickle_tools.pickle_load_attrs(self,self.path)
+		if self.path and os.path.exists(self.path):	pickle_tools.pickle_load_attrs(self,self.path)
 	
 	def saveContext(self):
 		pickle_tools.pickle_dump_attrs(self,self.path,"nextTermId","termWords")
 	
+	def contextSnapshot(self):
+		"""returns (nextTermId,termWords) as they are now, for saveContextSnapshot on another thread"""
+		return (self.nextTermId,dict(self.termWords))
+	
+	def saveContextSnapshot(self,snapshot):
+		"""saves a contextSnapshot() as the context, written beside it and renamed into place"""
+		nextTermId,termWords = snapshot
+		temporaryPath = self.path + ".tmp"
+		wp = open(temporaryPath,"wb")
+		try:
+			pickle.dump({"nextTermId": nextTermId,"termWords": termWords},wp,-1)
+		finally:
+			wp.close()
+		os.rename(temporaryPath,self.path)
+	
 	def parseOneDocument(self,path):
 		self.handler = ReutersCorpusParser.ReutersCorpusHandler()
 		self.parser.setContentHandler(self.handler)
 		self.parser.parse(path)
 	
+	def analyzeOneDocument(self,path):
+		"""Parses and analyzes the document at path, returns its AnalyzedDocument"""
+		if not self.streaming:
+			self.parseOneDocument(path)
+			return self.analyzeDocument()
+		handler = ReutersCorpusParser.StreamingReutersCorpusHandler(self.getTermWordTermId)
+		self.parser.setContentHandler(handler)
+		self.parser.parse(path)
+		return handler.analyzedDocument
+	
 	def addTermWordToTermWords(self,termWord):
 		if termWord not in self.termWords:
 			self.termWords[termWord] = self.nextTermId
@@ -104,15 +219,78 @@ class ReutersCorpusParser(object):
 			termWalker(self,node,analyzedDocument)
 		return analyzedDocument
 	
-	def runAnalysisOnFileList(self,outputPrefix,fileList):
-		outputFile = open(outputPrefix + ".docs","wb")
+	def analyzeFileList(self,fileList):
+		"""yields the AnalyzedDocument of every file in fileList, in order"""
 		for fileName in fileList:
-			self.parseOneDocument(fileName)
-			analyzedDocument = self.analyzeDocument()
-			pickle.dump(analyzedDocument,outputFile,-1)
+			yield self.analyzeOneDocument(fileName)
+	
+	def analyzeFileListInParallel(self,fileList,workerCount=None,filesPerTask=64,tasksPerWorker=2):
+		"""Same documents as analyzeFileList, but parsing is spread over workerCount processes
+		Each task parses filesPerTask files with its own termWords, the results are remapped
+		into self.termWords here, in file order, so the output does not depend on workerCount.
+		At most tasksPerWorker tasks per worker are in flight, so a slow consumer holds back the parsing"""
+		def _fileSlices(fileList):
+			fileSlice = list()
+			for fileName in fileList:
+				fileSlice.append(fileName)
+				if len(fileSlice) == filesPerTask:
+					yield fileSlice
+					fileSlice = list()
+			if fileSlice: yield fileSlice
+		
+		if workerCount is None: workerCount = multiprocessing.cpu_count()
+		pool = multiprocessing.Pool(workerCount)
+		pendingTasks = collections.deque()
+		fileSlices = _fileSlices(fileList)
+		try:
+			while 1:
+				for fileSlice in itertools.islice(fileSlices,tasksPerWorker * workerCount - len(pendingTasks)):
+					pendingTasks.append(pool.apply_async(_analyzeFileSlice,(fileSlice,)))
+				if not pendingTasks: break
+				localTermWords,analyzedDocuments = pendingTasks.popleft().get()
+				globalTermIds = self.getTermIdsOfLocalTermWords(localTermWords)
+				for analyzedDocument in analyzedDocuments:
+					self.remapAnalyzedDocument(analyzedDocument,globalTermIds)
+					yield analyzedDocument
+		finally:
+			pool.terminate()
+			pool.join()
+	
+	def writeAnalysisFiles(self,outputPrefix,analyzedDocuments):
+		outputFile = AnalyzedDocumentsWriter(outputPrefix + ".docs")
+		for analyzedDocument in analyzedDocuments:
+			outputFile.write(analyzedDocument)
 
 		outputFile.close()
-		termWordsFile = open(outputPrefix + ".alphabet","wb")
-		pickle.dump(self.termWords,termWordsFile,-1)
-		termWordsFile.close()
+		termdict.saveAlphabet(self.termWords,outputPrefix + ".alphabet")
 		self.saveContext()
+	
+	def runAnalysisOnFileList(self,outputPrefix,fileList):
+		self.writeAnalysisFiles(outputPrefix,self.analyzeFileList(fileList))
+	
+	def getTermIdsOfLocalTermWords(self,localTermWords):
+		"""returns the termIds of self.termWords for localTermWords, a list of termWords indexed by local termId
+		local termIds are visited in ascending order, i.e. in the order the termWords were first
+		seen, so unseen termWords get the termIds this parser would have given them"""
+		return map(self.getTermWordTermId,localTermWords)
+	
+	def remapAnalyzedDocument(self,analyzedDocument,globalTermIds):
+		"""Rewrites the local termIds of analyzedDocument using globalTermIds (see getTermIdsOfLocalTermWords)"""
+		for analyzedTerm in analyzedDocument.analyzedTermList:
+			analyzedTerm.instanceSet = set([(globalTermIds[termId],extent) for termId,extent in analyzedTerm.instanceSet])
+	
+	def runParallelAnalysisOnFileList(self,outputPrefix,fileList,workerCount=None,filesPerTask=64):
+		"""Same output as runAnalysisOnFileList, see analyzeFileListInParallel"""
+		self.writeAnalysisFiles(outputPrefix,self.analyzeFileListInParallel(fileList,workerCount,filesPerTask))
+
+def _analyzeFileSlice(fileNames):
+	"""runs in the workers of runParallelAnalysisOnFileList
+	returns (localTermWords,[AnalyzedDocument]), the termIds of the documents index localTermWords"""
+	parser = ReutersCorpusParser(None)
+	analyzedDocuments = list()
+	for fileName in fileNames:
+		analyzedDocuments.append(parser.analyzeOneDocument(fileName))
+	localTermWords = [None] * parser.nextTermId
+	for termWord,termId in parser.termWords.iteritems():
+		localTermWords[termId] = termWord
+	return (localTermWords,analyzedDocuments)
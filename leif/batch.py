@@ -0,0 +1,120 @@
+"""
+Batch query execution
+
+All queries are parsed up front, the postings of every distinct term are decoded
+once into DecodedDocIdTermInstanceTables, and the queries are then evaluated
+against those shared tables by a pool of workers. Results are written as JSON
+lines, in the order of the input queries, as soon as they are available.
+"""
+import data
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
+import query
+import sys
+import time
+
+# set before the worker pool starts, process workers inherit them when they are forked
+_batchEnvironment = None
+_batchDocIdMap = None # the data.DocIdMap of the index, results report the docIds documents were posted with
+
+def makeEnvironmentFromDecodedTables(decodedTables):
+	"""decodedTables maps termWord to the DecodedDocIdTermInstanceTable of its postings"""
+	def lookupFunction(termWord):
+		def computedMatchGenerator(decodedTable):
+			for docIdTermInstanceVector in data.readDecodedDocIdTermInstanceTable(decodedTable):
+				termInstancesFunction = lambda termInstancesGenerator=docIdTermInstanceVector.termInstancesGenerator: list(termInstancesGenerator)
+				yield data.ComputedMatch(docIdTermInstanceVector.docId,_termInstanceVectorsFunction=termInstancesFunction)
+		if termWord not in decodedTables: return data.ComputedMatchVector(iter([]))
+		return data.ComputedMatchVector(computedMatchGenerator(decodedTables[termWord]))
+	def docIdLookupFunction(termWord):
+		if termWord not in decodedTables: return iter([])
+		return iter(decodedTables[termWord].docIds)
+	def documentFrequencyFunction(termWord):
+		if termWord not in decodedTables: return 0
+		return len(decodedTables[termWord])
+
+	# runQueryBatch decoded every termWord the Prefixes, Ranges, Fuzzies and Substrings of the batch
+	# expand to, they expand alike against the decoded termWords
+	return query.makeInitialEnvironmentFromLookupFunction(lookupFunction,docIdLookupFunction,documentFrequencyFunction,decodedTables)
+
+def decodeTermWords(reverseIndex,termWords,queryTermWords):
+	"""returns a dict of termWord -> DecodedDocIdTermInstanceTable for every termWord in queryTermWords
+	that is part of the alphabet termWords"""
+	decodedTables = dict()
+	for termWord in queryTermWords:
+		if termWord in termWords and termWord not in decodedTables:
+			decodedTables[termWord] = data.decodeDocIdTermInstanceTable(reverseIndex.lookupTermId(termWords[termWord]))
+	return decodedTables
+
+def parseQueryStrings(queryStrings):
+	"""returns a list of (queryString,expressionTree,errorMessage), blank lines are skipped"""
+	parsedQueries = list()
+	for queryString in queryStrings:
+		queryString = queryString.strip()
+		if not queryString: continue
+		try:
+			expressionTree = query.getExpressionTreeFromString(queryString)
+			query.compileExpressionTree(expressionTree)
+			parsedQueries.append((queryString,expressionTree,None))
+		except SyntaxError, e:
+			parsedQueries.append((queryString,None,str(e)))
+	return parsedQueries
+
+def _evaluateBatchQuery(parsedQuery):
+	"""runs in the workers, returns one JSON line"""
+	queryString,expressionTree,errorMessage = parsedQuery
+	if errorMessage is not None:
+		return json.dumps({"query": queryString,"error": errorMessage})
+	try:
+		docIds = [computedMatch.docId for computedMatch in query.reduceTopLevel(expressionTree,_batchEnvironment)]
+		if _batchDocIdMap is not None: docIds = map(_batchDocIdMap.externalDocId,docIds)
+	except Exception, e:
+		return json.dumps({"query": queryString,"error": "%s: %s" % (e.__class__.__name__,e)})
+	return json.dumps({"query": queryString,"count": len(docIds),"docIds": docIds})
+
+def runQueryBatch(reverseIndex,termWords,queryStrings,outputFile,workerCount=None,useThreads=False):
+	"""Evaluates every query in queryStrings, writing JSON lines to outputFile
+	workerCount defaults to the number of CPUs, workerCount 1 evaluates in this process
+	returns (queryCount,elapsedSeconds)"""
+	global _batchEnvironment,_batchDocIdMap
+	startTime = time.time()
+	parsedQueries = parseQueryStrings(queryStrings)
+	queryTermWords = set()
+	for queryString,expressionTree,errorMessage in parsedQueries:
+		queryTermWords.update(query.collectTermWords(expressionTree))
+		for termExpansionPlan in query.collectTermExpansions(expressionTree):
+			queryTermWords.update(termExpansionPlan.expand(termWords))
+	decodedTables = decodeTermWords(reverseIndex,termWords,queryTermWords)
+	_batchEnvironment = makeEnvironmentFromDecodedTables(decodedTables)
+	_batchDocIdMap = reverseIndex.docIdMap
+	decodeTime = time.time()
+	print >> sys.stderr, "Batch: %d queries, %d distinct terms decoded in %.2fs" % (len(parsedQueries),len(decodedTables),decodeTime - startTime)
+
+	if workerCount is None: workerCount = multiprocessing.cpu_count()
+	pool = None
+	if workerCount <= 1:
+		results = itertools.imap(_evaluateBatchQuery,parsedQueries)
+	else:
+		if useThreads: pool = multiprocessing.pool.ThreadPool(workerCount)
+		else: pool = multiprocessing.Pool(workerCount)
+		chunkSize = max(1,min(256,len(parsedQueries) / (workerCount * 4)))
+		results = pool.imap(_evaluateBatchQuery,parsedQueries,chunkSize)
+
+	queryCount = 0
+	try:
+		for resultLine in results:
+			outputFile.write(resultLine + "\n")
+			queryCount += 1
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		_batchEnvironment = None
+
+	elapsedSeconds = time.time() - startTime
+	evaluateSeconds = time.time() - decodeTime
+	print >> sys.stderr, "Batch: %d queries in %.2fs, %.1f queries/s (%.1f queries/s excluding decode)" % (
+		queryCount,elapsedSeconds,queryCount / max(elapsedSeconds,1e-9),queryCount / max(evaluateSeconds,1e-9))
+	return (queryCount,elapsedSeconds)
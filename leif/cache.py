@@ -0,0 +1,312 @@
+"""
+Classes implementing bounded caches used by the query path
+"""
+import collections
+import data
+import lazy
+import threading
+
+class LRUCache(object):
+	"""A least recently used cache bounded by an estimate of the bytes it holds
+	sizeFunction takes a cached value and returns its estimated size in bytes"""
+	__slots__ = ["byteLimit","byteCount","sizeFunction","entryHash","lock","hits","misses","evictions"]
+	def __init__(self,_byteLimit,_sizeFunction):
+		self.byteLimit = _byteLimit
+		self.byteCount = 0
+		self.sizeFunction = _sizeFunction
+		self.entryHash = collections.OrderedDict() # key -> (size,value), oldest first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def lookup(self,key):
+		"""returns the value for key or None, marking key as most recently used"""
+		self.lock.acquire()
+		try:
+			if key not in self.entryHash:
+				self.misses += 1
+				return None
+			entry = self.entryHash.pop(key)
+			self.entryHash[key] = entry
+			self.hits += 1
+			return entry[1]
+		finally:
+			self.lock.release()
+
+	def store(self,key,value):
+		"""values larger than byteLimit are never stored"""
+		size = self.sizeFunction(value)
+		if size > self.byteLimit: return
+		self.lock.acquire()
+		try:
+			self._discard(key)
+			while self.entryHash and self.byteCount + size > self.byteLimit:
+				oldestKey = iter(self.entryHash).next()
+				self._discard(oldestKey)
+				self.evictions += 1
+			self.entryHash[key] = (size,value)
+			self.byteCount += size
+		finally:
+			self.lock.release()
+
+	def invalidate(self,key):
+		self.lock.acquire()
+		try:
+			self._discard(key)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entryHash.clear()
+			self.byteCount = 0
+		finally:
+			self.lock.release()
+
+	def _discard(self,key):
+		"""caller must hold self.lock"""
+		if key in self.entryHash:
+			size,value = self.entryHash.pop(key)
+			self.byteCount -= size
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			"entries": len(self.entryHash),
+			"bytes": self.byteCount,
+			"byteLimit": self.byteLimit,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"hitRatio": lookups and float(self.hits) / lookups or 0.0,
+		}
+
+	def __len__(self): return len(self.entryHash)
+	def __contains__(self,key): return key in self.entryHash
+
+class SegmentedLRUCache(object):
+	"""A byte bounded cache split into a probationary and a protected segment
+	New entries start out probationary and are promoted when hit again, so a burst
+	of one-off lookups can only push other one-off entries out of the cache"""
+	__slots__ = ["byteLimit","protectedByteLimit","sizeFunction","probation","protected","probationByteCount","protectedByteCount","lock","hits","misses","evictions","promotions"]
+	def __init__(self,_byteLimit,_sizeFunction,_protectedRatio=0.8):
+		self.byteLimit = _byteLimit
+		self.protectedByteLimit = int(_byteLimit * _protectedRatio)
+		self.sizeFunction = _sizeFunction
+		self.probation = collections.OrderedDict() # key -> (size,value), oldest first
+		self.protected = collections.OrderedDict()
+		self.probationByteCount = 0
+		self.protectedByteCount = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.promotions = 0
+
+	@property
+	def byteCount(self): return self.probationByteCount + self.protectedByteCount
+
+	def lookup(self,key):
+		self.lock.acquire()
+		try:
+			if key in self.protected:
+				entry = self.protected.pop(key)
+				self.protected[key] = entry
+			elif key in self.probation:
+				entry = self.probation.pop(key)
+				self.probationByteCount -= entry[0]
+				self.protected[key] = entry
+				self.protectedByteCount += entry[0]
+				self.promotions += 1
+				# demote the oldest protected entries back to the head of probation
+				while self.protectedByteCount > self.protectedByteLimit and len(self.protected) > 1:
+					demotedKey,demotedEntry = self.protected.popitem(False)
+					self.protectedByteCount -= demotedEntry[0]
+					self.probation[demotedKey] = demotedEntry
+					self.probationByteCount += demotedEntry[0]
+			else:
+				self.misses += 1
+				return None
+			self.hits += 1
+			return entry[1]
+		finally:
+			self.lock.release()
+
+	def store(self,key,value):
+		"""values larger than byteLimit are never stored"""
+		size = self.sizeFunction(value)
+		if size > self.byteLimit: return
+		self.lock.acquire()
+		try:
+			self._discard(key)
+			while self.byteCount + size > self.byteLimit:
+				if self.probation:
+					evictedKey,evictedEntry = self.probation.popitem(False)
+					self.probationByteCount -= evictedEntry[0]
+				else:
+					evictedKey,evictedEntry = self.protected.popitem(False)
+					self.protectedByteCount -= evictedEntry[0]
+				self.evictions += 1
+			self.probation[key] = (size,value)
+			self.probationByteCount += size
+		finally:
+			self.lock.release()
+
+	def invalidate(self,key):
+		self.lock.acquire()
+		try:
+			self._discard(key)
+		finally:
+			self.lock.release()
+
+	def invalidateMatching(self,predicate):
+		"""drops every entry whose key satisfies predicate"""
+		self.lock.acquire()
+		try:
+			for segment in (self.probation,self.protected):
+				for key in [key for key in segment if predicate(key)]:
+					self._discard(key)
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.probation.clear()
+			self.protected.clear()
+			self.probationByteCount = 0
+			self.protectedByteCount = 0
+		finally:
+			self.lock.release()
+
+	def _discard(self,key):
+		"""caller must hold self.lock"""
+		if key in self.probation:
+			size,value = self.probation.pop(key)
+			self.probationByteCount -= size
+		elif key in self.protected:
+			size,value = self.protected.pop(key)
+			self.protectedByteCount -= size
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			"entries": len(self.probation) + len(self.protected),
+			"protectedEntries": len(self.protected),
+			"bytes": self.byteCount,
+			"byteLimit": self.byteLimit,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"promotions": self.promotions,
+			"hitRatio": lookups and float(self.hits) / lookups or 0.0,
+		}
+
+	def __len__(self): return len(self.probation) + len(self.protected)
+	def __contains__(self,key): return key in self.probation or key in self.protected
+
+class PostingsCache(object):
+	"""Holds DecodedDocIdTermInstanceTables keyed by (partitionKey,termId), where partitionKey is the
+	cacheKey of a partition, its (partitionName,serial). A partition replaced by a merge keeps its own key,
+	so what is still read out of it never shows up as the postings of its successor.
+	Partitions must call invalidateTermId/invalidatePartition whenever their data changes"""
+	__slots__ = ["segmentedCache","invalidationCount"]
+	def __init__(self,_byteLimit):
+		self.segmentedCache = SegmentedLRUCache(_byteLimit,data.estimateSizeOfDecodedDocIdTermInstanceTable)
+		self.invalidationCount = 0
+
+	def lookupTermId(self,partitionKey,termId,readerFunction):
+		"""returns a reader for termId, readerFunction is only called to fill the cache on a miss"""
+		key = (partitionKey,termId)
+		decodedTable = self.segmentedCache.lookup(key)
+		readStatistics = data.activeReadStatistics()
+		if readStatistics is not None:
+			partitionName = partitionKey[0]
+			if decodedTable is None: readStatistics.partition(partitionName).cacheMisses += 1
+			else: readStatistics.partition(partitionName).cacheHits += 1
+		if decodedTable is None:
+			# a concurrent invalidation means the decoded data may already be stale, so do not keep it
+			invalidationCount = self.invalidationCount
+			decodedTable = data.decodeDocIdTermInstanceTable(readerFunction())
+			if invalidationCount == self.invalidationCount:
+				self.segmentedCache.store(key,decodedTable)
+		return data.readDecodedDocIdTermInstanceTable(decodedTable)
+
+	def invalidateTermId(self,partitionKey,termId):
+		self.invalidationCount += 1
+		self.segmentedCache.invalidate((partitionKey,termId))
+
+	def invalidatePartition(self,partitionKey):
+		self.invalidationCount += 1
+		self.segmentedCache.invalidateMatching(lambda key: key[0] == partitionKey)
+
+	def clear(self):
+		self.invalidationCount += 1
+		self.segmentedCache.clear()
+
+	def stats(self):
+		stats = self.segmentedCache.stats()
+		stats["invalidations"] = self.invalidationCount
+		return stats
+
+class QueryResultCache(object):
+	"""Holds [ComputedMatch] results keyed by a canonical expression tree
+	Each result remembers the index generation it was computed against, a lookup
+	made at any other generation discards the entry, since new postings may change it.
+	Matches are kept as the query produced them, those of a Boolean query keep their docId and
+	decode their positions only when a later consumer reads them"""
+	__slots__ = ["lruCache","hits","misses","invalidations"]
+	def __init__(self,_byteLimit):
+		def _size(entry):
+			generation,computedMatchList = entry
+			return estimateSizeOfComputedMatchList(computedMatchList)
+		self.lruCache = LRUCache(_byteLimit,_size)
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	def lookup(self,canonicalExpression,generation):
+		entry = self.lruCache.lookup(canonicalExpression)
+		if entry is not None and entry[0] != generation:
+			self.lruCache.invalidate(canonicalExpression)
+			self.invalidations += 1
+			entry = None
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return entry[1]
+
+	def store(self,canonicalExpression,generation,computedMatchList):
+		self.lruCache.store(canonicalExpression,(generation,computedMatchList))
+
+	def clear(self): self.lruCache.clear()
+
+	@property
+	def byteLimit(self): return self.lruCache.byteLimit
+
+	def stats(self):
+		stats = self.lruCache.stats()
+		lookups = self.hits + self.misses
+		stats["hits"] = self.hits
+		stats["misses"] = self.misses
+		stats["hitRatio"] = lookups and float(self.hits) / lookups or 0.0
+		stats["invalidations"] = self.invalidations
+		return stats
+
+# Rough CPython object sizes, used only to keep caches within their budget
+ComputedMatchSizeInBytes = 128
+TermInstanceSizeInBytes = 64
+TermInstanceVectorsFunctionSizeInBytes = 64
+
+def estimateSizeOfComputedMatchList(computedMatchList):
+	"""does not realize the termInstanceVectors, a match that was never realized counts for its docId and
+	the function which would decode its positions, so it is kept that way until a consumer reads them"""
+	bytes = 0
+	for computedMatch in computedMatchList:
+		bytes += ComputedMatchSizeInBytes
+		if computedMatch.isRealized: bytes += TermInstanceSizeInBytes * sum(1 for termInstance in lazy.flatten(computedMatch.realizedTermInstanceVectors))
+		else: bytes += TermInstanceVectorsFunctionSizeInBytes
+	return bytes
@@ -1,11 +1,16 @@
 """
 Classes and functions for dealing with data associated to the Indexer
 """
+import array
+import binascii
+import heapq
 import itertools
 import lazy
 import operator
 import struct
 import sys
+import threading
+import time
 
 class TermInstance(object):
 	"""The Index must deal with TermInstances when satisfying Queries
@@ -41,6 +46,11 @@ class DocIdTermInstanceTable(object):
 	def termInstanceCount(self):
 		return sum(map(len,self.docIdHash.values()))
 	
+	@property
+	def maxTermInstanceCount(self):
+		if not self.docIdHash: return 0
+		return max(map(len,self.docIdHash.values()))
+	
 	def insertTermInstanceRecord(self,docId,termInstance):
 		if docId not in self.docIdHash: self.docIdHash[docId] = set()
 		self.docIdHash[docId].add(termInstance)
@@ -53,12 +63,15 @@ class DocIdTermInstanceTable(object):
 	def __repr__(self): return "<DocIdTermInstanceTable %d docId(s) %d termInstance(s)>" % (len(self),self.termInstanceCount)
 
 class CompressedDocIdTermInstanceTableHeader(object):
-	__slots__ = ["offset","length","docIdCount","termInstanceCount"]
+	__slots__ = ["layout","offset","length","docIdCount","termInstanceCount","maxTermInstanceCount","docIdsLength"]
 	def __init__(self):
+		self.layout = DocIdTermInstanceTableLayoutSplit
 		self.offset = 0
 		self.length = 0
 		self.docIdCount = 0
 		self.termInstanceCount = 0
+		self.maxTermInstanceCount = 0 # largest number of TermInstances held by any one docId
+		self.docIdsLength = 0 # bytes of the docIds ahead of the TermInstance counts, split and bitmap layouts
 
 class DocIdTermInstanceVector(object):
 	"""Replaces the tuple returned by readers so that flatten will not expand the docId,[TermInstances] pairing"""
@@ -78,9 +91,33 @@ class DocIdTermInstanceVector(object):
 # Disk Layout Constants
 SkipOffsetSizeInBytes = 4 # on disk we store the seek offset to the end of a table
 DocIdSizeInBytes = 4
+TermInstanceCountSizeInBytes = 4
 PositionSizeInBytes = 4
 ExtentSizeInBytes = 4
 TermInstanceSizeInBytes = PositionSizeInBytes + ExtentSizeInBytes
+DecodedDocIdTermInstanceTableSizeInBytes = 256 # rough in-memory overhead of the object and its three arrays
+
+# Table layouts, recorded in the CompressedDocIdTermInstanceTableHeader
+# interleaved: for each docId: skipOffset,docId,position,extent,position,extent...
+# split: all docIds, then the TermInstance count of each docId, then all position,extent pairs
+#  so that docIds can be read without touching any position bytes
+# bitmap: as split, but the docIds are Roaring style containers, one for each 65536 docIds sharing
+#  their high bits: the container count, the key,kind,cardinality of every container, then the payload
+#  of every container, the sorted low 16 bits of its docIds (array) or 65536 bits (bitmap), where bit
+#  low & 7 of byte low >> 3 is set for every docId. Used for dense tables, see isDenseDocIdList
+DocIdTermInstanceTableLayoutInterleaved = 0
+DocIdTermInstanceTableLayoutSplit = 1
+DocIdTermInstanceTableLayoutBitmap = 2
+
+BitmapContainerCount = struct.Struct("!I")
+BitmapContainerHeader = struct.Struct("!HHI") # key,kind,cardinality
+BitmapContainerArray = 0
+BitmapContainerBitmap = 1
+BitmapContainerBytes = 8192
+ArrayContainerMaxCardinality = 4096 # past this many docIds a bitmap container is the smaller one
+BitmapLayoutMinDocIds = 256 # smaller tables always use the split layout
+BitmapLayoutMaxSpanPerDocId = 16 # a table is dense when it holds at least 1 in 16 of the docIds it spans
+_bitsOfByte = [[bit for bit in xrange(8) if byte & (1 << bit)] for byte in xrange(256)]
 
 def estimateSizeOfDocIdTermInstanceTable(_table):
 	"""Calculates the maximal size of the _table
@@ -88,38 +125,189 @@ def estimateSizeOfDocIdTermInstanceTable(_table):
 	the compressor can be more efficient"""
 	bytes = 0
 	for docId in _table.docIdHash:
-		bytes += SkipOffsetSizeInBytes + DocIdSizeInBytes
+		bytes += DocIdSizeInBytes + TermInstanceCountSizeInBytes
 		bytes += len(_table.docIdHash[docId]) * TermInstanceSizeInBytes
 	
 	return bytes
 
+def isDenseDocIdList(docIds):
+	"""True when the ascending docIds are enough, and close enough together, for the bitmap layout"""
+	return len(docIds) >= BitmapLayoutMinDocIds and docIds[-1] - docIds[0] < BitmapLayoutMaxSpanPerDocId * len(docIds)
+
+def compressDocIdBitmap(docIds):
+	"""the Roaring style containers of the ascending docIds, see DocIdTermInstanceTableLayoutBitmap"""
+	containerHeaders = list()
+	payloads = list()
+	for key,keyDocIds in itertools.groupby(docIds,lambda docId: docId >> 16):
+		lows = [docId & 0xffff for docId in keyDocIds]
+		if len(lows) > ArrayContainerMaxCardinality:
+			bits = bytearray(BitmapContainerBytes)
+			for low in lows: bits[low >> 3] |= 1 << (low & 7)
+			containerHeaders.append(BitmapContainerHeader.pack(key,BitmapContainerBitmap,len(lows)))
+			payloads.append(str(bits))
+		else:
+			containerHeaders.append(BitmapContainerHeader.pack(key,BitmapContainerArray,len(lows)))
+			payloads.append(struct.pack("!%dH" % len(lows),*lows))
+	return "".join([BitmapContainerCount.pack(len(containerHeaders))] + containerHeaders + payloads)
+
+def _bitmapContainers(_buffer,_offset):
+	"""returns [(key,kind,cardinality,payloadOffset)] of the containers written by compressDocIdBitmap at _offset"""
+	containerCount, = BitmapContainerCount.unpack_from(_buffer,_offset)
+	headerOffset = _offset + BitmapContainerCount.size
+	payloadOffset = headerOffset + containerCount * BitmapContainerHeader.size
+	containers = list()
+	for containerIndex in xrange(containerCount):
+		key,kind,cardinality = BitmapContainerHeader.unpack_from(_buffer,headerOffset + containerIndex * BitmapContainerHeader.size)
+		containers.append((key,kind,cardinality,payloadOffset))
+		if kind == BitmapContainerBitmap: payloadOffset += BitmapContainerBytes
+		else: payloadOffset += 2 * cardinality
+	return containers
+
+def _decompressBitmapDocIds(_buffer,_offset):
+	docIds = list()
+	for key,kind,cardinality,payloadOffset in _bitmapContainers(_buffer,_offset):
+		base = key << 16
+		if kind == BitmapContainerBitmap:
+			for byteIndex,byte in enumerate(bytearray(_buffer[payloadOffset:payloadOffset + BitmapContainerBytes])):
+				if byte:
+					byteBase = base + (byteIndex << 3)
+					for bit in _bitsOfByte[byte]: docIds.append(byteBase + bit)
+		else:
+			docIds.extend([base + low for low in struct.unpack("!%dH" % cardinality,_buffer[payloadOffset:payloadOffset + 2 * cardinality])])
+	return docIds
+
+def _bitmapOfBytes(bits):
+	"""the long whose bit i is bit i & 7 of byte i >> 3 of bits"""
+	return long(binascii.hexlify(bits[::-1]) or "0",16)
+
+def decompressDocIdBitmap(_buffer,_header):
+	"""returns the docIds of a bitmap layout table as a bitmap (see bitmapOfDocIds), None for other layouts
+	Bitmap containers are copied straight into the bitmap, only array containers are decoded"""
+	if getattr(_header,"layout",DocIdTermInstanceTableLayoutInterleaved) != DocIdTermInstanceTableLayoutBitmap: return None
+	bitmap = 0L
+	for key,kind,cardinality,payloadOffset in _bitmapContainers(_buffer,_header.offset):
+		if kind == BitmapContainerBitmap:
+			bits = _buffer[payloadOffset:payloadOffset + BitmapContainerBytes]
+		else:
+			bits = bytearray(BitmapContainerBytes)
+			for low in struct.unpack("!%dH" % cardinality,_buffer[payloadOffset:payloadOffset + 2 * cardinality]): bits[low >> 3] |= 1 << (low & 7)
+			bits = str(bits)
+		bitmap |= _bitmapOfBytes(bits) << (key << 16)
+	return bitmap
+
+def bitmapOfDocIds(docIds):
+	"""returns a long with bit docId set for every one of docIds
+	Boolean operators on such bitmaps run a machine word at a time, see docIdBitmapOp"""
+	docIds = list(docIds)
+	if not docIds: return 0L
+	bits = bytearray((max(docIds) >> 3) + 1)
+	for docId in docIds: bits[docId >> 3] |= 1 << (docId & 7)
+	return _bitmapOfBytes(str(bits))
+
+def docIdsOfBitmap(bitmap):
+	"""Generates the ascending docIds set in bitmap, see bitmapOfDocIds"""
+	hexDigits = "%x" % bitmap
+	if len(hexDigits) & 1: hexDigits = "0" + hexDigits
+	for byteIndex,byte in enumerate(bytearray(binascii.unhexlify(hexDigits)[::-1])):
+		if byte:
+			byteBase = byteIndex << 3
+			for bit in _bitsOfByte[byte]: yield byteBase + bit
+
+def countOfBitmap(bitmap):
+	return bin(bitmap).count("1")
+
 def compressDocIdTermInstanceTable(_table):
 	"""Creates a compressed packed byte string of the _table
 	returns a tuple the first value is the CompressedDocIdTermInstanceTableHeader for this
-	the second is the compressed data itself
-	*currently there is no compression*"""
+	the second is the compressed data itself, in the split layout, or the bitmap layout
+	when the docIds are dense (see isDenseDocIdList), chosen afresh every time a table is written
+	*currently positions are not compressed*"""
 	_pack = struct.pack
-	_tuple = lambda termInstance: (termInstance.position,termInstance.extent)
-	termInstanceBlocks = []
-	for docId in sorted(_table.docIdHash):
-		termInstances = _table.docIdHash[docId]
-		skipOffsetBytes = DocIdSizeInBytes
-		termInstanceCount = len(termInstances) # note this is not the same as: _table.termInstanceCount
-		skipOffsetBytes += termInstanceCount * TermInstanceSizeInBytes
-		termInstanceVector = list(lazy.flatten(map(_tuple,sorted(termInstances))))
-		termInstanceBlocks.append(_pack("!II%dI" % len(termInstanceVector),skipOffsetBytes,docId,*termInstanceVector))
-	
-	compressedData = "".join(termInstanceBlocks)
+	docIds = sorted(_table.docIdHash)
+	termInstanceCounts = list()
+	termInstanceElements = list()
+	for docId in docIds:
+		termInstances = sorted(_table.docIdHash[docId])
+		termInstanceCounts.append(len(termInstances))
+		for termInstance in termInstances:
+			termInstanceElements.append(termInstance.position)
+			termInstanceElements.append(termInstance.extent)
+	
 	header = CompressedDocIdTermInstanceTableHeader()
+	if isDenseDocIdList(docIds):
+		header.layout = DocIdTermInstanceTableLayoutBitmap
+		docIdData = compressDocIdBitmap(docIds)
+	else:
+		header.layout = DocIdTermInstanceTableLayoutSplit
+		docIdData = _pack("!%dI" % len(docIds),*docIds)
+	compressedData = "".join([
+		docIdData,
+		_pack("!%dI" % len(termInstanceCounts),*termInstanceCounts),
+		_pack("!%dI" % len(termInstanceElements),*termInstanceElements)])
+	header.docIdsLength = len(docIdData)
 	header.docIdCount = len(_table)
 	header.termInstanceCount = _table.termInstanceCount
+	header.maxTermInstanceCount = _table.maxTermInstanceCount
 	header.length = len(compressedData)
 	return (header,compressedData)
 
 def decompressDocIdTermInstanceTable(_buffer,_header):
 	"""Creates a Python generator which will produce (docId,[TermInstance]) tuple
 	the [TermInstance] is a generator which will produce the TermInstance structures
-	associated with docId"""
+	associated with docId, position bytes are only read once it is iterated"""
+	layout = getattr(_header,"layout",DocIdTermInstanceTableLayoutInterleaved)
+	if layout == DocIdTermInstanceTableLayoutSplit:
+		return _decompressSplitDocIdTermInstanceTable(_buffer,_header)
+	elif layout == DocIdTermInstanceTableLayoutBitmap:
+		return _generateSplitDocIdTermInstanceVectors(_buffer,_decompressBitmapDocIds(_buffer,_header.offset),_header.offset + _header.docIdsLength)
+	return _decompressInterleavedDocIdTermInstanceTable(_buffer,_header)
+
+def decompressDocIds(_buffer,_header):
+	"""returns the ascending docIds of a compressed table, without decoding any TermInstance"""
+	_unpack = struct.unpack
+	layout = getattr(_header,"layout",DocIdTermInstanceTableLayoutInterleaved)
+	if layout == DocIdTermInstanceTableLayoutSplit:
+		docIdCount = _header.docIdCount
+		return _unpack("!%dI" % docIdCount,_buffer[_header.offset:_header.offset+docIdCount*DocIdSizeInBytes])
+	elif layout == DocIdTermInstanceTableLayoutBitmap:
+		return _decompressBitmapDocIds(_buffer,_header.offset)
+	docIds = list()
+	currentOffset = _header.offset
+	while currentOffset < _header.offset + _header.length:
+		skipOffset,docId = _unpack("!II",_buffer[currentOffset:currentOffset+SkipOffsetSizeInBytes+DocIdSizeInBytes])
+		docIds.append(docId)
+		currentOffset += SkipOffsetSizeInBytes + skipOffset
+	return docIds
+
+def compressedDocIdsSizeInBytes(_header):
+	"""the bytes decompressDocIds has to read for a table"""
+	layout = getattr(_header,"layout",DocIdTermInstanceTableLayoutInterleaved)
+	if layout == DocIdTermInstanceTableLayoutSplit:
+		return _header.docIdCount*DocIdSizeInBytes
+	elif layout == DocIdTermInstanceTableLayoutBitmap:
+		return _header.docIdsLength
+	return _header.length
+
+def _generateSplitDocIdTermInstanceVectors(_buffer,_docIds,_countOffset):
+	"""the TermInstance counts of _docIds start at _countOffset, followed by all position,extent pairs"""
+	def termInstanceGenerator(_offset,_termInstanceCount):
+		termInstanceElements = struct.unpack("!%dI" % (2*_termInstanceCount),_buffer[_offset:_offset+_termInstanceCount*TermInstanceSizeInBytes])
+		for _position,_extent in lazy.pairup(termInstanceElements):
+			yield TermInstance(_position,_extent)
+
+	elementOffset = _countOffset + len(_docIds)*TermInstanceCountSizeInBytes
+	termInstanceCounts = struct.unpack("!%dI" % len(_docIds),_buffer[_countOffset:elementOffset])
+	for docId,termInstanceCount in itertools.izip(_docIds,termInstanceCounts):
+		yield DocIdTermInstanceVector(docId,termInstanceGenerator(elementOffset,termInstanceCount))
+		elementOffset += termInstanceCount*TermInstanceSizeInBytes
+
+def _decompressSplitDocIdTermInstanceTable(_buffer,_header):
+	docIdCount = _header.docIdCount
+	docIds = struct.unpack("!%dI" % docIdCount,_buffer[_header.offset:_header.offset+docIdCount*DocIdSizeInBytes])
+	return _generateSplitDocIdTermInstanceVectors(_buffer,docIds,_header.offset + docIdCount*DocIdSizeInBytes)
+
+def _decompressInterleavedDocIdTermInstanceTable(_buffer,_header):
+	"""reads tables written before the split layout existed"""
 	def generateDocIdTermInstanceVectors(_offset,_length):
 		currentOffset = _offset
 		_unpack = struct.unpack
@@ -157,15 +345,131 @@ def readUncompressedDocIdTermInstanceTable(_table):
 	
 	return generateDocIdTermInstanceVectors()
 
+class DecodedDocIdTermInstanceTable(object):
+	"""A compact, read-only copy of the output of a reader, suitable for caching
+	docIds :: array of DocId
+	termInstanceOffsets :: array, the TermInstances of docIds[i] are elements
+	  termInstanceOffsets[i] up to termInstanceOffsets[i+1] of termInstanceElements
+	termInstanceElements :: array of interleaved position,extent pairs"""
+	__slots__ = ["docIds","termInstanceOffsets","termInstanceElements"]
+	def __init__(self):
+		self.docIds = array.array("i")
+		self.termInstanceOffsets = array.array("i",[0])
+		self.termInstanceElements = array.array("i")
+	
+	def __len__(self): return len(self.docIds)
+	def __repr__(self): return "<DecodedDocIdTermInstanceTable %d docId(s) %d termInstance(s)>" % (len(self),len(self.termInstanceElements) / 2)
+
+def decodeDocIdTermInstanceTable(_reader):
+	"""Drains a reader (see decompressDocIdTermInstanceTable) into a DecodedDocIdTermInstanceTable"""
+	decodedTable = DecodedDocIdTermInstanceTable()
+	_appendDocId = decodedTable.docIds.append
+	_appendOffset = decodedTable.termInstanceOffsets.append
+	_appendElement = decodedTable.termInstanceElements.append
+	for docIdTermInstanceVector in _reader:
+		if docIdTermInstanceVector.docId is None: continue
+		_appendDocId(docIdTermInstanceVector.docId)
+		for termInstance in docIdTermInstanceVector.termInstancesGenerator:
+			_appendElement(termInstance.position)
+			_appendElement(termInstance.extent)
+		_appendOffset(len(decodedTable.termInstanceElements))
+	
+	return decodedTable
+
+def readDecodedDocIdTermInstanceTable(_decodedTable):
+	"""Creates a Python generator which will produce (docId,[TermInstance]) tuple
+	see decompressDocIdTermInstanceTable"""
+	def generateDocIdTermInstanceVectors():
+		docIds = _decodedTable.docIds
+		termInstanceOffsets = _decodedTable.termInstanceOffsets
+		termInstanceElements = _decodedTable.termInstanceElements
+		def termInstanceGenerator(_start,_end):
+			for elementIndex in xrange(_start,_end,2):
+				yield TermInstance(termInstanceElements[elementIndex],termInstanceElements[elementIndex+1])
+
+		for docIndex,docId in enumerate(docIds):
+			yield DocIdTermInstanceVector(docId,termInstanceGenerator(termInstanceOffsets[docIndex],termInstanceOffsets[docIndex+1]))
+	
+	return generateDocIdTermInstanceVectors()
+
+def estimateSizeOfDecodedDocIdTermInstanceTable(_decodedTable):
+	_size = lambda _array: _array.itemsize * len(_array)
+	return DecodedDocIdTermInstanceTableSizeInBytes + _size(_decodedTable.docIds) + _size(_decodedTable.termInstanceOffsets) + _size(_decodedTable.termInstanceElements)
+
+def readUncompressedDocIds(_table):
+	return sorted(_table.docIdHash)
+
 def nullUncompressedDocIdTermInstanceTable():
 	# returns a generator object to match semantics of a reader
-	return (_ for _ in [(None,iter([]))])
+	return (_ for _ in [DocIdTermInstanceVector(None,iter([]))])
 
 def joinUncompressedDocIdTermInstanceTableReaders(readerList):
+	"""Merges readers, each in ascending docId order, into a single ascending reader
+	the merge is lazy, no reader is advanced further than the docIds consumed"""
 	_peekable = lazy.peekable
 	_ifilter = itertools.ifilter
-	_flatten = lazy.flatten
-	return _peekable(sorted(_ifilter(None,_flatten(map(None,*readerList)))))
+	_hasDocId = lambda docIdTermInstanceVector: docIdTermInstanceVector.docId is not None
+	return _peekable(heapq.merge(*[_ifilter(_hasDocId,reader) for reader in readerList]))
+
+def joinDocIdReaders(docIdReaderList):
+	"""Merges iterables of ascending docIds into a single ascending iterator"""
+	return heapq.merge(*docIdReaderList)
+
+class DocumentLengthTable(object):
+	"""Records the length, in positions, of every posted document
+	Lengths are held in an array indexed directly by docId, 0 marks an unknown docId"""
+	__slots__ = ["lengths","documentCount","totalLength"]
+	def __init__(self):
+		self.lengths = array.array("i")
+		self.documentCount = 0
+		self.totalLength = 0
+	
+	def setDocumentLength(self,docId,length):
+		if docId >= len(self.lengths):
+			self.lengths.extend(itertools.repeat(0,docId + 1 - len(self.lengths)))
+		previousLength = self.lengths[docId]
+		if previousLength == 0: self.documentCount += 1
+		self.totalLength += length - previousLength
+		self.lengths[docId] = length
+	
+	def getDocumentLength(self,docId):
+		if docId < len(self.lengths): return self.lengths[docId]
+		return 0
+	
+	@property
+	def averageDocumentLength(self):
+		if self.documentCount == 0: return 0.0
+		return float(self.totalLength) / self.documentCount
+	
+	def docIds(self):
+		"""returns the ascending docIds of every posted document"""
+		return [docId for docId,length in enumerate(self.lengths) if length > 0]
+	
+	def __len__(self): return self.documentCount
+	def __contains__(self,docId): return self.getDocumentLength(docId) > 0
+	def __repr__(self): return "<DocumentLengthTable %d document(s) %d position(s)>" % (self.documentCount,self.totalLength)
+
+class DocIdMap(object):
+	"""Maps the docIds documents are posted with (external, e.g. the Reuters itemid) to the docIds
+	the index holds them under (internal), once an optimize has reassigned them
+	Documents posted afterwards get the next internal docIds, in the order they arrive"""
+	__slots__ = ["externalDocIds","internalDocIds"]
+	def __init__(self,_externalDocIds):
+		self.externalDocIds = array.array("l",_externalDocIds) # indexed by internal docId
+		self.internalDocIds = dict([(externalDocId,internalDocId) for internalDocId,externalDocId in enumerate(self.externalDocIds)])
+	
+	def internalDocId(self,externalDocId):
+		"""assigns the next internal docId to an externalDocId never seen before"""
+		if externalDocId not in self.internalDocIds:
+			self.internalDocIds[externalDocId] = len(self.externalDocIds)
+			self.externalDocIds.append(externalDocId)
+		return self.internalDocIds[externalDocId]
+	
+	def externalDocId(self,internalDocId):
+		return self.externalDocIds[internalDocId]
+	
+	def __len__(self): return len(self.externalDocIds)
+	def __repr__(self): return "<DocIdMap %d docId(s)>" % len(self.externalDocIds)
 
 class AnalyzedTerm(object):
 	"""each term is really a set of term occurrences"""
@@ -188,17 +492,129 @@ class AnalyzedDocument(object):
 	def appendAnalyzedTerm(self,analyzedTerm):
 		self.analyzedTermList.append(analyzedTerm)
 	
+	@property
+	def termCount(self):
+		"""the number of positions in the document"""
+		return len(self.analyzedTermList)
+	
+	def iterTermInstances(self):
+		"""yields (position,termId,extent) for every term occurrence, this is what ReverseIndex.post() consumes"""
+		for position,analyzedTerm in enumerate(self.analyzedTermList):
+			for termId,extent in analyzedTerm.instanceSet:
+				yield (position,termId,extent)
+	
 	def __repr__(self): return "#AD(%d):%s" % (self.docId,repr(self.analyzedTermList))
 
+PackedAnalyzedDocumentHeader = struct.Struct("<qII") # docId,termCount,instanceCount
+
+class PackedAnalyzedDocument(object):
+	"""An AnalyzedDocument read in place from a buffer (usually an mmap) holding
+	the header, then instanceCount uint16 per position, then the termId and the extent
+	uint32 columns, one entry per term occurrence. Nothing is decoded until iterTermInstances()"""
+	__slots__ = ["docId","termCount","instanceCount","buffer","offset"]
+	def __init__(self,_buffer,_offset):
+		self.buffer = _buffer
+		self.docId,self.termCount,self.instanceCount = PackedAnalyzedDocumentHeader.unpack_from(_buffer,_offset)
+		self.offset = _offset + PackedAnalyzedDocumentHeader.size
+	
+	@staticmethod
+	def pack(analyzedDocument):
+		"""returns the packed bytes of an AnalyzedDocument, occurrences are sorted within each position"""
+		instanceCounts = array.array("H")
+		termIds = array.array("I")
+		extents = array.array("I")
+		for analyzedTerm in analyzedDocument.analyzedTermList:
+			instanceCounts.append(len(analyzedTerm.instanceSet))
+			for termId,extent in sorted(analyzedTerm.instanceSet):
+				termIds.append(termId)
+				extents.append(extent)
+		if sys.byteorder != "little":
+			for column in (instanceCounts,termIds,extents): column.byteswap()
+		return "".join([PackedAnalyzedDocumentHeader.pack(analyzedDocument.docId,len(instanceCounts),len(termIds)),instanceCounts.tostring(),termIds.tostring(),extents.tostring()])
+	
+	@property
+	def size(self):
+		"""bytes taken by the document, including its header"""
+		return PackedAnalyzedDocumentHeader.size + 2 * self.termCount + 8 * self.instanceCount
+	
+	def _columns(self):
+		offset = self.offset
+		instanceCounts = struct.unpack_from("<%dH" % self.termCount,self.buffer,offset)
+		offset += 2 * self.termCount
+		termIds = struct.unpack_from("<%dI" % self.instanceCount,self.buffer,offset)
+		offset += 4 * self.instanceCount
+		extents = struct.unpack_from("<%dI" % self.instanceCount,self.buffer,offset)
+		return (instanceCounts,termIds,extents)
+	
+	def iterTermInstances(self):
+		instanceCounts,termIds,extents = self._columns()
+		positions = itertools.chain.from_iterable([itertools.repeat(position,instanceCount) for position,instanceCount in enumerate(instanceCounts)])
+		return itertools.izip(positions,termIds,extents)
+	
+	def toAnalyzedDocument(self):
+		analyzedDocument = AnalyzedDocument(self.docId)
+		analyzedTerm = None
+		for position,termId,extent in self.iterTermInstances():
+			while len(analyzedDocument.analyzedTermList) <= position:
+				analyzedTerm = AnalyzedTerm()
+				analyzedDocument.appendAnalyzedTerm(analyzedTerm)
+			analyzedTerm.addTermIdWithOptionalExtent(termId,extent)
+		while len(analyzedDocument.analyzedTermList) < self.termCount:
+			analyzedDocument.appendAnalyzedTerm(AnalyzedTerm())
+		return analyzedDocument
+	
+	@property
+	def analyzedTermList(self):
+		return self.toAnalyzedDocument().analyzedTermList
+	
+	def __repr__(self): return "#PAD(%d):%d terms,%d instances" % (self.docId,self.termCount,self.instanceCount)
+
+def packAnalyzedDocument(analyzedDocument):
+	"""the packed bytes of either kind of document, a PackedAnalyzedDocument is copied as it is"""
+	if isinstance(analyzedDocument,PackedAnalyzedDocument):
+		start = analyzedDocument.offset - PackedAnalyzedDocumentHeader.size
+		return analyzedDocument.buffer[start:start + analyzedDocument.size]
+	return PackedAnalyzedDocument.pack(analyzedDocument)
+
 class ComputedMatch(object):
-	"""Queries produce ComputedMatch(es)"""
-	__slots__ = ["docId","termInstanceVectors"]
-	def __init__(self,_docId,_termInstanceVectors):
+	"""Queries produce ComputedMatch(es)
+	A ComputedMatch can be built from a docId and a termInstanceVectorsFunction instead of
+	termInstanceVectors, the function is then called the first time termInstanceVectors is read.
+	Boolean operators only look at docIds, so positions are decoded only for the matches that a
+	positional operator (or whoever consumes the query result) inspects.
+	Nothing produces an empty match lazily, so an unrealized match is taken to be non-empty"""
+	__slots__ = ["docId","realizedTermInstanceVectors","termInstanceVectorsFunction"]
+	def __init__(self,_docId,_termInstanceVectors=None,_termInstanceVectorsFunction=None):
 		self.docId = _docId
-		self.termInstanceVectors = _termInstanceVectors
+		self.realizedTermInstanceVectors = _termInstanceVectors
+		self.termInstanceVectorsFunction = _termInstanceVectorsFunction
+		if _termInstanceVectors is None and _termInstanceVectorsFunction is None:
+			self.realizedTermInstanceVectors = list()
+	
+	def _getTermInstanceVectors(self):
+		if self.realizedTermInstanceVectors is None:
+			self.realizedTermInstanceVectors = self.termInstanceVectorsFunction()
+			self.termInstanceVectorsFunction = None
+		return self.realizedTermInstanceVectors
+	
+	def _setTermInstanceVectors(self,termInstanceVectors):
+		self.realizedTermInstanceVectors = termInstanceVectors
+		self.termInstanceVectorsFunction = None
+	
+	termInstanceVectors = property(_getTermInstanceVectors,_setTermInstanceVectors)
+	
+	@property
+	def isRealized(self): return self.realizedTermInstanceVectors is not None
+	
+	def isEmpty(self):
+		"""does not realize the termInstanceVectors"""
+		if not self.isRealized: return False
+		return len(self.realizedTermInstanceVectors) == 0
 	
 	def computedMatchCartesianProductWithPredicate(self,predicate):
 		"""Return a new ComputedMatch which is the cartesian product of self.termInstanceVectors"""
+		budget = activeQueryBudget()
+		if budget is not None: predicate = budget.chargedPredicate(predicate)
 		return ComputedMatch(self.docId,list(lazy.predicated_cartesian_product(predicate,*self.termInstanceVectors)))
 	
 	def computedMatchSubsets(self,minSubsetSize=1,maxSubsetSize=5):
@@ -210,9 +626,12 @@ class ComputedMatch(object):
 		minSubsetSize = minSubsetSize or 1
 		maxSubsetSize = maxSubsetSize or sys.maxint
 		if maxSubsetSize < minSubsetSize: maxSubsetSize = minSubsetSize + 1
+		budget = activeQueryBudget()
 		for subsetSize in xrange(minSubsetSize,maxSubsetSize + 1):
 			try:
-				powerset += list(lazy.nary_subset(self.termInstanceVectors,subsetSize))
+				subsets = lazy.nary_subset(self.termInstanceVectors,subsetSize)
+				if budget is not None: subsets = budget.chargedIterator(subsets,budget.chargeIntermediateMatches)
+				powerset += list(subsets)
 			except StopIteration:
 				break
 
@@ -223,9 +642,9 @@ class ComputedMatch(object):
 		if self.docId != other.docId: raise ValueError("Cannot add ComputedMatch objects of differing docId")
 	
 	def __add__(self,computedMatch):
-		"""Return a new ComputedMatch"""
+		"""Return a new, unrealized, ComputedMatch"""
 		self._addOpAssert(computedMatch)
-		return ComputedMatch(self.docId,[self.termInstanceVectors,computedMatch.termInstanceVectors])
+		return ComputedMatch(self.docId,_termInstanceVectorsFunction=lambda: [self.termInstanceVectors,computedMatch.termInstanceVectors])
 	# make it work in both directions
 	__radd__ = __add__
 
@@ -248,15 +667,192 @@ class ComputedMatch(object):
 	def __iter__(self): return iter(self.termInstanceVectors)
 	def __repr__(self): return "#CM(%d):%s" % (self.docId,repr(self.termInstanceVectors))
 
+class QueryBudgetExceeded(Exception):
+	"""raised inside query operators once the active QueryBudget runs out"""
+
+ClockCheckInterval = 256 # charges between looks at the clock
+
+class QueryBudget(object):
+	"""Limits the work of one query: wall time (seconds), postings decoded and intermediate matches
+	A limit of None is unlimited. Operators, and the lookups of an environment, charge the budget
+	that is active in their thread (see budgetedIterator) and raise QueryBudgetExceeded once any
+	limit is passed. exceededReason then tells which one"""
+	__slots__ = ["wallTimeLimit","postingsLimit","intermediateMatchLimit","deadline","postingsDecoded","intermediateMatches","exceededReason","chargesUntilClockCheck"]
+	def __init__(self,_wallTimeLimit=None,_postingsLimit=None,_intermediateMatchLimit=None):
+		self.wallTimeLimit = _wallTimeLimit
+		self.postingsLimit = _postingsLimit
+		self.intermediateMatchLimit = _intermediateMatchLimit
+		self.start()
+	
+	def start(self):
+		"""(re)starts the clock and clears the counters"""
+		self.deadline = None
+		if self.wallTimeLimit is not None: self.deadline = time.time() + self.wallTimeLimit
+		self.postingsDecoded = 0
+		self.intermediateMatches = 0
+		self.exceededReason = None
+		self.chargesUntilClockCheck = ClockCheckInterval
+	
+	@property
+	def exceeded(self): return self.exceededReason is not None
+	
+	def chargePostings(self,count=1):
+		self.postingsDecoded += count
+		if self.postingsLimit is not None and self.postingsDecoded > self.postingsLimit:
+			self._exceed("more than %d postings decoded" % self.postingsLimit)
+		self._tick()
+	
+	def chargeIntermediateMatches(self,count=1):
+		self.intermediateMatches += count
+		if self.intermediateMatchLimit is not None and self.intermediateMatches > self.intermediateMatchLimit:
+			self._exceed("more than %d intermediate matches" % self.intermediateMatchLimit)
+		self._tick()
+	
+	def checkWallTime(self):
+		if self.deadline is not None and time.time() > self.deadline:
+			self._exceed("more than %.3f seconds" % self.wallTimeLimit)
+	
+	def _tick(self):
+		self.chargesUntilClockCheck -= 1
+		if self.chargesUntilClockCheck <= 0:
+			self.chargesUntilClockCheck = ClockCheckInterval
+			self.checkWallTime()
+	
+	def _exceed(self,reason):
+		if self.exceededReason is None: self.exceededReason = reason
+		raise QueryBudgetExceeded(self.exceededReason)
+	
+	def chargedIterator(self,iterator,chargeFunction):
+		"""calls chargeFunction for every item of iterator"""
+		for item in iterator:
+			chargeFunction()
+			yield item
+	
+	def chargedPredicate(self,predicate):
+		"""charges an intermediate match for every test of predicate (which can be None)"""
+		def _chargedPredicate(items):
+			self.chargeIntermediateMatches()
+			return predicate is None or predicate(items)
+		return _chargedPredicate
+	
+	def __repr__(self):
+		return "<QueryBudget %d posting(s) %d intermediate match(es)%s>" % (self.postingsDecoded,self.intermediateMatches,self.exceededReason and ", exceeded: " + self.exceededReason or "")
+
+_queryBudgetState = threading.local()
+
+def activeQueryBudget():
+	"""the QueryBudget being enforced in this thread, or None"""
+	return getattr(_queryBudgetState,"budget",None)
+
+def budgetedIterator(iterableFunction,budget):
+	"""Iterates over iterableFunction() with budget active, every item is produced under the budget
+	Running out of budget ends the iteration early, budget.exceededReason tells why"""
+	def _withBudget(function):
+		previousBudget = activeQueryBudget()
+		_queryBudgetState.budget = budget
+		try:
+			return function()
+		finally:
+			_queryBudgetState.budget = previousBudget
+	
+	try:
+		iterator = _withBudget(lambda: iter(iterableFunction()))
+		while 1:
+			yield _withBudget(iterator.next)
+	except QueryBudgetExceeded:
+		return
+
+class PartitionReadStatistics(object):
+	"""What was read out of one partition: tables looked up, postings (docIds) and
+	TermInstances produced, bytes decoded and postings cache hits and misses"""
+	__slots__ = ["lookups","postings","termInstances","bytesDecoded","cacheHits","cacheMisses"]
+	def __init__(self):
+		self.lookups = 0
+		self.postings = 0
+		self.termInstances = 0
+		self.bytesDecoded = 0
+		self.cacheHits = 0
+		self.cacheMisses = 0
+	
+	def __repr__(self):
+		return "lookups=%d postings=%d termInstances=%d bytes=%d cache=%d/%d" % (self.lookups,self.postings,self.termInstances,self.bytesDecoded,self.cacheHits,self.cacheHits + self.cacheMisses)
+
+class ReadStatistics(object):
+	"""Per partition read statistics, collected while made active by withReadStatistics
+	Partitions only look for it once per table, so when nothing is collecting the cost is one getattr"""
+	__slots__ = ["partitionReadStatistics"]
+	def __init__(self):
+		self.partitionReadStatistics = dict() # partitionName -> PartitionReadStatistics
+	
+	def partition(self,partitionName):
+		if partitionName not in self.partitionReadStatistics:
+			self.partitionReadStatistics[partitionName] = PartitionReadStatistics()
+		return self.partitionReadStatistics[partitionName]
+
+_readStatisticsState = threading.local()
+
+def activeReadStatistics():
+	"""the ReadStatistics collecting in this thread, or None"""
+	return getattr(_readStatisticsState,"readStatistics",None)
+
+def withReadStatistics(readStatistics,function):
+	"""calls function with readStatistics collecting, returns what function returned"""
+	previousReadStatistics = activeReadStatistics()
+	_readStatisticsState.readStatistics = readStatistics
+	try:
+		return function()
+	finally:
+		_readStatisticsState.readStatistics = previousReadStatistics
+
+def countedDocIdTermInstanceTableReader(partitionName,docIdTermInstanceVectors):
+	"""wraps a table reader, counting the postings and TermInstances taken from it
+	the counts go to whichever ReadStatistics is active at the time they are read"""
+	def countedTermInstances(termInstancesGenerator):
+		for termInstance in termInstancesGenerator:
+			readStatistics = activeReadStatistics()
+			if readStatistics is not None: readStatistics.partition(partitionName).termInstances += 1
+			yield termInstance
+	for docIdTermInstanceVector in docIdTermInstanceVectors:
+		if docIdTermInstanceVector.docId is not None:
+			readStatistics = activeReadStatistics()
+			if readStatistics is not None: readStatistics.partition(partitionName).postings += 1
+			docIdTermInstanceVector = DocIdTermInstanceVector(docIdTermInstanceVector.docId,countedTermInstances(docIdTermInstanceVector.termInstancesGenerator))
+		yield docIdTermInstanceVector
+
+def countedDocIdReader(partitionName,docIds):
+	for docId in docIds:
+		readStatistics = activeReadStatistics()
+		if readStatistics is not None: readStatistics.partition(partitionName).postings += 1
+		yield docId
+
 class ComputedMatchVector(object):
 	"""A container-like object holding ComputedMatch(es)
-	This does not provide a len(), since the internal generator can be infinite"""
-	__slots__ = ["computedMatchGenerator","realizedComputedMatchVector"]
+	This does not provide a len(), since the internal generator can be infinite
+
+	A vector streams by default: it may be iterated once and keeps none of its matches.
+	Anything which must walk a vector more than once, or index into it, has to call
+	replayable() before iteration starts, the vector then keeps every match it produces"""
+	__slots__ = ["computedMatchGenerator","realizedComputedMatchVector","isReplayable","isConsumed"]
 	def __init__(self,_computedMatchGenerator):
 		self.computedMatchGenerator = _computedMatchGenerator
 		self.realizedComputedMatchVector = list()
+		self.isReplayable = False
+		self.isConsumed = False
+	
+	def replayable(self):
+		"""opt into materialization, returns self"""
+		if self.isConsumed and not self.isReplayable: raise ValueError("ComputedMatchVector has already been streamed")
+		self.isReplayable = True
+		return self
 	
 	def __iter__(self):
+		if not self.isReplayable:
+			if self.isConsumed: raise ValueError("ComputedMatchVector can only be streamed once, call replayable() before iterating")
+			self.isConsumed = True
+			budget = activeQueryBudget()
+			if budget is not None: return budget.chargedIterator(iter(self.computedMatchGenerator),budget.chargeIntermediateMatches)
+			return iter(self.computedMatchGenerator)
+
 		def vectorIterator(computedMatchVector):
 			iterationIndex = 0
 			while 1:
@@ -269,6 +865,8 @@ class ComputedMatchVector(object):
 		return vectorIterator(self)
 	
 	def __getitem__(self,index):
+		if not self.isReplayable: self.replayable()
+		self.isConsumed = True
 		try:
 			while len(self.realizedComputedMatchVector) < index + 1:
 				self.realizedComputedMatchVector.append(self.computedMatchGenerator.next())
@@ -276,57 +874,90 @@ class ComputedMatchVector(object):
 			pass
 		return self.realizedComputedMatchVector[index]
 	
+	def page(self,offset=0,limit=None):
+		"""iterate over at most limit matches, after skipping the first offset
+		the underlying generator is not advanced any further than needed"""
+		if limit is None: return itertools.islice(self,offset,None)
+		return itertools.islice(self,offset,offset + limit)
+	
 	def __repr__(self): return "#CMV:%s..." % (repr(self.realizedComputedMatchVector))
 
 def computedMatchVectorOrOp(*computedMatchVectors):
-	"""Return a new ComputedMatchVector which is a set of all inputs"""
-	def computedMatchGenerator():
-		yieldingVectors = [lazy.peekable(computedMatchVector) for computedMatchVector in computedMatchVectors]
-		while yieldingVectors:
-			yieldingVectorList = None
-			matchToYield = None
-			for vectorIndex,vector in enumerate(yieldingVectors):
-				computedMatch = vector.peek()
-				if matchToYield is None: 
-					matchToYield = computedMatch
-					yieldingVectorList = [vectorIndex]
-				else:
-					if matchToYield.docId == computedMatch.docId:
-						matchToYield += computedMatch
-						yieldingVectorList.append(vectorIndex)
-					elif computedMatch.docId < matchToYield.docId:
-						matchToYield = computedMatch
-						yieldingVectorList = [vectorIndex]
-
-			emptyVectorList = list()
-			for vectorIndex in yieldingVectorList:
-				try:
-					yieldingVectors[vectorIndex].next()
-				except StopIteration:
-					emptyVectorList.append(vectorIndex)
+	"""Return a new ComputedMatchVector which is a set of all inputs
+	The inputs are merged through a heap, so a term expansion unioning hundreds of
+	vectors costs a logarithm of their number per match rather than their number"""
+	def keyedMatches(vectorIndex,computedMatchVector):
+		for computedMatch in computedMatchVector:
+			yield (computedMatch.docId,vectorIndex,computedMatch)
+
+	def joinedMatch(matchesToJoin):
+		if len(matchesToJoin) == 1: return matchesToJoin[0]
+		def joinedTermInstanceVectors(matchesToJoin):
+			# the same as += over matchesToJoin, without changing any input ComputedMatch
+			termInstanceVectors = list()
+			for computedMatch in matchesToJoin:
+				termInstanceVectors += computedMatch.termInstanceVectors
+			termInstanceVectors.sort()
+			return termInstanceVectors
+		return ComputedMatch(matchesToJoin[0].docId,_termInstanceVectorsFunction=lambda matchesToJoin=matchesToJoin: joinedTermInstanceVectors(matchesToJoin))
 
-			yieldingVectors = [vector for vectorIndex,vector in enumerate(yieldingVectors) if vectorIndex not in emptyVectorList]
-			if matchToYield: yield matchToYield
+	def computedMatchGenerator():
+		matchesToJoin = list()
+		for docId,vectorIndex,computedMatch in heapq.merge(*[keyedMatches(vectorIndex,computedMatchVector) for vectorIndex,computedMatchVector in enumerate(computedMatchVectors)]):
+			if matchesToJoin and matchesToJoin[0].docId != docId:
+				matchToYield = joinedMatch(matchesToJoin)
+				if not matchToYield.isEmpty(): yield matchToYield
+				matchesToJoin = list()
+			matchesToJoin.append(computedMatch)
+		if matchesToJoin:
+			matchToYield = joinedMatch(matchesToJoin)
+			if not matchToYield.isEmpty(): yield matchToYield
 	
 	return ComputedMatchVector(computedMatchGenerator())
 
+def _docIdAlignedComputedMatches(computedMatchVectors):
+	"""Generates a list holding one ComputedMatch from each vector, for every docId that all vectors share
+	Every vector must be in ascending docId order, each is walked exactly once"""
+	iterators = [iter(computedMatchVector) for computedMatchVector in computedMatchVectors]
+	if not iterators: return
+	try:
+		currentMatches = [iterator.next() for iterator in iterators]
+		while 1:
+			targetDocId = max([computedMatch.docId for computedMatch in currentMatches])
+			aligned = True
+			for vectorIndex,iterator in enumerate(iterators):
+				while currentMatches[vectorIndex].docId < targetDocId:
+					currentMatches[vectorIndex] = iterator.next()
+				if currentMatches[vectorIndex].docId != targetDocId: aligned = False
+			if aligned:
+				yield list(currentMatches)
+				currentMatches = [iterator.next() for iterator in iterators]
+	except StopIteration:
+		return
+
 def computedMatchVectorAndOp(*computedMatchVectors):
 	"""Return a new ComputedMatchVector where all ComputedMatch(es) has equal docId(s)"""
 	def computedMatchGenerator():
-		docIdEq = lambda computedMatch: len(frozenset(computedMatch)) == 1
-		for computedMatches in lazy.predicated_cartesian_product(docIdEq,*computedMatchVectors):
-			if 0 not in map(len,computedMatches):
+		for computedMatches in _docIdAlignedComputedMatches(computedMatchVectors):
+			if True not in [computedMatch.isEmpty() for computedMatch in computedMatches]:
 				yield reduce(operator.__add__,computedMatches)
 	
 	return ComputedMatchVector(computedMatchGenerator())
 
 def computedMatchVectorAndnotOp(*computedMatchVectors):
-	"""Return a new ComputedMatchVector iff the first computedMatchVector has output and all others have no output"""
+	"""Return a new ComputedMatchVector of the ComputedMatch(es) of the first input whose docId is in no other input"""
 	def computedMatchGenerator():
-		docIdEq = lambda computedMatch: len(frozenset(computedMatch)) == 1
-		for computedMatches in lazy.predicated_cartesian_product(docIdEq,*computedMatchVectors):
-			if len(computedMatches) == 1 or (len(computedMatches) > 1 and 0 == sum(map(len,computedMatches[1:]))):
-				yield computedMatches[0]
+		if not computedMatchVectors: return
+		excludingVectors = [lazy.peekable(computedMatchVector) for computedMatchVector in computedMatchVectors[1:]]
+		for computedMatch in computedMatchVectors[0]:
+			excluded = False
+			for vector in excludingVectors:
+				try:
+					while vector.peek().docId < computedMatch.docId: vector.next()
+					if vector.peek().docId == computedMatch.docId: excluded = True
+				except StopIteration:
+					pass
+			if not excluded: yield computedMatch
 	
 	return ComputedMatchVector(computedMatchGenerator())
 
@@ -391,7 +1022,10 @@ def computedMatchVectorWithinOp(distanceConstraint,*computedMatchVectors):
 	def distanceTest(computedMatches):
 		if not computedMatches: return False
 		_flatten = lazy.flatten
-		for computedMatchPair in lazy.nary_subset(list(_flatten(computedMatches)),2):
+		computedMatchPairs = lazy.nary_subset(list(_flatten(computedMatches)),2)
+		budget = activeQueryBudget()
+		if budget is not None: computedMatchPairs = budget.chargedIterator(computedMatchPairs,budget.chargeIntermediateMatches)
+		for computedMatchPair in computedMatchPairs:
 			if abs(computedMatchPair[0].position - computedMatchPair[1].position) <= distanceConstraint:
 				return True
 	
@@ -428,6 +1062,62 @@ def computedMatchVectorScopeOp(scopeComputedMatchVector,scopedComputedMatchVecto
 	
 	return ComputedMatchVector(computedMatchGenerator())
 
+def computedMatchVectorPhraseOp(phraseLength,offsets,*computedMatchVectors):
+	"""Return a new ComputedMatchVector of the docIds where the term instances of every input, each
+	moved back by its offset, start the phrase at the same position. Instances with an extent
+	(element names) are left out. A match holds the phraseLength TermInstances of every occurrence"""
+	def computedMatchGenerator():
+		for computedMatches in _docIdAlignedComputedMatches(computedMatchVectors):
+			phraseStarts = None
+			for offset,computedMatch in zip(offsets,computedMatches):
+				starts = set([termInstance.position - offset for termInstance in computedMatch.termInstanceVectors if termInstance.extent == 0])
+				if phraseStarts is None: phraseStarts = starts
+				else: phraseStarts &= starts
+				if not phraseStarts: break
+			if phraseStarts:
+				positions = set([start + k for start in phraseStarts for k in xrange(phraseLength)])
+				yield ComputedMatch(computedMatches[0].docId,[TermInstance(position) for position in sorted(positions)])
+	
+	return ComputedMatchVector(computedMatchGenerator())
+
+def docIdIntersection(*docIdIterables):
+	"""Generates the docIds found in every one of the ascending docIdIterables"""
+	iterators = [iter(docIdIterable) for docIdIterable in docIdIterables]
+	if not iterators: return
+	try:
+		currentDocIds = [iterator.next() for iterator in iterators]
+		while 1:
+			targetDocId = max(currentDocIds)
+			aligned = True
+			for iteratorIndex,iterator in enumerate(iterators):
+				while currentDocIds[iteratorIndex] < targetDocId:
+					currentDocIds[iteratorIndex] = iterator.next()
+				if currentDocIds[iteratorIndex] != targetDocId: aligned = False
+			if aligned:
+				yield targetDocId
+				currentDocIds = [iterator.next() for iterator in iterators]
+	except StopIteration:
+		return
+
+def docIdUnion(*docIdIterables):
+	"""Generates, once each, the docIds found in any of the ascending docIdIterables"""
+	previousDocId = None
+	for docId in heapq.merge(*docIdIterables):
+		if docId != previousDocId:
+			yield docId
+			previousDocId = docId
+
+def docIdDifference(docIdIterable,*excludedDocIdIterables):
+	"""Generates the docIds of docIdIterable found in none of excludedDocIdIterables, all ascending"""
+	excludedDocIds = lazy.peekable(docIdUnion(*excludedDocIdIterables))
+	for docId in docIdIterable:
+		try:
+			while excludedDocIds.peek() < docId: excludedDocIds.next()
+			if excludedDocIds.peek() == docId: continue
+		except StopIteration:
+			pass
+		yield docId
+
 OP_AND = 1
 OP_ANDNOT = 2
 OP_BEFORE = 3
@@ -437,6 +1127,23 @@ OP_WITHIN = 6
 OP_SCOPE = 7
 OP_OR = 8
 
+def _bitmapAndnot(bitmap,*excludedBitmaps):
+	return bitmap & ~reduce(operator.or_,excludedBitmaps,0L)
+
+def docIdBitmapOp(opcode):
+	"""returns the bitmap (see bitmapOfDocIds) counterpart of a boolean opcode, None for positional opcodes"""
+	if opcode == OP_AND: return lambda *bitmaps: reduce(operator.and_,bitmaps)
+	elif opcode == OP_ANDNOT: return _bitmapAndnot
+	elif opcode == OP_OR: return lambda *bitmaps: reduce(operator.or_,bitmaps,0L)
+	return None
+
+def docIdOp(opcode):
+	"""returns the docId only counterpart of a boolean opcode, None for positional opcodes"""
+	if opcode == OP_AND: return docIdIntersection
+	elif opcode == OP_ANDNOT: return docIdDifference
+	elif opcode == OP_OR: return docIdUnion
+	return None
+
 def computedMatchVectorOp(opcode):
 	if opcode == OP_AND: return computedMatchVectorAndOp
 	elif opcode == OP_ANDNOT: return computedMatchVectorAndnotOp
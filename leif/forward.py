@@ -0,0 +1,127 @@
+"""
+Forward index, docId -> the termIds of a document position by position
+
+While documents are posted each one is packed (see data.PackedAnalyzedDocument),
+compressed with zlib and appended to a single file. The offset and length of
+every record are kept in a table pickled beside it by writeToDisk. A document is
+rebuilt from its record in O(document length) without reading the reverse
+index, which is what a fast unindex and query result snippets need.
+"""
+import data
+import os
+import pickle_tools
+import threading
+import zlib
+
+ForwardIndexTableSuffix = ".table"
+
+class ForwardIndex(object):
+	"""Appends documents to the file at path, records of docIds posted again replace the earlier ones"""
+	__slots__ = ["path","recordOffsets","dataFile","lock"]
+	def __init__(self,_path):
+		self.path = _path
+		self.recordOffsets = dict() # docId -> (offset,length) of its record
+		self.lock = threading.Lock()
+		if os.path.exists(_path + ForwardIndexTableSuffix): pickle_tools.pickle_load_attrs(self,_path + ForwardIndexTableSuffix)
+		self.dataFile = open(_path,"a+b")
+
+	def addDocument(self,analyzedDocument,docId=None):
+		"""docId, when given, is the docId the record is kept under instead of analyzedDocument.docId
+		(see data.DocIdMap), the record itself always holds the docId the document was posted with"""
+		if docId is None: docId = analyzedDocument.docId
+		record = zlib.compress(data.packAnalyzedDocument(analyzedDocument))
+		self.lock.acquire()
+		try:
+			self.dataFile.seek(0,os.SEEK_END)
+			offset = self.dataFile.tell()
+			self.dataFile.write(record)
+			self.recordOffsets[docId] = (offset,len(record))
+		finally:
+			self.lock.release()
+
+	def writeToDisk(self):
+		self.lock.acquire()
+		try:
+			self.dataFile.flush()
+			pickle_tools.pickle_dump_attrs(self,self.path + ForwardIndexTableSuffix,"recordOffsets")
+		finally:
+			self.lock.release()
+
+	def renumberDocIds(self,internalDocIds):
+		"""keeps every record under internalDocIds[docId] from now on, see optimize"""
+		self.lock.acquire()
+		try:
+			self.recordOffsets = dict([(internalDocIds[docId],recordOffset) for docId,recordOffset in self.recordOffsets.iteritems()])
+		finally:
+			self.lock.release()
+
+	def lookupDocument(self,docId):
+		"""returns the data.PackedAnalyzedDocument of docId, None when it was never added"""
+		if docId not in self.recordOffsets: return None
+		offset,length = self.recordOffsets[docId]
+		self.lock.acquire()
+		try:
+			self.dataFile.flush()
+			self.dataFile.seek(offset)
+			record = self.dataFile.read(length)
+		finally:
+			self.lock.release()
+		return data.PackedAnalyzedDocument(zlib.decompress(record),0)
+
+	def docIds(self):
+		return sorted(self.recordOffsets)
+
+	def __contains__(self,docId): return docId in self.recordOffsets
+	def __len__(self): return len(self.recordOffsets)
+	def __repr__(self): return "#FI(%s):%d documents" % (self.path,len(self.recordOffsets))
+
+def invertAlphabet(alphabet):
+	"""returns the termId -> termWord dict of alphabet, a dict or a termdict.TermDictionary"""
+	return dict([(termId,termWord) for termWord,termId in alphabet.iteritems()])
+
+def documentTermWords(analyzedDocument,termWordOfTermId):
+	"""returns the sorted (position,termWord) pairs of analyzedDocument, termIds missing from termWordOfTermId are skipped"""
+	return sorted([(position,termWordOfTermId[termId]) for position,termId,extent in analyzedDocument.iterTermInstances() if termId in termWordOfTermId])
+
+def _matchedPositions(termInstanceVectors):
+	"""the positions of every TermInstance however deeply the vectors of an operator nest them"""
+	positions = set()
+	for element in termInstanceVectors:
+		if isinstance(element,data.TermInstance): positions.add(element.position)
+		else: positions.update(_matchedPositions(element))
+	return positions
+
+def makeSnippet(forwardIndex,termWordOfTermId,computedMatch,context=8,maxFragments=3,highlight=("[","]")):
+	"""returns a line of text from the document of computedMatch, made of up to maxFragments
+	windows of context words around its matched positions, with the matched words marked by
+	highlight. Element names (instances with an extent) are left out. Returns None when the
+	document is not in forwardIndex"""
+	analyzedDocument = forwardIndex.lookupDocument(computedMatch.docId)
+	if analyzedDocument is None: return None
+	words = [None] * analyzedDocument.termCount
+	for position,termId,extent in analyzedDocument.iterTermInstances():
+		if extent == 0 and termId in termWordOfTermId: words[position] = termWordOfTermId[termId]
+	matchedPositions = sorted(_matchedPositions(computedMatch.termInstanceVectors))
+
+	windows = list()
+	for position in matchedPositions:
+		start,end = max(0,position - context),min(len(words),position + context + 1)
+		if windows and start <= windows[-1][1]:
+			windows[-1][1] = max(windows[-1][1],end)
+		else:
+			if len(windows) == maxFragments: break
+			windows.append([start,end])
+
+	matchedPositions = set(matchedPositions)
+	fragments = list()
+	for start,end in windows:
+		fragmentWords = list()
+		for position in xrange(start,end):
+			if words[position] is None: continue
+			if position in matchedPositions: fragmentWords.append(highlight[0] + words[position] + highlight[1])
+			else: fragmentWords.append(words[position])
+		fragments.append(" ".join(fragmentWords))
+	snippet = " ... ".join(fragments)
+	if windows and windows[0][0] > 0: snippet = "... " + snippet
+	if windows and windows[-1][1] < len(words): snippet += " ..."
+	return snippet
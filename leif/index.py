@@ -1,47 +1,62 @@
 """
 Classes and functions dealing with the Index structure
 """
+import cache
+import copy
 import data
 import exceptions
+import forward
+import itertools
 import mmap
 import os
 import pickle_tools
 import Queue
 import struct
 import sys
+import telemetry
 import threading
 import time
 
 defaultMetadataFileSuffix = ".meta"
+# every partition object caches its postings under a serial of its own, so postings a query
+# still reads out of a partition replaced by a merge never end up in the cache of its successor
+_partitionSerials = itertools.count()
 
 class ReverseIndexKeyError(exceptions.Exception):
 	"""raise if the indexKey does not match its expected value"""
 
-def openIndexPartition(name,path,metadataFileSuffix=defaultMetadataFileSuffix,indexKey=None):
+def openIndexPartition(name,path,metadataFileSuffix=defaultMetadataFileSuffix,indexKey=None,postingsCache=None):
 	"""Creates the appropriate partition based on the path
 
 	MemoryPartitons will be created if the path starts with :memory:"""
 	if path.startswith(":memory:"):
 		path = path[len(":memory:"):]
-		return MemoryPartition(name,path,_indexKey=indexKey)
+		return MemoryPartition(name,path,_indexKey=indexKey,_postingsCache=postingsCache)
 	else:
-		return ExternalPartition(name,path,_metadataFileSuffix=metadataFileSuffix,_indexKey=indexKey)
+		return ExternalPartition(name,path,_metadataFileSuffix=metadataFileSuffix,_indexKey=indexKey,_postingsCache=postingsCache)
+
+def removeIndexPartitionFiles(path,metadataFileSuffix=defaultMetadataFileSuffix):
+	"""removes whatever a partition at path left on disk, data and metadata"""
+	for stalePath in (path,path + metadataFileSuffix):
+		if os.path.exists(stalePath): os.unlink(stalePath)
 
 class MemoryPartition(object):
 	"""MemoryPartition keeps all index data in RAM.
 	It can optionally be backed by a permanent file which is loaded at __init__"""
-	__slots__ = ["name","path","indexKey","termInstanceLimit","termIdHash"]
-	def __init__(self,_name,_path,_indexKey=None):
+	__slots__ = ["name","path","indexKey","termInstanceLimit","termIdHash","postingsCache","cacheKey"]
+	def __init__(self,_name,_path,_indexKey=None,_postingsCache=None):
 		self.name = _name
+		self.cacheKey = (_name,_partitionSerials.next())
 		self.path = _path # can be None
 		self.indexKey = _indexKey
 		self.termInstanceLimit = None
 		self.termIdHash = dict()
+		self.postingsCache = _postingsCache # can be None
 
 		self.__pickle_init__()
 	
 	def __pickle_init__(self):
-		if self.path:
+		if self.path and os.path.exists(self.path):
 			try:
 				print >> sys.stderr, "MemoryPartition data found at %s" % self.path
 				key = self.indexKey
@@ -58,7 +73,11 @@ class MemoryPartition(object):
 	
 	def zeroAllData(self):
 		self.termIdHash = dict()
-		# remove disk based data
+		if self.postingsCache: self.postingsCache.invalidatePartition(self.cacheKey)
+		self.emptyDiskData()
+	
+	def emptyDiskData(self):
+		"""removes disk based data, what is in memory is left as it is"""
 		if self.path and os.path.exists(self.path): os.unlink(self.path)
 	
 	@property
@@ -66,24 +85,60 @@ class MemoryPartition(object):
 		return sum(map(lambda termInstance: termInstance.termInstanceCount,self.termIdHash.values()))
 	
 	def reachedTermInstanceLimit(self):
-		if self.termInstanceLimit: return self.termInstanceLimit == self.termInstanceCount
+		if self.termInstanceLimit: return self.termInstanceCount >= self.termInstanceLimit
 		return False
 	
 	def addTermInstance(self,termId,docId,position,extent=0):
 		if termId not in self.termIdHash:
 			self.termIdHash[termId] = data.DocIdTermInstanceTable()
 		self.termIdHash[termId].insertTermInstanceRecord(docId,data.TermInstance(position,extent))
+		if self.postingsCache: self.postingsCache.invalidateTermId(self.cacheKey,termId)
 	
 	def lookupTermId(self,termId):
 		if termId in self.termIdHash:
-			return data.readUncompressedDocIdTermInstanceTable(self.termIdHash[termId])
+			if self.postingsCache:
+				reader = self.postingsCache.lookupTermId(self.cacheKey,termId,lambda: data.readUncompressedDocIdTermInstanceTable(self.termIdHash[termId]))
+			else:
+				reader = data.readUncompressedDocIdTermInstanceTable(self.termIdHash[termId])
+			readStatistics = data.activeReadStatistics()
+			if readStatistics is not None:
+				readStatistics.partition(self.name).lookups += 1
+				reader = data.countedDocIdTermInstanceTableReader(self.name,reader)
+			return reader
 		return data.nullUncompressedDocIdTermInstanceTable()
 	
+	def lookupDocIds(self,termId):
+		"""returns the ascending docIds holding termId, without reading any TermInstance"""
+		if termId in self.termIdHash:
+			docIds = data.readUncompressedDocIds(self.termIdHash[termId])
+			readStatistics = data.activeReadStatistics()
+			if readStatistics is not None:
+				readStatistics.partition(self.name).lookups += 1
+				docIds = data.countedDocIdReader(self.name,docIds)
+			return docIds
+		return []
+	
+	def lookupDocIdBitmap(self,termId):
+		"""the MemoryPartition keeps no bitmaps, see ExternalPartition.lookupDocIdBitmap"""
+		return None
+	
+	def holdsDocIdBitmap(self,termId):
+		return False
+	
+	def lookupTermStatistics(self,termId):
+		"""returns (docIdCount,maxTermInstanceCount) for termId"""
+		if termId in self.termIdHash:
+			table = self.termIdHash[termId]
+			return (len(table),table.maxTermInstanceCount)
+		return (0,0)
+	
 	def deleteTermId(self,termId):
 		if termId in self.termIdHash: del self.termIdHash[termId]
+		if self.postingsCache: self.postingsCache.invalidateTermId(self.cacheKey,termId)
 	
 	def deleteDocId(self,termId,docId):
 		if termId in self.termIdHash: self.termIdHash[termId].deleteDocId(docId)
+		if self.postingsCache: self.postingsCache.invalidateTermId(self.cacheKey,termId)
 	
 	def estimateSizeOnDisk(self):
 		"""If we are to serialize this data how much room might we need"""
@@ -99,14 +154,16 @@ class ExternalPartition(object):
 	"""ExternalPartition uses an on disk file to store compressed DocIdTermInstanceTable instances
 	In memory it must maintan only enough information to read the proper table for a termId
 	This in-memory data must be explicitly preserved to disk, and will be loaded at __init___"""
-	__slots__ = ["name","path","indexKey","metadataFileSuffix","termInstanceLimit","termIdHash","fp","mmap"]
-	def __init__(self,_name,_path,_metadataFileSuffix=defaultMetadataFileSuffix,_indexKey=None):
+	__slots__ = ["name","path","indexKey","metadataFileSuffix","termInstanceLimit","termIdHash","postingsCache","cacheKey","fp","mmap"]
+	def __init__(self,_name,_path,_metadataFileSuffix=defaultMetadataFileSuffix,_indexKey=None,_postingsCache=None):
 		self.name = _name
+		self.cacheKey = (_name,_partitionSerials.next())
 		self.path = _path
 		self.indexKey = _indexKey
 		self.metadataFileSuffix = _metadataFileSuffix
 		self.termInstanceLimit = None
 		self.termIdHash = dict()
+		self.postingsCache = _postingsCache # can be None
 
 		self.__pickle_init__()
 		self.__mmap_init__()
@@ -129,9 +186,16 @@ class ExternalPartition(object):
 	
 	def zeroAllData(self):
 		self.termIdHash = dict()
+		if self.postingsCache: self.postingsCache.invalidatePartition(self.cacheKey)
+		self.emptyDiskData()
+	
+	def emptyDiskData(self):
+		"""empties the files of the partition, termIdHash and the open mmap are left as they are"""
 		metadataPath = self.path + self.metadataFileSuffix
 		if os.path.exists(metadataPath): os.unlink(metadataPath)
-		# truncate the index, but do not remove it from disk
+		# empty the index, but do not remove it from disk. A fresh file is made rather than
+		# truncating this one, queries still reading through the old mmap would fault
+		if os.path.exists(self.path): os.unlink(self.path)
 		open(self.path,"wb").close()
 	
 	@property
@@ -139,17 +203,72 @@ class ExternalPartition(object):
 		return sum(map(lambda termInstanceHeader: termInstanceHeader.termInstanceCount,self.termIdHash.values()))
 	
 	def reachedTermInstanceLimit(self):
-		if self.termInstanceLimit: return self.termInstanceLimit == self.termInstanceCount
+		if self.termInstanceLimit: return self.termInstanceCount >= self.termInstanceLimit
 		return False
 	
 	def lookupTermId(self,termId):
 		if termId in self.termIdHash: 
-			return data.decompressDocIdTermInstanceTable(self.mmap,self.termIdHash[termId])
+			if self.postingsCache:
+				reader = self.postingsCache.lookupTermId(self.cacheKey,termId,lambda: self._decompressTermId(termId))
+			else:
+				reader = self._decompressTermId(termId)
+			readStatistics = data.activeReadStatistics()
+			if readStatistics is not None:
+				readStatistics.partition(self.name).lookups += 1
+				reader = data.countedDocIdTermInstanceTableReader(self.name,reader)
+			return reader
 		return data.nullUncompressedDocIdTermInstanceTable()
 	
+	def _decompressTermId(self,termId):
+		header = self.termIdHash[termId]
+		readStatistics = data.activeReadStatistics()
+		if readStatistics is not None: readStatistics.partition(self.name).bytesDecoded += header.length
+		return data.decompressDocIdTermInstanceTable(self.mmap,header)
+	
+	def lookupDocIds(self,termId):
+		"""returns the ascending docIds holding termId, without reading any TermInstance"""
+		if termId in self.termIdHash:
+			header = self.termIdHash[termId]
+			docIds = data.decompressDocIds(self.mmap,header)
+			readStatistics = data.activeReadStatistics()
+			if readStatistics is not None:
+				partitionReadStatistics = readStatistics.partition(self.name)
+				partitionReadStatistics.lookups += 1
+				partitionReadStatistics.bytesDecoded += data.compressedDocIdsSizeInBytes(header)
+				docIds = data.countedDocIdReader(self.name,docIds)
+			return docIds
+		return []
+	
+	def lookupDocIdBitmap(self,termId):
+		"""returns the docIds holding termId as a bitmap (see data.bitmapOfDocIds) when its table
+		is in the bitmap layout, None otherwise"""
+		if self.holdsDocIdBitmap(termId):
+			header = self.termIdHash[termId]
+			readStatistics = data.activeReadStatistics()
+			if readStatistics is not None:
+				partitionReadStatistics = readStatistics.partition(self.name)
+				partitionReadStatistics.lookups += 1
+				partitionReadStatistics.postings += header.docIdCount
+				partitionReadStatistics.bytesDecoded += header.docIdsLength
+			return data.decompressDocIdBitmap(self.mmap,header)
+		return None
+	
+	def holdsDocIdBitmap(self,termId):
+		"""True when the table of termId is in the bitmap layout, answered from its header"""
+		return termId in self.termIdHash and getattr(self.termIdHash[termId],"layout",None) == data.DocIdTermInstanceTableLayoutBitmap
+	
+	def lookupTermStatistics(self,termId):
+		"""returns (docIdCount,maxTermInstanceCount) for termId, straight from the table header"""
+		if termId in self.termIdHash:
+			header = self.termIdHash[termId]
+			# headers written before maxTermInstanceCount existed only bound it by termInstanceCount
+			return (header.docIdCount,getattr(header,"maxTermInstanceCount",header.termInstanceCount))
+		return (0,0)
+	
 	def deleteTermId(self,termId):
 		"""does not remove data from index, just drops the reference in the termIdHash to prevent lookup"""
 		if termId in self.termIdHash: del self.termIdHash[termId]
+		if self.postingsCache: self.postingsCache.invalidateTermId(self.cacheKey,termId)
 	
 	def estimateSizeOnDisk(self):
 		return sum(map(lambda header: header.length,self.termIdHash.values()))
@@ -173,97 +292,46 @@ class ExternalPartition(object):
 				self.mmap = mmap.mmap(self.fp.fileno(),fileSize,mmap.MAP_SHARED,mmap.PROT_READ)
 	
 	def mergePartitions(self,termIdList,*partitions):
-		"""Merge the data from partitions into self
+		"""Merge the data from partitions and self into a new partition at the path of self
 		This must be a method on an ExternalPartition, MemoryPartitions have no concept of merging
 		termIdList must contain the sorted list of all termIds in all partitions
 		the resulting merged partition will contain one entry for each termId
+		Neither self nor partitions are changed, queries can go on reading them while the merge runs
+		and afterwards, through their mmaps of the files the merge replaced
+		returns (mergedPartition,bytesRead,bytesWritten), bytes read out of partitions holding compressed data are estimates
 		"""
-		# seek constants... no need to import them from wherever...
-		SEEK_END = 2
-		SEEK_CUR = 1
-		# internal functions to handle some preliminaries
-		# makes the main merge code easier to understand, sacrificing overval function length
-		def _growPartitionFile(howMuch):
-			"""extend the disk partition by howMuch"""
-			if os.path.exists(self.path): # prevent trucating existing file
-				print >> sys.stderr, "Extending ExternalPartition %s" % self.path
-				fp = open(self.path,"rb+")
-			else:
-				print >> sys.stderr, "Creating ExternalPartiton %s" % self.path
-				fp = open(self.path,"wb")
-
-			fp.seek(0,SEEK_END)
-			previousSize = fp.tell()
-			fp.seek(howMuch - 1,SEEK_CUR)
-			fp.write('\x00')
-			newSize = fp.tell()
-			print >> sys.stderr, "ExternalPartition grew %d bytes, has size %s" % (newSize-previousSize,newSize)
-			fp.close()
-			self.__mmap_init__()
-		def _relocateDocIdTermInstanceTables():
-			"""Relocates the existing tables to the end of the file maintaining proper offsets"""
-			rp = open(self.path,"rb")
-			wp = open(self.path,"rb+")
-			wp.seek(0,SEEK_END)
-
-			for termId in reversed(sorted(self.termIdHash)):
-				header = self.termIdHash[termId]
-				rp.seek(header.offset)
-				wp.seek(-header.length,SEEK_CUR)
-				newOffset = wp.tell()
-				wp.write(rp.read(header.length))
-				wp.seek(newOffset)
-				self.termIdHash[termId].offset = newOffset
-
-			rp.close()
-			wp.close()
-		# Main Merge Logic
-		spaceNeeded = sum(map(lambda partition: partition.estimateSizeOnDisk(),partitions))
-		_growPartitionFile(spaceNeeded)
-		_relocateDocIdTermInstanceTables()
-		wp = open(self.path,"rb+")
-
+		mergedPath = self.path + ".merge"
+		termIdHash = dict()
+		partitions = partitions + (self,)
+		print >> sys.stderr, "Merging %d partitions into %s" % (len(partitions),mergedPath)
+		wp = open(mergedPath,"wb")
 		for termId in termIdList:
-			partitionsHoldingTermId = list()
-			for partition in partitions:
-				if termId in partition:
-					partitionsHoldingTermId.append(partition)
-
-			# always add self last
-			if termId in self: partitionsHoldingTermId.append(self)
+			partitionsHoldingTermId = [partition for partition in partitions if termId in partition]
 			if len(partitionsHoldingTermId) == 0: continue
-			else:
-				newOffset = wp.tell()
-
-			if len(partitionsHoldingTermId) == 1:
-				partition = partitionsHoldingTermId[0]
-				#print >> sys.stderr, "Merge single instance of termId %d from %s" % (termId,partition.name)
-				header,compressedData = partition.compressTermIdData(termId)
-				wp.write(compressedData)
-				header.offset = newOffset
-				self.termIdHash[termId] = header
-
-				if partition is not self: partition.deleteTermId(termId)
+			elif len(partitionsHoldingTermId) == 1:
+				header,compressedData = partitionsHoldingTermId[0].compressTermIdData(termId)
+				header = copy.copy(header) # the header may belong to the termIdHash of an ExternalPartition
 			else:
 				table = data.DocIdTermInstanceTable()
 				for partition in partitionsHoldingTermId:
-					#print >> sys.stderr, "Merge multi instance termId %s from %s" % (termId,partition.name)
 					for docIdTermInstanceVector in partition.lookupTermId(termId):
 						docId = docIdTermInstanceVector.docId
 						for termInstance in docIdTermInstanceVector.termInstancesGenerator:
 							table.insertTermInstanceRecord(docId,termInstance)
-
-					if partition is not self: partition.deleteTermId(termId)
-
-				header,compressedData = data.compressDocIdTermInstanceTable(table) 
-				wp.write(compressedData)
-				header.offset = newOffset
-				self.termIdHash[termId] = header
-
-		wp.truncate()
-		print >> sys.stderr, "ExternalPartition was truncated to size %d" % wp.tell()
+				header,compressedData = data.compressDocIdTermInstanceTable(table)
+			header.offset = wp.tell()
+			wp.write(compressedData)
+			termIdHash[termId] = header
+		mergedBytes = wp.tell()
 		wp.close()
-		self.__mmap_init__()
+		print >> sys.stderr, "ExternalPartition %s was merged to size %d" % (self.path,mergedBytes)
+
+		# renaming over the file leaves the mmap of self reading the old one
+		os.rename(mergedPath,self.path)
+		mergedPartition = ExternalPartition(self.name,self.path,self.metadataFileSuffix,self.indexKey,self.postingsCache)
+		mergedPartition.termIdHash = termIdHash
+		mergedPartition.termInstanceLimit = self.termInstanceLimit
+		return (mergedPartition,sum(map(lambda partition: partition.estimateSizeOnDisk(),partitions)),mergedBytes)
 
 class GrowthStrategyFixedBuffer(object):
 	"""a partition growth strategy where we merge into the next partition when the previous
@@ -295,6 +363,10 @@ class GrowthStrategyFixedBuffer(object):
 		else: return ((r-1)*(r**(k-1)))*b
 	
 	def mergePartitions(self,termIdList,partitions,partitionConstructor):
+		"""returns (mergedPartitions,mergeIntoPartitionK,bytesRead,bytesWritten)
+		partitions is left as it is for the queries reading it, mergedPartitions is the list to replace it
+		with: partitions[:mergeIntoPartitionK + 1] merged into a new partition mergeIntoPartitionK, and
+		new empty partitions below it. partitionConstructor(k) opens partition k at its path, k = 0 the MMP"""
 		mergeIntoPartitionK = len(partitions)
 		for partitionK in xrange(1,mergeIntoPartitionK):
 			termInstanceCount = sum(map(lambda partition: partition.termInstanceCount,partitions[:partitionK+1]))
@@ -303,33 +375,83 @@ class GrowthStrategyFixedBuffer(object):
 				break
 
 		if mergeIntoPartitionK == len(partitions):
-			newPartition = partitionConstructor(mergeIntoPartitionK)
-			newPartition.termInstanceLimit = self.computeTermInstanceLimitForPartitionK(mergeIntoPartitionK)
-			partitions.append(newPartition)
+			targetPartition = partitionConstructor(mergeIntoPartitionK)
+			targetPartition.termInstanceLimit = self.computeTermInstanceLimitForPartitionK(mergeIntoPartitionK)
+		else:
+			targetPartition = partitions[mergeIntoPartitionK]
 
-		partitions[mergeIntoPartitionK].mergePartitions(termIdList,*partitions[:mergeIntoPartitionK])
+		mergedPartition,bytesRead,bytesWritten = targetPartition.mergePartitions(termIdList,*partitions[:mergeIntoPartitionK])
+		mergedPartitions = list()
 		for k in xrange(mergeIntoPartitionK):
-			partitions[k].zeroAllData()
+			partitions[k].emptyDiskData()
+			emptyPartition = partitionConstructor(k)
+			emptyPartition.termInstanceLimit = partitions[k].termInstanceLimit
+			mergedPartitions.append(emptyPartition)
+		mergedPartitions.append(mergedPartition)
+		mergedPartitions += partitions[mergeIntoPartitionK + 1:]
+		return (mergedPartitions,mergeIntoPartitionK,bytesRead,bytesWritten)
+
+def documentBiwords(analyzedDocument,biwordTermIds):
+	"""generates (position,(termId,nextTermId)) for every pair of words at adjacent positions of
+	analyzedDocument where either word is in biwordTermIds, element names (instances with an extent) are not words"""
+	wordTermIds = dict()
+	for position,termId,extent in analyzedDocument.iterTermInstances():
+		if extent == 0: wordTermIds.setdefault(position,[]).append(termId)
+	for position in sorted(wordTermIds):
+		if position + 1 not in wordTermIds: continue
+		for termId in wordTermIds[position]:
+			for nextTermId in wordTermIds[position + 1]:
+				if termId in biwordTermIds or nextTermId in biwordTermIds: yield (position,(termId,nextTermId))
 
 class ReverseIndex(object):
-	"""Brings together the Memory and External partitions in to a single interface"""
-	def __init__(self,_path,_partitionPrefix,_indexKey):
+	"""Brings together the Memory and External partitions in to a single interface
+	_postingsCacheByteLimit > 0 keeps decoded postings of frequently looked up termIds in a cache.PostingsCache
+	_documentQueueSize and _postingQueueSize > 0 bound the ingress queues, post() then blocks while they are full
+	_forwardIndex keeps every posted document in a forward.ForwardIndex as well, one found on disk is always kept up.
+	It is only started on an empty index, so that it holds every document of the index
+	_biwordTermIds also posts every pair of adjacent words holding one of these termIds under the
+	(termId,nextTermId) pair, see documentBiwords. The set is saved with the index and can only be
+	changed while the index is empty, so that every document has the biwords of the set"""
+	def __init__(self,_path,_partitionPrefix,_indexKey,_postingsCacheByteLimit=0,_documentQueueSize=0,_postingQueueSize=0,_forwardIndex=False,_biwordTermIds=None):
 		self.path = _path
 		self.partitionPrefix = _partitionPrefix
 		self.indexKey = _indexKey
 		self.growthStrategy = GrowthStrategyFixedBuffer(512,3)
 		self.makePartitionName = lambda name: os.sep.join([self.path,self.partitionPrefix + ".%s" % name])
+		self.postingsCache = None
+		if _postingsCacheByteLimit > 0: self.postingsCache = cache.PostingsCache(_postingsCacheByteLimit)
 
-		mmp = openIndexPartition("MMP",":memory:%s" % self.makePartitionName("MMP"),indexKey=self.indexKey)
-		mmp.termInstanceLimit = self.growthStrategy.computeTermInstanceLimitForPartitionK(0)
-
-		self.partitions = [mmp]
+		self.partitions = list()
 		self.externalPartitionCount = 0
+		self.partitionPaths = None # the path of every partition, MMP first, saved once an optimize moved them off their names
 		self.lexicon = dict()
 		self.termCount = 0
+		self.generation = 0 # bumped for every posting, lets query caches detect stale results
+		self.documentLengths = data.DocumentLengthTable()
+		self.ingestStatistics = telemetry.IngestStatistics()
+		self.documentQueueSize = _documentQueueSize
+		self.postingQueueSize = _postingQueueSize
+		self.biwordTermIds = set()
+		self.docIdMap = None # a data.DocIdMap once an optimize reassigned the docIds
+		self.forwardIndex = None
 
 		self.__pickle_init__()
+		mmp = openIndexPartition("MMP",":memory:%s" % self.partitionPath(0),indexKey=self.indexKey,postingsCache=self.postingsCache)
+		mmp.termInstanceLimit = self.growthStrategy.computeTermInstanceLimitForPartitionK(0)
+		self.partitions.append(mmp)
 		self.openAllExternalPartitions()
+		if os.path.exists(self.makePartitionName("FWD")):
+			self.forwardIndex = forward.ForwardIndex(self.makePartitionName("FWD"))
+		elif _forwardIndex:
+			if len(self.documentLengths):
+				print >> sys.stderr, "ReverseIndex already holds documents, a forward index can only be started on an empty one"
+			else:
+				self.forwardIndex = forward.ForwardIndex(self.makePartitionName("FWD"))
+		if _biwordTermIds is not None and set(_biwordTermIds) != self.biwordTermIds:
+			if len(self.documentLengths):
+				print >> sys.stderr, "ReverseIndex already holds documents, keeping its %d biword termIds" % len(self.biwordTermIds)
+			else:
+				self.biwordTermIds = set(_biwordTermIds)
 
 		self.__document_ingress_init__()
 		self.__posting_ingress_init__()
@@ -343,79 +465,200 @@ class ReverseIndex(object):
 			except IOError:
 				print >> sys.stderr, "Unable to load ReverseIndex metadata from %s" % path
 	
+	def partitionPath(self,k):
+		"""the path partition k is kept at, k = 0 the MMP"""
+		if self.partitionPaths is not None and k < len(self.partitionPaths): return self.partitionPaths[k]
+		if k == 0: return self.makePartitionName("MMP")
+		return self.makePartitionName("EXP%d" % k)
+	
 	def openAllExternalPartitions(self):
 		print >> sys.stderr, "ReverseIndex has %d external partitions to open" % (self.externalPartitionCount)
 		for k in xrange(self.externalPartitionCount):
 			k = k + 1
-			self.partitions.append(openIndexPartition("EXP%d"%k,self.makePartitionName("EXP%d"%k),indexKey=self.indexKey))
+			self.partitions.append(openIndexPartition("EXP%d"%k,self.partitionPath(k),indexKey=self.indexKey,postingsCache=self.postingsCache))
+	
+	def writeLexiconToDisk(self):
+		"""writes the LEX beside its path and renames it into place, the partitions it names are the index"""
+		self.partitionPaths = [partition.path for partition in self.partitions]
+		path = self.makePartitionName("LEX")
+		pickle_tools.pickle_dump_attrs(self,path + ".tmp","externalPartitionCount","partitionPaths","lexicon","termCount","documentLengths","biwordTermIds","docIdMap")
+		os.rename(path + ".tmp",path)
 	
 	def writeToDisk(self):
-		# THIS IS A HACK!!! WE NEED BETTER merge synronization
-		busyLoopCounter = 0
-		while not (self.documentQueue.empty() and self.postingQueue.empty()):
-			time.sleep(30)
-			if busyLoopCounter % 5 == 0:
-				print >> sys.stderr, "WriteToDisk waiting on queues..."
-			busyLoopCounter += 1
+		# the ingress threads mark every item done once it is indexed, a document only after
+		# all its postings are queued, so once both joins return everything posted is in a partition
+		print >> sys.stderr, "WriteToDisk waiting on queues..."
+		self.documentQueue.join()
+		self.postingQueue.join()
 
 		print >> sys.stderr, "Writing to disk..."
 
-		path = self.makePartitionName("LEX")
-		pickle_tools.pickle_dump_attrs(self,path,"externalPartitionCount","lexicon","termCount")
+		self.writeLexiconToDisk()
 		for partition in self.partitions:
 			partition.writeToDisk()
+		if self.forwardIndex is not None: self.forwardIndex.writeToDisk()
 	
 	def __document_ingress_init__(self):
-		"""creates the post() method so that analyzed docs can be added to the index
+		"""creates the post() method so that analyzed docs can be added to the index, either
+		data.AnalyzedDocument or data.PackedAnalyzedDocument
 		also created the ingress thread and associated data
 		"""
+		def _partitionTermId(self,termId):
+			# the lexicon also maps biwords, (termId,nextTermId) pairs, to partition termIds
+			if termId not in self.lexicon:
+				self.lexicon[termId] = self.termCount
+				self.termCount += 1
+			return self.lexicon[termId]
+
 		def _documentIngressThread(self):
 			willBlock = True
 			while 1:
 				analyzedDocument = self.documentQueue.get(willBlock)
-				for position,analyzedTerm in enumerate(analyzedDocument.analyzedTermList):
-					for termId,extent in analyzedTerm.instanceSet:
-						if termId not in self.lexicon:
-							self.lexicon[termId] = self.termCount
-							self.termCount += 1
-						termId = self.lexicon[termId]
-						self.postingQueue.put((termId,analyzedDocument.docId,position,extent))
+				docId = analyzedDocument.docId
+				if self.docIdMap is not None: docId = self.docIdMap.internalDocId(docId)
+				self.documentLengths.setDocumentLength(docId,analyzedDocument.termCount)
+				self.ingestStatistics.documentsPosted += 1
+				if self.forwardIndex is not None: self.forwardIndex.addDocument(analyzedDocument,docId)
+				for position,termId,extent in analyzedDocument.iterTermInstances():
+					self.postingQueue.put((_partitionTermId(self,termId),docId,position,extent))
+				if self.biwordTermIds:
+					for position,biword in documentBiwords(analyzedDocument,self.biwordTermIds):
+						self.postingQueue.put((_partitionTermId(self,biword),docId,position,0))
+				self.documentQueue.task_done()
 
 		self.post = lambda analyzedDocument: self.documentQueue.put(analyzedDocument)
-		self.documentQueue = Queue.Queue(-1)
-		self.documentIngressThread = threading.Thread(target = _documentIngressThread,args = (self,))
+		self.documentQueue = Queue.Queue(self.documentQueueSize)
+		self.documentIngressThread = threading.Thread(target = _documentIngressThread,name = "DocumentIngress",args = (self,))
 		self.documentIngressThread.setDaemon(True)
 		self.documentIngressThread.start()
 	
 	def __posting_ingress_init__(self):
 		"""pulls data from the documentQueue and puts it in the index, while managing the indexes growth"""
 		def _lexiconTermIds(self):
-			return [self.lexicon[termId] for termId in sorted(self.lexicon)]
+			# mergePartitions writes the tables in this order, the order of the partition termIds,
+			# not of the termIds they were posted with
+			return sorted(self.lexicon.values())
 
 		def _postingIngressThread(self):
 			willBlock = True
+			previousDocId = None
 			while 1:
 				termId,docId,position,extent = self.postingQueue.get(willBlock)
-				if self.partitions[0].reachedTermInstanceLimit():
+				# only move on from the MMP between documents, so no document spans two partitions
+				# and per partition docId counts and term frequencies are exact
+				if docId != previousDocId and self.partitions[0].reachedTermInstanceLimit():
 					print >> sys.stderr, "Extending partitions"
-					def _externalPartitionConstructor(k):
-						partitionName = "EXP%d" % k
-						return openIndexPartition(partitionName,self.makePartitionName(partitionName),indexKey=self.indexKey)
-					self.growthStrategy.mergePartitions(_lexiconTermIds(self),self.partitions,_externalPartitionConstructor)
+					def _partitionConstructor(k):
+						partitionName = k and "EXP%d" % k or "MMP"
+						path = self.makePartitionName(partitionName)
+						# a path no partition is kept at only holds what an optimize cut short left behind
+						if path not in [partition.path for partition in self.partitions]: removeIndexPartitionFiles(path)
+						if k == 0: return openIndexPartition("MMP",":memory:%s" % path,indexKey=self.indexKey,postingsCache=self.postingsCache)
+						return openIndexPartition(partitionName,path,indexKey=self.indexKey,postingsCache=self.postingsCache)
+					self.ingestStatistics.recordMergeStart()
+					mergeStartTime = time.time()
+					bytesIngested = self.partitions[0].estimateSizeOnDisk()
+					mergedPartitions,mergeIntoPartitionK,bytesRead,bytesWritten = self.growthStrategy.mergePartitions(_lexiconTermIds(self),self.partitions,_partitionConstructor)
+					replacedPartitions = self.partitions[:mergeIntoPartitionK + 1]
+					# a single assignment, a lookup sees the partitions from before the merge or after it, never a mix
+					self.partitions = mergedPartitions
+					if self.postingsCache:
+						for partition in replacedPartitions: self.postingsCache.invalidatePartition(partition.cacheKey)
+					self.ingestStatistics.recordMerge(mergeIntoPartitionK,time.time() - mergeStartTime,bytesIngested,bytesRead,bytesWritten)
 					self.externalPartitionCount = len(self.partitions) - 1
 				self.partitions[0].addTermInstance(termId,docId,position,extent)
+				self.generation += 1
+				self.ingestStatistics.postingsIndexed += 1
+				previousDocId = docId
+				self.postingQueue.task_done()
 
-		self.postingQueue = Queue.Queue(-1)
-		self.postingIngressThread = threading.Thread(target = _postingIngressThread,args = (self,))
+		self.postingQueue = Queue.Queue(self.postingQueueSize)
+		self.postingIngressThread = threading.Thread(target = _postingIngressThread,name = "PostingIngress",args = (self,))
 		self.postingIngressThread.setDaemon(True)
 		self.postingIngressThread.start()
 	
+	def stats(self):
+		"""returns a JSON friendly dict describing ingestion, merges and the partitions"""
+		stats = self.ingestStatistics.stats()
+		stats["documentQueueDepth"] = self.documentQueue.qsize()
+		stats["postingQueueDepth"] = self.postingQueue.qsize()
+		stats["generation"] = self.generation
+		stats["termCount"] = self.termCount
+		partitionStats = list()
+		for level,partition in enumerate(list(self.partitions)):
+			termInstanceCount = partition.termInstanceCount
+			partitionStats.append({
+				"name": partition.name,
+				"level": level,
+				"termIds": len(partition.termIdHash),
+				"termInstances": termInstanceCount,
+				"termInstanceLimit": partition.termInstanceLimit,
+				"fill": partition.termInstanceLimit and float(termInstanceCount) / partition.termInstanceLimit or 0.0,
+				"bytes": partition.estimateSizeOnDisk(),
+			})
+		stats["partitions"] = partitionStats
+		stats["mmpFill"] = partitionStats[0]["fill"]
+		if self.postingsCache is not None: stats["postingsCache"] = self.postingsCache.stats()
+		return stats
+	
+	def startIngestProfiler(self,interval=0.005):
+		"""returns a started telemetry.SamplingProfiler over the ingress threads, stop() it and read its report()"""
+		return telemetry.SamplingProfiler([self.documentIngressThread,self.postingIngressThread],interval).start()
+	
+	def externalDocId(self,docId):
+		"""the docId a document was posted with, for a docId of the index (see data.DocIdMap)"""
+		if self.docIdMap is None: return docId
+		return self.docIdMap.externalDocId(docId)
+
+	def holdsBiword(self,termId,nextTermId):
+		"""True when every occurrence of the pair is posted under (termId,nextTermId), see documentBiwords"""
+		return termId in self.biwordTermIds or nextTermId in self.biwordTermIds
+
 	def lookupTermId(self,termId):
 		if termId in self.lexicon:
 			termId = self.lexicon[termId]
 			return data.joinUncompressedDocIdTermInstanceTableReaders([partition.lookupTermId(termId) for partition in self.partitions])
 		else:
 			return data.nullUncompressedDocIdTermInstanceTable()
+	
+	def lookupDocIds(self,termId):
+		"""returns an iterator over the ascending docIds holding termId
+		this is the first phase of evaluation, it never decodes positions"""
+		if termId in self.lexicon:
+			termId = self.lexicon[termId]
+			return data.joinDocIdReaders([partition.lookupDocIds(termId) for partition in self.partitions])
+		return iter([])
+	
+	def holdsDocIdBitmap(self,termId):
+		"""True when some partition keeps termId in the bitmap layout, i.e. termId is dense there"""
+		if termId in self.lexicon:
+			termId = self.lexicon[termId]
+			for partition in self.partitions:
+				if partition.holdsDocIdBitmap(termId): return True
+		return False
+	
+	def lookupDocIdBitmap(self,termId):
+		"""returns the docIds holding termId as a bitmap (see data.bitmapOfDocIds), None unless
+		holdsDocIdBitmap(termId). Partitions keeping termId in another layout add their docIds to it"""
+		if not self.holdsDocIdBitmap(termId): return None
+		termId = self.lexicon[termId]
+		bitmap = 0L
+		for partition in self.partitions:
+			partitionBitmap = partition.lookupDocIdBitmap(termId)
+			if partitionBitmap is None: partitionBitmap = data.bitmapOfDocIds(partition.lookupDocIds(termId))
+			bitmap |= partitionBitmap
+		return bitmap
+	
+	def lookupTermStatistics(self,termId):
+		"""returns (documentFrequency,maxTermFrequency) for termId across all partitions"""
+		documentFrequency,maxTermFrequency = 0,0
+		if termId in self.lexicon:
+			termId = self.lexicon[termId]
+			for partition in self.partitions:
+				docIdCount,maxTermInstanceCount = partition.lookupTermStatistics(termId)
+				documentFrequency += docIdCount
+				maxTermFrequency = max(maxTermFrequency,maxTermInstanceCount)
+		return (documentFrequency,maxTermFrequency)
 
 # A Test Mode
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+"""
+Direct ingest, from Reuters Corpus XML files into a ReverseIndex in one process
+
+The documents produced by analysis.ReutersCorpusParser are posted straight to
+the ReverseIndex instead of going through a .docs file. Every stage is bounded:
+the parser (or its worker processes) only runs a few tasks ahead, and post()
+blocks while the ReverseIndex ingress queues are full, so memory use does not
+depend on the size of the corpus. The alphabet is rewritten every alphabetInterval
+seconds while new termWords appear and once more at the end, so until then it can
+lack the termWords of the last alphabetInterval seconds of documents. The periodic
+rewrites run on a thread of their own from a copy of the termWords, posting goes on
+meanwhile, and one is skipped while the last is still being written.
+
+The parser context (termWords and the next termId) must carry on the termIds the
+index was built with. openParser takes them from the alphabet when there is no
+context, an index built from .docs files keeps its context where _reuters.py put it.
+"""
+import analysis
+import os
+import sys
+import termdict
+import threading
+import time
+
+def openParser(contextPath,alphabetPath):
+	"""returns the analysis.ReutersCorpusParser of an ingest, with the context at contextPath
+	or, when there is none, the termWords of the alphabet at alphabetPath if that exists"""
+	parser = analysis.ReutersCorpusParser(contextPath)
+	if not os.path.exists(contextPath) and os.path.exists(alphabetPath):
+		print >> sys.stderr, "No analysis context at %s, continuing the termIds of %s" % (contextPath,alphabetPath)
+		for termWord,termId in termdict.openAlphabet(alphabetPath).iteritems():
+			if isinstance(termWord,str): termWord = termWord.decode("utf-8")
+			parser.termWords[termWord] = termId
+			parser.nextTermId = max(parser.nextTermId,termId + 1)
+	return parser
+
+def parserCoversIndex(parser,reverseIndex):
+	"""False when reverseIndex holds termIds the parser never gave out, its termIds would then
+	be given again to other termWords and add their postings to those of the indexed ones"""
+	indexedTermIds = [termId for termId in reverseIndex.lexicon.keys() if not isinstance(termId,tuple)]
+	return not indexedTermIds or max(indexedTermIds) < parser.nextTermId
+
+def ingestFileList(parser,reverseIndex,fileList,alphabetPath,workerCount=1,alphabetInterval=30.0):
+	"""Posts the documents of fileList to reverseIndex, returns how many there were
+	workerCount != 1 parses in that many processes (None means one per CPU). The alphabet
+	and the parser context are saved every alphabetInterval seconds and once all files are read"""
+	if workerCount == 1:
+		analyzedDocuments = parser.analyzeFileList(fileList)
+	else:
+		analyzedDocuments = parser.analyzeFileListInParallel(fileList,workerCount)
+
+	def _saveAlphabet(snapshot):
+		nextTermId,termWords = snapshot
+		termdict.saveAlphabet(termWords,alphabetPath)
+		parser.saveContextSnapshot(snapshot)
+
+	documentCount = 0
+	savedTermCount = None
+	saveThread = None
+	lastSaveTime = time.time()
+	for analyzedDocument in analyzedDocuments:
+		reverseIndex.post(analyzedDocument)
+		documentCount += 1
+		if time.time() - lastSaveTime >= alphabetInterval:
+			if parser.nextTermId != savedTermCount and (saveThread is None or not saveThread.isAlive()):
+				saveThread = threading.Thread(target = _saveAlphabet,name = "AlphabetSave",args = (parser.contextSnapshot(),))
+				saveThread.setDaemon(True)
+				saveThread.start()
+				savedTermCount = parser.nextTermId
+			lastSaveTime = time.time()
+	if saveThread is not None: saveThread.join()
+	_saveAlphabet(parser.contextSnapshot())
+	print >> sys.stderr, "Ingested %d documents, %d termWords" % (documentCount,parser.nextTermId)
+	return documentCount
@@ -0,0 +1,183 @@
+"""
+Character trigram index over the sorted term dictionary
+
+Every termWord is padded with Boundary on both sides and cut into overlapping
+trigrams. The index maps each trigram to the ascending ordinals, positions in
+termWord order, of the termWords holding it, so candidates for a fuzzy or a
+substring lookup come from a few posting lists instead of the whole vocabulary.
+termWords are UTF-8 bytes here, trigrams and edit distances are over bytes.
+
+The file holds a sorted table of fixed size (trigram,offset,count) entries
+followed by the uint32 ordinal lists, and is searched in place through mmap.
+
+Fuzzy lookups of termWords with too few trigrams to bound their matches use a
+second index of the same layout, keyed by the length of a termWord (one byte,
+longer ones counted as 255) followed by one of its padded bigrams.
+"""
+import array
+import collections
+import mmap
+import struct
+import sys
+
+TrigramIndexMagic = "LEIFTG\x01\x00"
+TrigramIndexHeader = struct.Struct("<II") # termCount,trigramCount
+TrigramEntry = struct.Struct("<3sII") # trigram,offset of its ordinals,ordinal count
+LengthBigramIndexMagic = "LEIFLB\x01\x00"
+Boundary = "\x00"
+
+def termWordTrigrams(termWord):
+	"""the trigrams of termWord padded with Boundary, len(termWord) of them counting repeats"""
+	padded = Boundary + termWord + Boundary
+	return [padded[i:i + 3] for i in xrange(len(padded) - 2)]
+
+def termWordBigrams(termWord):
+	"""the bigrams of termWord padded with Boundary, len(termWord) + 1 of them counting repeats"""
+	padded = Boundary + termWord + Boundary
+	return [padded[i:i + 2] for i in xrange(len(padded) - 1)]
+
+def lengthBigramKey(length,bigram):
+	return chr(min(length,255)) + bigram
+
+def fragmentTrigrams(fragment):
+	"""the trigrams of fragment unpadded, as it can be anywhere in a termWord"""
+	return [fragment[i:i + 3] for i in xrange(len(fragment) - 2)]
+
+def buildTrigramPostings(sortedTermWords):
+	"""returns a dict trigram -> array of the ascending ordinals of the termWords holding it"""
+	trigramPostings = dict()
+	for ordinal,termWord in enumerate(sortedTermWords):
+		for trigram in set(termWordTrigrams(termWord)):
+			if trigram not in trigramPostings: trigramPostings[trigram] = array.array("I")
+			trigramPostings[trigram].append(ordinal)
+	return trigramPostings
+
+def buildLengthBigramPostings(sortedTermWords):
+	"""returns a dict lengthBigramKey -> array of the ascending ordinals of the termWords of that length holding that bigram"""
+	lengthBigramPostings = dict()
+	for ordinal,termWord in enumerate(sortedTermWords):
+		for bigram in set(termWordBigrams(termWord)):
+			key = lengthBigramKey(len(termWord),bigram)
+			if key not in lengthBigramPostings: lengthBigramPostings[key] = array.array("I")
+			lengthBigramPostings[key].append(ordinal)
+	return lengthBigramPostings
+
+def writeTrigramIndex(sortedTermWords,path,magic=TrigramIndexMagic,buildPostings=buildTrigramPostings):
+	"""writes the trigram index of sortedTermWords to path, or with LengthBigramIndexMagic and
+	buildLengthBigramPostings, their length and bigram index"""
+	trigramPostings = buildPostings(sortedTermWords)
+	trigrams = sorted(trigramPostings)
+	entries = list()
+	offset = len(magic) + TrigramIndexHeader.size + TrigramEntry.size * len(trigrams)
+	for trigram in trigrams:
+		entries.append(TrigramEntry.pack(trigram,offset,len(trigramPostings[trigram])))
+		offset += 4 * len(trigramPostings[trigram])
+
+	outputFile = open(path,"wb")
+	outputFile.write(magic)
+	outputFile.write(TrigramIndexHeader.pack(len(sortedTermWords),len(trigrams)))
+	outputFile.writelines(entries)
+	for trigram in trigrams:
+		ordinals = trigramPostings[trigram]
+		if sys.byteorder != "little": ordinals.byteswap()
+		outputFile.write(ordinals.tostring())
+	outputFile.close()
+
+class MemoryTrigramIndex(object):
+	"""A trigram index built in memory, for alphabets that have no trigram file
+	_buildPostings=buildLengthBigramPostings builds their length and bigram index instead"""
+	__slots__ = ["termCount","trigramPostings"]
+	def __init__(self,_sortedTermWords,_buildPostings=buildTrigramPostings):
+		self.termCount = len(_sortedTermWords)
+		self.trigramPostings = _buildPostings(_sortedTermWords)
+
+	def ordinals(self,trigram):
+		return self.trigramPostings.get(trigram,())
+
+class MappedTrigramIndex(object):
+	"""A trigram index file written by writeTrigramIndex, _magic tells which of the two it must be"""
+	__slots__ = ["path","buffer","magic","termCount","trigramCount"]
+	def __init__(self,_path,_magic=TrigramIndexMagic):
+		self.path = _path
+		self.magic = _magic
+		indexFile = open(_path,"rb")
+		try:
+			self.buffer = mmap.mmap(indexFile.fileno(),0,access=mmap.ACCESS_READ)
+		finally:
+			indexFile.close()
+		if self.buffer[:len(_magic)] != _magic: raise ValueError("%s is not a trigram index" % _path)
+		self.termCount,self.trigramCount = TrigramIndexHeader.unpack_from(self.buffer,len(_magic))
+
+	def _entry(self,entryIndex):
+		return TrigramEntry.unpack_from(self.buffer,len(self.magic) + TrigramIndexHeader.size + TrigramEntry.size * entryIndex)
+
+	def ordinals(self,trigram):
+		low,high = 0,self.trigramCount
+		while low < high:
+			middle = (low + high) // 2
+			entryTrigram,offset,count = self._entry(middle)
+			if entryTrigram < trigram:
+				low = middle + 1
+			elif entryTrigram > trigram:
+				high = middle
+			else:
+				return struct.unpack_from("<%dI" % count,self.buffer,offset)
+		return ()
+
+def editDistance(a,b,maxDistance):
+	"""Levenshtein distance of a and b, or maxDistance + 1 once it is known to exceed maxDistance"""
+	if abs(len(a) - len(b)) > maxDistance: return maxDistance + 1
+	previousRow = range(len(b) + 1)
+	for i in xrange(1,len(a) + 1):
+		row = [i] + [0] * len(b)
+		for j in xrange(1,len(b) + 1):
+			row[j] = min(previousRow[j] + 1,row[j - 1] + 1,previousRow[j - 1] + (a[i - 1] != b[j - 1]))
+		if min(row) > maxDistance: return maxDistance + 1
+		previousRow = row
+	return min(previousRow[-1],maxDistance + 1)
+
+def fuzzyCandidates(trigramIndex,termWord,maxDistance,maxCandidates):
+	"""returns ordinals of termWords that may be within maxDistance edits of termWord, None when the
+	trigrams cannot tell. An edit changes at most 3 trigrams, so a termWord within maxDistance shares
+	all but 3 * maxDistance of the distinct trigrams of termWord. When that bound is not positive
+	(termWords of up to about 3 * maxDistance bytes) a match may share no trigram at all, and the
+	candidates must be found some other way, see lengthBigramCandidates.
+	At most maxCandidates ordinals are returned, those sharing the most trigrams"""
+	trigrams = set(termWordTrigrams(termWord))
+	threshold = len(trigrams) - 3 * maxDistance
+	if threshold <= 0: return None
+	sharedCounts = collections.defaultdict(int)
+	for trigram in trigrams:
+		for ordinal in trigramIndex.ordinals(trigram):
+			sharedCounts[ordinal] += 1
+	candidates = [(-sharedCount,ordinal) for ordinal,sharedCount in sharedCounts.iteritems() if sharedCount >= threshold]
+	candidates.sort()
+	return [ordinal for negativeSharedCount,ordinal in candidates[:maxCandidates]]
+
+def lengthBigramCandidates(lengthBigramIndex,termWord,maxDistance,maxCandidates):
+	"""returns ordinals of termWords that may be within maxDistance edits of termWord, out of its length and
+	bigram index. Only termWords at most maxDistance longer or shorter are looked at, and an edit changes at
+	most 2 bigrams, so a match shares all but 2 * maxDistance of the distinct bigrams of termWord. Candidates
+	must share one bigram even when that bound is not positive (termWords shorter than 2 * maxDistance
+	bytes), such a termWord of n bytes then misses the matches sharing none, at least (n + 1) / 2 edits away.
+	At most maxCandidates ordinals are returned, those sharing the most bigrams"""
+	bigrams = set(termWordBigrams(termWord))
+	threshold = max(1,len(bigrams) - 2 * maxDistance)
+	keys = set([lengthBigramKey(length,bigram) for length in xrange(max(0,len(termWord) - maxDistance),len(termWord) + maxDistance + 1) for bigram in bigrams])
+	sharedCounts = collections.defaultdict(int)
+	for key in keys:
+		for ordinal in lengthBigramIndex.ordinals(key):
+			sharedCounts[ordinal] += 1
+	candidates = [(-sharedCount,ordinal) for ordinal,sharedCount in sharedCounts.iteritems() if sharedCount >= threshold]
+	candidates.sort()
+	return [ordinal for negativeSharedCount,ordinal in candidates[:maxCandidates]]
+
+def substringCandidates(trigramIndex,fragment):
+	"""returns the ascending ordinals of termWords holding every trigram of fragment, which is at least 3 long"""
+	postings = sorted([trigramIndex.ordinals(trigram) for trigram in set(fragmentTrigrams(fragment))],key=len)
+	if not postings: return []
+	candidates = set(postings[0])
+	for ordinals in postings[1:]:
+		if not candidates: break
+		candidates.intersection_update(ordinals)
+	return sorted(candidates)
@@ -0,0 +1,152 @@
+"""
+Offline optimize, every partition of a ReverseIndex merged into one ExternalPartition
+
+Geometric partitioning keeps several partitions, so a termId is looked up in each
+of them and its postings are rewritten merge after merge. An optimize writes every
+termId as a single table into the partition level the growth strategy would have
+put that many postings in, the levels below are left empty, so later updates
+merge as usual.
+
+The documents can also be renumbered 0,1,2... in an order that puts similar
+documents next to each other (clusterDocIdOrder) or in a given one
+(readDocIdOrder). Each term is then held by runs of nearby docIds, so more tables
+are dense enough for the bitmap layout (see data.isDenseDocIdList) and docId
+intersections have fewer words to combine. The docIds documents were posted with
+are kept in a data.DocIdMap of the index, and results are reported with them.
+"""
+import data
+import index
+import os
+import sys
+
+MinHashSignatureLength = 4
+_minHashPrime = 4294967311 # the least prime above 2 ** 32
+_minHashMultipliers = (2654435761,2246822519,3266489917,668265263,374761393,1181783497,3144134277,2860486313)
+
+def clusterDocIdOrder(reverseIndex,signatureLength=MinHashSignatureLength,maxDocumentFraction=0.5):
+	"""returns every docId of reverseIndex ordered so that documents sharing termIds sit together
+	Documents are sorted by a MinHash signature of their termIds, the more termIds two documents
+	share the likelier their leading minima are equal. termIds held by more than maxDocumentFraction
+	of the documents tell nothing apart and are left out, as are biwords"""
+	docIds = reverseIndex.documentLengths.docIds()
+	documentFrequencyLimit = maxDocumentFraction * len(docIds)
+	signatures = dict()
+	for termId in reverseIndex.lexicon.keys():
+		if isinstance(termId,tuple): continue
+		if reverseIndex.lookupTermStatistics(termId)[0] > documentFrequencyLimit: continue
+		termIdHashes = [(termId * multiplier + k) % _minHashPrime for k,multiplier in enumerate(_minHashMultipliers[:signatureLength])]
+		for docId in reverseIndex.lookupDocIds(termId):
+			signature = signatures.get(docId)
+			if signature is None: signatures[docId] = termIdHashes
+			else: signatures[docId] = map(min,signature,termIdHashes)
+	unsigned = [_minHashPrime] * signatureLength # documents holding only common termIds go last
+	return sorted(docIds,key=lambda docId: (signatures.get(docId,unsigned),docId))
+
+def readDocIdOrder(reverseIndex,path):
+	"""returns every docId of reverseIndex in the order of the file at path, one docId a line as the
+	documents were posted with it. Documents the file does not list follow in their current order"""
+	docIdMap = reverseIndex.docIdMap
+	listedDocIds = list()
+	seen = set()
+	for line in open(path):
+		line = line.strip()
+		if not line: continue
+		docId = int(line)
+		if docIdMap is not None: docId = docIdMap.internalDocIds.get(docId)
+		if docId is None or docId in seen or docId not in reverseIndex.documentLengths: continue
+		listedDocIds.append(docId)
+		seen.add(docId)
+	return listedDocIds + [docId for docId in reverseIndex.documentLengths.docIds() if docId not in seen]
+
+def optimizeReverseIndex(reverseIndex,docIdOrder=None):
+	"""Merges every partition of reverseIndex into one, returns (bytesBefore,bytesAfter)
+	docIdOrder, when given, lists every docId of reverseIndex in the order they are renumbered 0,1,2...
+	Nothing may be posted meanwhile. The merged partition and the empty ones below it are written at paths
+	no partition of the index is kept at, the LEX naming them (and any reassignment of docIds) is then
+	renamed into place, and only after that are the old partitions removed. A crash before the LEX is
+	renamed leaves the index as it was, one after it the optimized index and some files nothing uses"""
+	reverseIndex.writeToDisk()
+	partitions = list(reverseIndex.partitions)
+	bytesBefore = sum([partition.estimateSizeOnDisk() for partition in partitions])
+	termInstanceCount = sum([partition.termInstanceCount for partition in partitions])
+	renumber = None
+	if docIdOrder is not None:
+		if termInstanceCount and not len(reverseIndex.documentLengths):
+			raise ValueError("The index keeps no document lengths (it was built before they were kept), its docIds cannot be reassigned")
+		if sorted(docIdOrder) != reverseIndex.documentLengths.docIds(): raise ValueError("docIdOrder must list every docId of the index once")
+		renumber = dict([(docId,internalDocId) for internalDocId,docId in enumerate(docIdOrder)])
+
+	growthStrategy = reverseIndex.growthStrategy
+	mergeIntoPartitionK = 1
+	while growthStrategy.computeTermInstanceLimitForPartitionK(mergeIntoPartitionK) < termInstanceCount: mergeIntoPartitionK += 1
+	mergedName = "EXP%d" % mergeIntoPartitionK
+
+	# the optimized partitions are kept at MMP.n,EXP1.n... for the least n no partition is kept at
+	partitionPaths = [partition.path for partition in partitions]
+	n = 1
+	while 1:
+		optimizedPaths = [reverseIndex.makePartitionName("%s.%d" % (k and "EXP%d" % k or "MMP",n)) for k in xrange(mergeIntoPartitionK + 1)]
+		if not [path for path in optimizedPaths if path in partitionPaths]: break
+		n += 1
+	for optimizedPath in optimizedPaths: index.removeIndexPartitionFiles(optimizedPath)
+	optimizedPath = optimizedPaths[-1]
+	print >> sys.stderr, "Optimizing %d partitions into %s" % (len(partitions),optimizedPath)
+	termIdHash = dict()
+	wp = open(optimizedPath,"wb")
+	try:
+		for termId in sorted(reverseIndex.lexicon.values()):
+			table = data.DocIdTermInstanceTable()
+			for partition in partitions:
+				if termId not in partition: continue
+				for docIdTermInstanceVector in partition.lookupTermId(termId):
+					docId = docIdTermInstanceVector.docId
+					if renumber is not None:
+						if docId not in renumber: raise ValueError("docId %d holds postings but has no document length, the docIds of the index cannot be reassigned" % docId)
+						docId = renumber[docId]
+					for termInstance in docIdTermInstanceVector.termInstancesGenerator:
+						table.insertTermInstanceRecord(docId,termInstance)
+			if not len(table): continue
+			header,compressedData = data.compressDocIdTermInstanceTable(table)
+			header.offset = wp.tell()
+			wp.write(compressedData)
+			termIdHash[termId] = header
+	except:
+		wp.close()
+		os.unlink(optimizedPath)
+		raise
+	wp.close()
+	optimizedPartition = index.openIndexPartition(mergedName,optimizedPath,indexKey=reverseIndex.indexKey,postingsCache=reverseIndex.postingsCache)
+	optimizedPartition.termIdHash = termIdHash
+	optimizedPartition.termInstanceLimit = growthStrategy.computeTermInstanceLimitForPartitionK(mergeIntoPartitionK)
+	optimizedPartition.writeToDisk()
+
+	optimizedPartitions = list()
+	for k in xrange(mergeIntoPartitionK):
+		if k == 0: partition = index.openIndexPartition("MMP",":memory:%s" % optimizedPaths[k],indexKey=reverseIndex.indexKey,postingsCache=reverseIndex.postingsCache)
+		else:
+			open(optimizedPaths[k],"wb").close()
+			partition = index.openIndexPartition("EXP%d" % k,optimizedPaths[k],indexKey=reverseIndex.indexKey,postingsCache=reverseIndex.postingsCache)
+		partition.termInstanceLimit = growthStrategy.computeTermInstanceLimitForPartitionK(k)
+		partition.writeToDisk()
+		optimizedPartitions.append(partition)
+	optimizedPartitions.append(optimizedPartition)
+
+	if renumber is not None:
+		documentLengths = data.DocumentLengthTable()
+		for docId in docIdOrder:
+			documentLengths.setDocumentLength(renumber[docId],reverseIndex.documentLengths.getDocumentLength(docId))
+		reverseIndex.documentLengths = documentLengths
+		reverseIndex.docIdMap = data.DocIdMap([reverseIndex.externalDocId(docId) for docId in docIdOrder])
+		if reverseIndex.forwardIndex is not None: reverseIndex.forwardIndex.renumberDocIds(renumber)
+	reverseIndex.partitions = optimizedPartitions
+	reverseIndex.externalPartitionCount = mergeIntoPartitionK
+	reverseIndex.generation += 1
+	reverseIndex.writeLexiconToDisk()
+
+	for partition in partitions:
+		partition.zeroAllData()
+		index.removeIndexPartitionFiles(partition.path)
+	reverseIndex.writeToDisk()
+	bytesAfter = optimizedPartition.estimateSizeOnDisk()
+	print >> sys.stderr, "Optimized into EXP%d, %d bytes of postings from %d" % (mergeIntoPartitionK,bytesAfter,bytesBefore)
+	return (bytesBefore,bytesAfter)
@@ -1,99 +1,670 @@
-"""Functions for querying the Index using a s-expr type syntax"""
-import compiler.ast
+"""Functions for querying the Index using a s-expr type syntax
+
+A query is a parenthesised list, the first element naming the operator:
+	(And,(Term,"cat"),(Within,3,(Term,"fat"),(Term,"rat")))
+Commas are optional, whitespace separates elements just as well.
+
+Queries are parsed into nested tuples, which are then compiled into a plan
+of operator nodes. A plan can be executed any number of times."""
+import cache
 import data
+import re
 import sys
+import termdict
+import time
+
+class QuerySyntaxError(SyntaxError):
+	"""raised for any malformed query string or expression tree"""
+
+MaxFuzzyDistance = 2
+FuzzyExpansionLimit = 64 # termWords a Fuzzy expands to at most, the nearest ones
+SubstringExpansionLimit = 256 # termWords a Substring expands to at most
+
+# Tokenizer
+TOKEN_OPEN = 1
+TOKEN_CLOSE = 2
+TOKEN_NAME = 3
+TOKEN_STRING = 4
+TOKEN_INTEGER = 5
+
+_tokenPattern = re.compile(r"""
+	(?P<space>[\s,]+)|
+	(?P<open>\()|
+	(?P<close>\))|
+	(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+	(?P<integer>-?\d+)|
+	(?P<name>[A-Za-z_]\w*)""",re.VERBOSE)
+
+def tokenizeQueryString(inputString):
+	"""Generates (tokenType,value) pairs from inputString"""
+	position = 0
+	_match = _tokenPattern.match
+	while position < len(inputString):
+		match = _match(inputString,position)
+		if match is None: raise QuerySyntaxError("Unexpected character %s at offset %d" % (repr(inputString[position]),position))
+		position = match.end()
+		kind = match.lastgroup
+		if kind == "space": continue
+		elif kind == "open": yield (TOKEN_OPEN,None)
+		elif kind == "close": yield (TOKEN_CLOSE,None)
+		elif kind == "name": yield (TOKEN_NAME,match.group(kind))
+		elif kind == "integer": yield (TOKEN_INTEGER,int(match.group(kind)))
+		elif kind == "string":
+			value = match.group(kind)[1:-1]
+			if "\\" in value: value = value.decode("string_escape")
+			yield (TOKEN_STRING,value)
 
 def getExpressionTreeFromString(inputString):
-	ast = compiler.parse(inputString)
-	if isinstance(ast,compiler.ast.Module):
-		docString,statement = ast
-		for node in statement.nodes:
-			# Discard is the expression type in compiler
-			if isinstance(node,compiler.ast.Discard):
-				return node.expr
-	
-	return None
-
-def makeInitialEnvironmentFromLookupFunction(lookupFunction):
-	"""lookupFunction takes a termWord as input and returns a [DocIdTermInstanceVector]"""
+	"""Parse inputString into nested tuples: (OperatorName,operand,...)
+	operands are strings, integers or nested tuples
+	returns None for an empty query"""
+	tokens = list(tokenizeQueryString(inputString))
+	if not tokens: return None
+	expressionTree,nextToken = _parseExpression(tokens,0)
+	if nextToken != len(tokens): raise QuerySyntaxError("Unexpected input after the end of the query")
+	return expressionTree
+
+def _parseExpression(tokens,tokenIndex):
+	"""returns (expressionTree,index of the token following the expression)"""
+	tokenType,value = tokens[tokenIndex]
+	if tokenType != TOKEN_OPEN: raise QuerySyntaxError("Query expressions must start with '('")
+	tokenIndex += 1
+	if tokenIndex == len(tokens) or tokens[tokenIndex][0] != TOKEN_NAME: raise QuerySyntaxError("Expected an operator name after '('")
+	expression = [tokens[tokenIndex][1]]
+	tokenIndex += 1
+	while tokenIndex < len(tokens):
+		tokenType,value = tokens[tokenIndex]
+		if tokenType == TOKEN_CLOSE:
+			return (tuple(expression),tokenIndex + 1)
+		elif tokenType == TOKEN_OPEN:
+			subExpression,tokenIndex = _parseExpression(tokens,tokenIndex)
+			expression.append(subExpression)
+		elif tokenType in (TOKEN_STRING,TOKEN_INTEGER):
+			expression.append(value)
+			tokenIndex += 1
+		else:
+			raise QuerySyntaxError("Unexpected name %s, operands must be quoted" % value)
+
+	raise QuerySyntaxError("Missing ')' at the end of the query")
+
+commutativeOperators = ("And","Or")
+
+def canonicalExpressionTree(expressionTree):
+	"""returns the form expressionTree is cached under, None for what is not an expression tree
+	Parsing already removed any syntactic variation (spacing, quoting, optional commas). The
+	operands of And and Or, and those Andnot takes away from its first, are sorted and repeats
+	are dropped, an And or Or operand of the same operator is flattened into its parent, as is
+	the first operand of an Andnot that is an Andnot. Positional operators keep their order"""
+	if not isinstance(expressionTree,tuple) or not expressionTree: return None
+	rator,rands = expressionTree[0],[canonicalExpressionTree(rand) if isinstance(rand,tuple) else rand for rand in expressionTree[1:]]
+	if rator in commutativeOperators:
+		flattenedRands = list()
+		for rand in rands:
+			if isinstance(rand,tuple) and rand and rand[0] == rator: flattenedRands.extend(rand[1:])
+			else: flattenedRands.append(rand)
+		return (rator,) + tuple(sorted(set(flattenedRands)))
+	if rator == "Andnot" and rands:
+		firstRand,subtractedRands = rands[0],rands[1:]
+		if isinstance(firstRand,tuple) and firstRand and firstRand[0] == "Andnot":
+			firstRand,subtractedRands = firstRand[1],list(firstRand[2:]) + subtractedRands
+		return (rator,firstRand) + tuple(sorted(set(subtractedRands)))
+	return (rator,) + tuple(rands)
+
+def collectTermWords(expressionTree):
+	"""returns the termWords of every Term and Phrase in expressionTree, in query order"""
+	termWords = list()
+	if isinstance(expressionTree,tuple) and expressionTree:
+		if expressionTree[0] in ("Term","Phrase"):
+			termWords.extend([rand for rand in expressionTree[1:] if isinstance(rand,basestring)])
+		else:
+			for rand in expressionTree[1:]:
+				termWords.extend(collectTermWords(rand))
+	return termWords
+
+def collectTermExpansions(expressionTree):
+	"""returns the TermExpansionPlan of every Prefix, Range, Fuzzy and Substring in expressionTree, in query order"""
+	termExpansionPlans = list()
+	if isinstance(expressionTree,tuple) and expressionTree:
+		if expressionTree[0] in termExpansionOperators:
+			termExpansionPlans.append(compileExpressionTree(expressionTree))
+		else:
+			for rand in expressionTree[1:]:
+				termExpansionPlans.extend(collectTermExpansions(rand))
+	return termExpansionPlans
+
+def makeInitialEnvironmentFromLookupFunction(lookupFunction,docIdLookupFunction=None,documentFrequencyFunction=None,termWords=None,biwordLookupFunction=None,docIdBitmapFunction=None,holdsDocIdBitmapFunction=None):
+	"""lookupFunction takes a termWord as input and returns a [DocIdTermInstanceVector]
+	docIdLookupFunction, if given, takes a termWord and returns its ascending docIds
+	documentFrequencyFunction, if given, takes a termWord and returns how many docIds hold it
+	both default to walking the output of lookupFunction
+	termWords, if given, is the alphabet (a termdict.TermDictionary or a dict) that Prefix,
+	Range, Fuzzy and Substring expand against, without it they expand to nothing
+	biwordLookupFunction, if given, takes two termWords and returns the matches of the pair at
+	the position of the first, or None when the pair is not in a biword index
+	docIdBitmapFunction and holdsDocIdBitmapFunction, if given, take a termWord and return its docIds
+	as a bitmap (see data.bitmapOfDocIds), and whether it has one, for the termWords stored dense"""
 	class EnvironmentBase(object):
-		__slots__ = ["lookupFunction"]
-		def __init__(self,_lookupFunction): self.lookupFunction = _lookupFunction 
+		__slots__ = ["lookupFunction","docIdLookupFunction","documentFrequencyFunction","termWords","biwordLookupFunction","docIdBitmapFunction","holdsDocIdBitmapFunction"]
+		def __init__(self,_lookupFunction,_docIdLookupFunction,_documentFrequencyFunction,_termWords,_biwordLookupFunction,_docIdBitmapFunction,_holdsDocIdBitmapFunction):
+			self.lookupFunction = _lookupFunction
+			self.docIdLookupFunction = _docIdLookupFunction
+			self.documentFrequencyFunction = _documentFrequencyFunction
+			self.termWords = _termWords
+			self.biwordLookupFunction = _biwordLookupFunction
+			self.docIdBitmapFunction = _docIdBitmapFunction
+			self.holdsDocIdBitmapFunction = _holdsDocIdBitmapFunction
 		def __contains__(self,termWord): return True
 		def __getitem__(self,termWord): return self.lookupFunction(termWord)
-	
-	return [EnvironmentBase(lookupFunction)]
+		def lookupDocIds(self,termWord):
+			if self.docIdLookupFunction is None: return (computedMatch.docId for computedMatch in self.lookupFunction(termWord))
+			return self.docIdLookupFunction(termWord)
+		def documentFrequency(self,termWord):
+			if self.documentFrequencyFunction is None: return sum(1 for docId in self.lookupDocIds(termWord))
+			return self.documentFrequencyFunction(termWord)
+		def lookupBiword(self,termWord,nextTermWord):
+			if self.biwordLookupFunction is None: return None
+			return self.biwordLookupFunction(termWord,nextTermWord)
+		def holdsDocIdBitmap(self,termWord):
+			return self.holdsDocIdBitmapFunction is not None and self.holdsDocIdBitmapFunction(termWord)
+		def lookupDocIdBitmap(self,termWord):
+			if self.docIdBitmapFunction is None: return None
+			return self.docIdBitmapFunction(termWord)
 
-def reduceTopLevel(expressionTree,initialEnvironment):
-	"""initialEnvironment must be a list"""
-	if isinstance(expressionTree,compiler.ast.Tuple):
-		rator,rands = expressionTree.nodes[0],expressionTree.nodes[1:]
-		if isinstance(rator,compiler.ast.Name):
-			rator = rator.name
-			# Dispatch on rator
-			if rator == "Term":
-				return reduceTerm(rands,initialEnvironment)
-			elif rator == "Or":
-				return reduceOrOp(rands,initialEnvironment)
-			elif rator == "And":
-				return reduceAndOp(rands,initialEnvironment)
-			elif rator == "Andnot":
-				return reduceAndnotOp(rands,initialEnvironment)
-			elif rator == "Before":
-				return reduceBeforeOp(rands,initialEnvironment)
-			elif rator == "After":
-				return reduceAfterOp(rands,initialEnvironment)
-			elif rator == "Minoc":
-				return reduceMinocOp(rands,initialEnvironment)
-			elif rator == "Within":
-				return reduceWithinOp(rands,initialEnvironment)
-			elif rator == "Scope":
-				return reduceScopeOp(rands,initialEnvironment)
-	
-	return None
-
-def reduceTerm(termConstant,environmentFrames):
-	termConstant = termConstant[0]
-	if isinstance(termConstant,compiler.ast.Const):
-		term = termConstant.value
+	return [EnvironmentBase(lookupFunction,docIdLookupFunction,documentFrequencyFunction,termWords,biwordLookupFunction,docIdBitmapFunction,holdsDocIdBitmapFunction)]
+
+def makeInitialEnvironmentFromReverseIndex(reverseIndex,termWords):
+	"""Environment resolving termWords, through the alphabet termWords, against reverseIndex
+	Matches are built lazily, positions are only decoded when something asks for them"""
+	def computedMatchGenerator(termId):
+		"""termId can also be a biword, a (termId,nextTermId) pair"""
+		budget = data.activeQueryBudget()
+		for docIdTermInstanceVector in reverseIndex.lookupTermId(termId):
+			if docIdTermInstanceVector.docId is not None:
+				if budget is not None: budget.chargePostings()
+				termInstancesFunction = lambda termInstancesGenerator=docIdTermInstanceVector.termInstancesGenerator: _decodeTermInstances(termInstancesGenerator,budget)
+				yield data.ComputedMatch(docIdTermInstanceVector.docId,_termInstanceVectorsFunction=termInstancesFunction)
+	def lookupFunction(termWord):
+		if termWord in termWords: return data.ComputedMatchVector(computedMatchGenerator(termWords[termWord]))
+		return data.ComputedMatchVector(iter([]))
+	def biwordLookupFunction(termWord,nextTermWord):
+		if termWord in termWords and nextTermWord in termWords:
+			biword = (termWords[termWord],termWords[nextTermWord])
+			if reverseIndex.holdsBiword(*biword): return data.ComputedMatchVector(computedMatchGenerator(biword))
+		return None
+	def docIdLookupFunction(termWord):
+		if termWord in termWords:
+			budget = data.activeQueryBudget()
+			if budget is not None: return budget.chargedIterator(reverseIndex.lookupDocIds(termWords[termWord]),budget.chargePostings)
+			return reverseIndex.lookupDocIds(termWords[termWord])
+		return iter([])
+	def documentFrequencyFunction(termWord):
+		if termWord in termWords: return reverseIndex.lookupTermStatistics(termWords[termWord])[0]
+		return 0
+	def docIdBitmapFunction(termWord):
+		if termWord in termWords:
+			budget = data.activeQueryBudget()
+			if budget is not None: budget.chargePostings(reverseIndex.lookupTermStatistics(termWords[termWord])[0])
+			return reverseIndex.lookupDocIdBitmap(termWords[termWord])
+		return None
+	def holdsDocIdBitmapFunction(termWord):
+		return termWord in termWords and reverseIndex.holdsDocIdBitmap(termWords[termWord])
+
+	return makeInitialEnvironmentFromLookupFunction(lookupFunction,docIdLookupFunction,documentFrequencyFunction,termWords,biwordLookupFunction,docIdBitmapFunction,holdsDocIdBitmapFunction)
+
+def _decodeTermInstances(termInstancesGenerator,budget):
+	"""positions are charged to budget only while it is being enforced, matches
+	realized later on by whoever consumes the result are not the query's work"""
+	termInstances = list(termInstancesGenerator)
+	if budget is not None and data.activeQueryBudget() is budget: budget.chargePostings(len(termInstances))
+	return termInstances
+
+# Query plans
+class TermPlan(object):
+	"""Looks up termWord in the first environment frame holding it"""
+	__slots__ = ["termWord"]
+	def __init__(self,_termWord):
+		self.termWord = _termWord
+
+	def _environmentFrame(self,environmentFrames):
 		for environmentFrame in environmentFrames:
-			if term in environmentFrame: return environmentFrame[term]
-	
-	return None
-
-def reduceSimpleOperator(opcode,expressionTree,environmentFrames):
-	op = data.computedMatchVectorOp(opcode)
-	return op(*[reduceTopLevel(expression,environmentFrames) for expression in expressionTree])
-
-def reduceAndOp(expressionTree,environmentFrames): return reduceSimpleOperator(data.OP_AND,expressionTree,environmentFrames)
-def reduceOrOp(expressionTree,environmentFrames): return reduceSimpleOperator(data.OP_OR,expressionTree,environmentFrames)
-def reduceAndnotOp(expressionTree,environmentFrames): return reduceSimpleOperator(data.OP_ANDNOT,expressionTree,environmentFrames)
-def reduceBeforeOp(expressionTree,environmentFrames): return reduceSimpleOperator(data.OP_BEFORE,expressionTree,environmentFrames)
-def reduceAfterOp(expressionTree,environmentFrames): return reduceSimpleOperator(data.OP_AFTER,expressionTree,environmentFrames)
-
-def reduceMinocOp(expressionTree,environmentFrames):
-	count,expressionTree = expressionTree[0],expressionTree[1:]
-	if isinstance(count,compiler.ast.Const):
-		count = count.value
-		op = data.computedMatchVectorOp(data.OP_MINOC)
-		return op(count,*[reduceTopLevel(expression,environmentFrames) for expression in expressionTree])
-	
-	return None
-
-def reduceWithinOp(expressionTree,environmentFrames):
-	count,expressionTree = expressionTree[0],expressionTree[1:]
-	if isinstance(count,compiler.ast.Const):
-		count = count.value
-		op = data.computedMatchVectorOp(data.OP_WITHIN)
-		return op(count,*[reduceTopLevel(expression,environmentFrames) for expression in expressionTree])
-	
-	return None
-
-def reduceScopeOp(expressionTree,environmentFrames):
-	if len(expressionTree) > 2: raise ValueError("Scope operator takes exactly two arguments")
-	scope,scoped = expressionTree[0],expressionTree[1]
-	scopeRator,scopeRand = scope.nodes[0],scope.nodes[1:]
-	scopedRator,scopedRand = scoped.nodes[0],scoped.nodes[1:]
-	if not (scopeRator.name == scopedRator.name == "Term"): raise ValueError("Scope arguments must be Terms")
-	op = data.computedMatchVectorOp(data.OP_SCOPE)
-	return op(reduceTerm(scopeRand,environmentFrames),reduceTerm(scopedRand,environmentFrames))
+			if self.termWord in environmentFrame: return environmentFrame
+		return None
+
+	def execute(self,environmentFrames):
+		environmentFrame = self._environmentFrame(environmentFrames)
+		if environmentFrame is None: return None
+		return environmentFrame[self.termWord]
+
+	def docIds(self,environmentFrames):
+		environmentFrame = self._environmentFrame(environmentFrames)
+		if environmentFrame is None: return iter([])
+		return environmentFrame.lookupDocIds(self.termWord)
+
+	def count(self,environmentFrames):
+		"""answered by the environment, i.e. straight from the partition headers"""
+		environmentFrame = self._environmentFrame(environmentFrames)
+		if environmentFrame is None: return 0
+		return environmentFrame.documentFrequency(self.termWord)
+
+	def holdsDocIdBitmap(self,environmentFrames):
+		"""True when the docIds of termWord are stored dense, see docIdBitmap"""
+		environmentFrame = self._environmentFrame(environmentFrames)
+		return environmentFrame is not None and environmentFrame.holdsDocIdBitmap(self.termWord)
+
+	def docIdBitmap(self,environmentFrames):
+		"""the docIds as a bitmap (see data.bitmapOfDocIds), None unless holdsDocIdBitmap()"""
+		environmentFrame = self._environmentFrame(environmentFrames)
+		if environmentFrame is None: return None
+		return environmentFrame.lookupDocIdBitmap(self.termWord)
+
+	def __repr__(self): return "(Term,%s)" % repr(self.termWord)
+
+class TermExpansionPlan(object):
+	"""Expands to a set of termWords and unions their postings, the way Or does
+	The expansion is made against the alphabet of the first environment frame having one,
+	every time the plan runs, so a prepared query also finds termWords added later on.
+	Each subclass defines expand(termWords), the termWords of that alphabet the plan stands for"""
+	__slots__ = ["rator","constantArguments"]
+	def __init__(self,_rator,_constantArguments):
+		self.rator = _rator
+		self.constantArguments = _constantArguments
+
+	def termPlans(self,environmentFrames):
+		for environmentFrame in environmentFrames:
+			if environmentFrame.termWords is not None: return map(TermPlan,self.expand(environmentFrame.termWords))
+		return []
+
+	def execute(self,environmentFrames):
+		computedMatchVectors = [termPlan.execute(environmentFrames) for termPlan in self.termPlans(environmentFrames)]
+		return data.computedMatchVectorOrOp(*[computedMatchVector for computedMatchVector in computedMatchVectors if computedMatchVector is not None])
+
+	def docIds(self,environmentFrames):
+		return data.docIdUnion(*[termPlan.docIds(environmentFrames) for termPlan in self.termPlans(environmentFrames)])
+
+	def count(self,environmentFrames):
+		return sum(1 for docId in self.docIds(environmentFrames))
+
+	def holdsDocIdBitmap(self,environmentFrames): return False
+	def docIdBitmap(self,environmentFrames): return None
+
+	def __repr__(self):
+		return "(%s)" % ",".join([self.rator] + map(repr,self.constantArguments))
+
+class TermRangePlan(TermExpansionPlan):
+	"""The termWords from low up to (not including) high, either can be None"""
+	__slots__ = ["low","high"]
+	def __init__(self,_rator,_constantArguments,_low,_high):
+		TermExpansionPlan.__init__(self,_rator,_constantArguments)
+		self.low = _low
+		self.high = _high
+
+	def expand(self,termWords):
+		return termdict.termWordsInRange(termWords,self.low,self.high)
+
+class FuzzyPlan(TermExpansionPlan):
+	"""The FuzzyExpansionLimit termWords nearest to termWord, within maxDistance edits"""
+	__slots__ = ["termWord","maxDistance"]
+	def __init__(self,_rator,_constantArguments,_termWord,_maxDistance):
+		TermExpansionPlan.__init__(self,_rator,_constantArguments)
+		self.termWord = _termWord
+		self.maxDistance = _maxDistance
+
+	def expand(self,termWords):
+		return termdict.termWordsNear(termWords,self.termWord,self.maxDistance,FuzzyExpansionLimit)
+
+class SubstringPlan(TermExpansionPlan):
+	"""The first SubstringExpansionLimit termWords, in termWord order, holding fragment"""
+	__slots__ = ["fragment"]
+	def __init__(self,_rator,_constantArguments,_fragment):
+		TermExpansionPlan.__init__(self,_rator,_constantArguments)
+		self.fragment = _fragment
+
+	def expand(self,termWords):
+		return termdict.termWordsContaining(termWords,self.fragment,SubstringExpansionLimit)
+
+class PhrasePlan(object):
+	"""Matches termWords at consecutive positions, element names are not words
+	Every adjacent pair the environment holds in a biword index is read from there, one posting
+	per occurrence of the pair, and only the termWords no such pair covers are read from their
+	Term postings. Without a biword index the phrase is matched from the positions of its Terms"""
+	__slots__ = ["rator","constantArguments","termWords"]
+	def __init__(self,_rator,_termWords):
+		self.rator = _rator
+		self.constantArguments = list(_termWords)
+		self.termWords = _termWords
+
+	def _environmentFrame(self,environmentFrames):
+		for environmentFrame in environmentFrames:
+			if False not in [termWord in environmentFrame for termWord in self.termWords]: return environmentFrame
+		return None
+
+	def execute(self,environmentFrames):
+		environmentFrame = self._environmentFrame(environmentFrames)
+		if environmentFrame is None: return None
+		offsets = list()
+		computedMatchVectors = list()
+		coveredOffsets = set()
+		for offset in xrange(len(self.termWords) - 1):
+			biwordMatchVector = environmentFrame.lookupBiword(self.termWords[offset],self.termWords[offset + 1])
+			if biwordMatchVector is not None:
+				offsets.append(offset)
+				computedMatchVectors.append(biwordMatchVector)
+				coveredOffsets.update((offset,offset + 1))
+		for offset,termWord in enumerate(self.termWords):
+			if offset not in coveredOffsets:
+				offsets.append(offset)
+				computedMatchVectors.append(environmentFrame[termWord])
+		return data.computedMatchVectorPhraseOp(len(self.termWords),offsets,*computedMatchVectors)
+
+	def docIds(self,environmentFrames):
+		computedMatchVector = self.execute(environmentFrames)
+		if computedMatchVector is None: return iter([])
+		return (computedMatch.docId for computedMatch in computedMatchVector)
+
+	def count(self,environmentFrames):
+		return sum(1 for docId in self.docIds(environmentFrames))
+
+	def holdsDocIdBitmap(self,environmentFrames): return False
+	def docIdBitmap(self,environmentFrames): return None
+
+	def __repr__(self):
+		return "(%s)" % ",".join([self.rator] + map(repr,self.constantArguments))
+
+class OperatorPlan(object):
+	"""Applies a data.computedMatchVector*Op to the output of its operand plans
+	constantArguments (e.g. the Within distance) are passed ahead of the operands
+	Boolean operators also have a docIdOperator, which needs only the docIds of the operands,
+	and a docIdBitmapOperator, which combines the bitmaps of operands stored dense word at a time"""
+	__slots__ = ["rator","opcode","operator","docIdOperator","docIdBitmapOperator","constantArguments","operandPlans"]
+	def __init__(self,_rator,_opcode,_constantArguments,_operandPlans):
+		self.rator = _rator
+		self.opcode = _opcode
+		self.operator = data.computedMatchVectorOp(_opcode)
+		self.docIdOperator = data.docIdOp(_opcode)
+		self.docIdBitmapOperator = data.docIdBitmapOp(_opcode)
+		self.constantArguments = _constantArguments
+		self.operandPlans = _operandPlans
+
+	def execute(self,environmentFrames):
+		operands = [operandPlan.execute(environmentFrames) for operandPlan in self.operandPlans]
+		return self.operator(*(self.constantArguments + operands))
+
+	def docIds(self,environmentFrames):
+		if self.docIdOperator is None:
+			# positional operators need positions, so fall back to the full evaluation
+			return (computedMatch.docId for computedMatch in self.execute(environmentFrames))
+		denseOperands = [operandPlan.holdsDocIdBitmap(environmentFrames) for operandPlan in self.operandPlans]
+		if False not in denseOperands: return data.docIdsOfBitmap(self.docIdBitmap(environmentFrames))
+		if self.opcode in (data.OP_AND,data.OP_OR) and denseOperands.count(True) > 1:
+			# the dense operands are combined as bitmaps first, then merged with the others
+			bitmaps = [operandPlan.docIdBitmap(environmentFrames) for operandPlan,isDense in zip(self.operandPlans,denseOperands) if isDense]
+			docIdIterables = [operandPlan.docIds(environmentFrames) for operandPlan,isDense in zip(self.operandPlans,denseOperands) if not isDense]
+			return self.docIdOperator(data.docIdsOfBitmap(self.docIdBitmapOperator(*bitmaps)),*docIdIterables)
+		return self.docIdOperator(*[operandPlan.docIds(environmentFrames) for operandPlan in self.operandPlans])
+
+	def count(self,environmentFrames):
+		if self.holdsDocIdBitmap(environmentFrames): return data.countOfBitmap(self.docIdBitmap(environmentFrames))
+		return sum(1 for docId in self.docIds(environmentFrames))
+
+	def holdsDocIdBitmap(self,environmentFrames):
+		"""True for a boolean node whose operands all have a bitmap, see docIdBitmap"""
+		if self.docIdBitmapOperator is None: return False
+		for operandPlan in self.operandPlans:
+			if not operandPlan.holdsDocIdBitmap(environmentFrames): return False
+		return True
+
+	def docIdBitmap(self,environmentFrames):
+		if not self.holdsDocIdBitmap(environmentFrames): return None
+		return self.docIdBitmapOperator(*[operandPlan.docIdBitmap(environmentFrames) for operandPlan in self.operandPlans])
+
+	def withOperandPlans(self,operandPlans):
+		"""a copy of this node applied to operandPlans instead"""
+		return OperatorPlan(self.rator,self.opcode,self.constantArguments,operandPlans)
+
+	def __repr__(self):
+		return "(%s)" % ",".join([self.rator] + map(repr,self.constantArguments) + map(repr,self.operandPlans))
+
+class AnalyzedPlan(object):
+	"""Wraps a plan node for EXPLAIN ANALYZE
+	Counts the matches (or docIds) the node produces, the time spent producing them, which
+	includes the time of its operands, and the partition reads made while the node is running
+	Plans are only wrapped when asked for an analysis, so unanalyzed queries pay nothing"""
+	__slots__ = ["plan","operandPlans","rowsOut","seconds","readStatistics"]
+	def __init__(self,_plan):
+		self.operandPlans = [AnalyzedPlan(operandPlan) for operandPlan in getattr(_plan,"operandPlans",[])]
+		if isinstance(_plan,OperatorPlan): _plan = _plan.withOperandPlans(self.operandPlans)
+		self.plan = _plan
+		self.rowsOut = 0
+		self.seconds = 0.0
+		self.readStatistics = data.ReadStatistics()
+
+	def execute(self,environmentFrames):
+		computedMatchVector = self._measure(lambda: self.plan.execute(environmentFrames))
+		if computedMatchVector is None: return None
+		return data.ComputedMatchVector(self._measuredIterator(computedMatchVector))
+
+	def docIds(self,environmentFrames):
+		return self._measuredIterator(self._measure(lambda: self.plan.docIds(environmentFrames)))
+
+	def count(self,environmentFrames):
+		return sum(1 for docId in self.docIds(environmentFrames))
+
+	def holdsDocIdBitmap(self,environmentFrames):
+		return self.plan.holdsDocIdBitmap(environmentFrames)
+
+	def docIdBitmap(self,environmentFrames):
+		bitmap = self._measure(lambda: self.plan.docIdBitmap(environmentFrames))
+		if bitmap is not None: self.rowsOut += data.countOfBitmap(bitmap)
+		return bitmap
+
+	def _measure(self,function):
+		startTime = time.time()
+		try:
+			return data.withReadStatistics(self.readStatistics,function)
+		finally:
+			self.seconds += time.time() - startTime
+
+	def _measuredIterator(self,iterable):
+		iterator = self._measure(lambda: iter(iterable))
+		while 1:
+			try:
+				item = self._measure(iterator.next)
+			except StopIteration:
+				return
+			self.rowsOut += 1
+			yield item
+
+	@property
+	def rowsIn(self):
+		"""what the operands produced, for a Term (or an expansion of Terms) the postings it read"""
+		if isinstance(self.plan,(TermPlan,TermExpansionPlan,PhrasePlan)):
+			return sum([partitionReadStatistics.postings for partitionReadStatistics in self.readStatistics.partitionReadStatistics.values()])
+		return sum([operandPlan.rowsOut for operandPlan in self.operandPlans])
+
+	@property
+	def selfSeconds(self):
+		return self.seconds - sum([operandPlan.seconds for operandPlan in self.operandPlans])
+
+	def format(self,depth=0):
+		"""returns the annotated plan tree as a list of lines, each node is followed by the partitions it read"""
+		indent = "  " * depth
+		if isinstance(self.plan,TermPlan): label = repr(self.plan)
+		else: label = "(%s)" % ",".join([self.plan.rator] + map(repr,self.plan.constantArguments))
+		lines = ["%s%s rows in=%d out=%d time=%.3fms self=%.3fms" % (indent,label,self.rowsIn,self.rowsOut,self.seconds * 1000.0,self.selfSeconds * 1000.0)]
+		for partitionName,partitionReadStatistics in sorted(self.readStatistics.partitionReadStatistics.items()):
+			lines.append("%s  | %s %s" % (indent,partitionName,repr(partitionReadStatistics)))
+		for operandPlan in self.operandPlans:
+			lines += operandPlan.format(depth + 1)
+		return lines
+
+	def __repr__(self): return "#AP:%s" % repr(self.plan)
+
+class PreparedQuery(object):
+	"""A compiled query, execute() can be called repeatedly with different environments"""
+	__slots__ = ["expressionTree","plan"]
+	def __init__(self,_expressionTree):
+		self.expressionTree = _expressionTree
+		self.plan = compileExpressionTree(_expressionTree)
+
+	def execute(self,initialEnvironment,budget=None):
+		"""initialEnvironment must be a list
+		With a data.QueryBudget the result ends early once the budget runs out, budget.exceeded
+		then tells that the matches seen are only a partial result"""
+		if budget is None: return self.plan.execute(initialEnvironment)
+		budget.start()
+		return data.ComputedMatchVector(data.budgetedIterator(lambda: self.plan.execute(initialEnvironment),budget))
+
+	def count(self,initialEnvironment,budget=None):
+		"""returns the number of matching docIds, without building any ComputedMatch for boolean queries
+		With a budget that runs out this is the count so far, see budget.exceeded"""
+		if budget is None or isinstance(self.plan,TermPlan): return self.plan.count(initialEnvironment)
+		budget.start()
+		return sum(1 for docId in data.budgetedIterator(lambda: self.plan.docIds(initialEnvironment),budget))
+
+	def exists(self,initialEnvironment,budget=None):
+		"""True as soon as one docId matches, False when none does or the budget runs out first"""
+		if budget is None:
+			docIds = self.plan.docIds(initialEnvironment)
+		else:
+			budget.start()
+			docIds = data.budgetedIterator(lambda: self.plan.docIds(initialEnvironment),budget)
+		for docId in docIds: return True
+		return False
+
+	def explainAnalyze(self,initialEnvironment,mode="matches",budget=None):
+		"""Evaluates the query to completion with every node instrumented, returns the AnalyzedPlan
+		mode "matches" runs execute(), "count" the docId only evaluation of count() and exists()
+		Positions are only counted where an operator decodes them, not those a consumer of
+		the matches would decode later. With a budget the evaluation stops once it runs out,
+		the plan then tells the work done so far, see budget.exceeded"""
+		analyzedPlan = AnalyzedPlan(self.plan)
+		if mode == "count":
+			evaluate = lambda: analyzedPlan.docIds(initialEnvironment)
+		else:
+			evaluate = lambda: analyzedPlan.execute(initialEnvironment) or []
+		if budget is None:
+			rows = evaluate()
+		else:
+			budget.start()
+			rows = data.budgetedIterator(evaluate,budget)
+		for row in rows: pass
+		return analyzedPlan
+
+	def __repr__(self): return "#PQ:%s" % repr(self.plan)
+
+def prepareQuery(queryString):
+	"""Parse and compile queryString, returns None for an empty query"""
+	expressionTree = getExpressionTreeFromString(queryString)
+	if expressionTree is None: return None
+	return PreparedQuery(expressionTree)
+
+def compileExpressionTree(expressionTree):
+	if not isinstance(expressionTree,tuple) or not expressionTree:
+		raise QuerySyntaxError("Expected an operator expression, found %s" % repr(expressionTree))
+	rator,rands = expressionTree[0],expressionTree[1:]
+	if rator not in operatorCompilers: raise QuerySyntaxError("Unknown operator %s" % rator)
+	return operatorCompilers[rator](rator,rands)
+
+def compileTerm(rator,rands):
+	if len(rands) != 1 or not isinstance(rands[0],basestring): raise QuerySyntaxError("Term takes exactly one quoted term")
+	return TermPlan(rands[0])
+
+def compilePrefix(rator,rands):
+	if len(rands) != 1 or not isinstance(rands[0],basestring) or not rands[0]: raise QuerySyntaxError("Prefix takes exactly one non-empty quoted prefix")
+	return TermRangePlan(rator,[rands[0]],rands[0],termdict.prefixUpperBound(rands[0]))
+
+def compileRange(rator,rands):
+	if len(rands) != 2 or not (isinstance(rands[0],basestring) and isinstance(rands[1],basestring)): raise QuerySyntaxError("Range takes two quoted terms, the first included and the second not")
+	return TermRangePlan(rator,list(rands),rands[0],rands[1])
+
+def compileFuzzy(rator,rands):
+	if len(rands) != 2 or not isinstance(rands[0],(int,long)) or not isinstance(rands[1],basestring): raise QuerySyntaxError("Fuzzy takes an edit distance and a quoted term")
+	if not 0 <= rands[0] <= MaxFuzzyDistance: raise QuerySyntaxError("Fuzzy edit distance must be from 0 to %d" % MaxFuzzyDistance)
+	return FuzzyPlan(rator,list(rands),rands[1],rands[0])
+
+def compileSubstring(rator,rands):
+	if len(rands) != 1 or not isinstance(rands[0],basestring) or len(rands[0]) < 3: raise QuerySyntaxError("Substring takes one quoted fragment of at least 3 characters")
+	return SubstringPlan(rator,[rands[0]],rands[0])
+
+def compilePhrase(rator,rands):
+	if len(rands) < 2 or False in [isinstance(rand,basestring) for rand in rands]: raise QuerySyntaxError("Phrase takes two or more quoted terms")
+	return PhrasePlan(rator,list(rands))
+
+def compileSimpleOperator(opcode):
+	def _compile(rator,rands):
+		return OperatorPlan(rator,opcode,[],map(compileExpressionTree,rands))
+	return _compile
+
+def compileCountedOperator(opcode):
+	"""for operators taking an integer ahead of their operands, i.e. Minoc and Within"""
+	def _compile(rator,rands):
+		if not rands or not isinstance(rands[0],(int,long)): raise QuerySyntaxError("%s takes an integer as its first operand" % rator)
+		return OperatorPlan(rator,opcode,[rands[0]],map(compileExpressionTree,rands[1:]))
+	return _compile
+
+def compileScopeOp(rator,rands):
+	if len(rands) != 2: raise QuerySyntaxError("Scope operator takes exactly two arguments")
+	operandPlans = map(compileExpressionTree,rands)
+	if not (isinstance(operandPlans[0],TermPlan) and isinstance(operandPlans[1],TermPlan)): raise QuerySyntaxError("Scope arguments must be Terms")
+	return OperatorPlan(rator,data.OP_SCOPE,[],operandPlans)
+
+operatorCompilers = {
+	"Term": compileTerm,
+	"Prefix": compilePrefix,
+	"Range": compileRange,
+	"Fuzzy": compileFuzzy,
+	"Substring": compileSubstring,
+	"Phrase": compilePhrase,
+	"Or": compileSimpleOperator(data.OP_OR),
+	"And": compileSimpleOperator(data.OP_AND),
+	"Andnot": compileSimpleOperator(data.OP_ANDNOT),
+	"Before": compileSimpleOperator(data.OP_BEFORE),
+	"After": compileSimpleOperator(data.OP_AFTER),
+	"Minoc": compileCountedOperator(data.OP_MINOC),
+	"Within": compileCountedOperator(data.OP_WITHIN),
+	"Scope": compileScopeOp,
+}
+
+termExpansionOperators = ("Prefix","Range","Fuzzy","Substring")
+
+def reduceTopLevel(expressionTree,initialEnvironment,budget=None):
+	"""initialEnvironment must be a list"""
+	if expressionTree is None: return None
+	return PreparedQuery(expressionTree).execute(initialEnvironment,budget)
+
+def countTopLevel(expressionTree,initialEnvironment,budget=None):
+	"""initialEnvironment must be a list, returns None for an empty query"""
+	if expressionTree is None: return None
+	return PreparedQuery(expressionTree).count(initialEnvironment,budget)
+
+def existsTopLevel(expressionTree,initialEnvironment,budget=None):
+	"""initialEnvironment must be a list, returns None for an empty query"""
+	if expressionTree is None: return None
+	return PreparedQuery(expressionTree).exists(initialEnvironment,budget)
+
+def reduceTopLevelWithCache(expressionTree,initialEnvironment,resultCache,generation,budget=None):
+	"""Same as reduceTopLevel, but answers repeated queries out of resultCache (a cache.QueryResultCache)
+	generation must change whenever the index receives new postings
+	Results are still streamed, they are only kept for the cache while they fit in it,
+	and only stored once the caller has consumed all of them"""
+	canonicalExpression = canonicalExpressionTree(expressionTree)
+	if canonicalExpression is None: return reduceTopLevel(expressionTree,initialEnvironment,budget)
+	computedMatchList = resultCache.lookup(canonicalExpression,generation)
+	if computedMatchList is not None: return data.ComputedMatchVector(iter(computedMatchList))
+
+	computedMatchVector = reduceTopLevel(expressionTree,initialEnvironment,budget)
+	if computedMatchVector is None: return None
+	def computedMatchGenerator():
+		computedMatchList = list()
+		byteCount = 0
+		for computedMatch in computedMatchVector:
+			if computedMatchList is not None:
+				computedMatchList.append(computedMatch)
+				byteCount += cache.estimateSizeOfComputedMatchList([computedMatch])
+				if byteCount > resultCache.byteLimit: computedMatchList = None
+			yield computedMatch
+		# a partial result, cut short by its budget, must not be served to later queries
+		if budget is not None and budget.exceeded: computedMatchList = None
+		if computedMatchList is not None: resultCache.store(canonicalExpression,generation,computedMatchList)
+
+	return data.ComputedMatchVector(computedMatchGenerator())
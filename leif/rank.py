@@ -0,0 +1,105 @@
+"""
+Ranked retrieval, scores documents with BM25 and returns the top k
+
+Uses WAND dynamic pruning: every term has an upper bound on the score it can
+contribute, computed from the largest term frequency held in the partition
+headers. Once k documents are known, docIds whose summed upper bounds cannot
+beat the k-th best score are skipped without being scored.
+"""
+import heapq
+import math
+
+defaultK1 = 1.2
+defaultB = 0.75
+
+def bm25InverseDocumentFrequency(documentCount,documentFrequency):
+	"""the non-negative idf variant, so that very common terms never lower a score"""
+	return math.log(1.0 + (documentCount - documentFrequency + 0.5) / (documentFrequency + 0.5))
+
+def bm25TermScore(termFrequency,documentLength,averageDocumentLength,inverseDocumentFrequency,k1=defaultK1,b=defaultB):
+	lengthNormalization = k1 * (1.0 - b + b * documentLength / averageDocumentLength)
+	return inverseDocumentFrequency * (termFrequency * (k1 + 1.0)) / (termFrequency + lengthNormalization)
+
+class TermCursor(object):
+	"""Walks the docIds of one termId in ascending order
+	docId is None once the cursor is exhausted, termFrequency is only counted for docIds the cursor stops on"""
+	__slots__ = ["termId","reader","docId","termInstancesGenerator","inverseDocumentFrequency","maxScore"]
+	def __init__(self,_termId,_reader,_inverseDocumentFrequency,_maxScore):
+		self.termId = _termId
+		self.reader = iter(_reader)
+		self.docId = None
+		self.termInstancesGenerator = None
+		self.inverseDocumentFrequency = _inverseDocumentFrequency
+		self.maxScore = _maxScore
+		self.next()
+
+	def next(self):
+		for docIdTermInstanceVector in self.reader:
+			if docIdTermInstanceVector.docId is None: continue
+			self.docId = docIdTermInstanceVector.docId
+			self.termInstancesGenerator = docIdTermInstanceVector.termInstancesGenerator
+			return
+		self.docId = None
+		self.termInstancesGenerator = None
+
+	def advanceTo(self,targetDocId):
+		while self.docId is not None and self.docId < targetDocId: self.next()
+
+	@property
+	def termFrequency(self):
+		return sum(1 for termInstance in self.termInstancesGenerator)
+
+	def __repr__(self): return "#TC(%s):%s" % (self.termId,self.docId)
+
+def rankTermIds(reverseIndex,termIds,k=10,k1=defaultK1,b=defaultB):
+	"""Return up to k (score,docId) pairs, best first, for the bag of termIds"""
+	documentLengths = reverseIndex.documentLengths
+	documentCount = len(documentLengths)
+	averageDocumentLength = documentLengths.averageDocumentLength or 1.0
+	if k <= 0 or documentCount == 0: return []
+
+	cursors = list()
+	for termId in set(termIds):
+		documentFrequency,maxTermFrequency = reverseIndex.lookupTermStatistics(termId)
+		if documentFrequency == 0: continue
+		inverseDocumentFrequency = bm25InverseDocumentFrequency(documentCount,documentFrequency)
+		# a zero length document has the smallest possible length normalization
+		maxScore = bm25TermScore(maxTermFrequency,0,averageDocumentLength,inverseDocumentFrequency,k1,b)
+		cursors.append(TermCursor(termId,reverseIndex.lookupTermId(termId),inverseDocumentFrequency,maxScore))
+
+	topK = list() # min-heap of (score,docId)
+	threshold = 0.0
+	_docIdOrder = lambda cursor: cursor.docId
+	while 1:
+		cursors = [cursor for cursor in cursors if cursor.docId is not None]
+		if not cursors: break
+		cursors.sort(key=_docIdOrder)
+
+		# the pivot is the first cursor at which the summed upper bounds could enter the top k
+		pivot = None
+		upperBound = 0.0
+		for cursorIndex,cursor in enumerate(cursors):
+			upperBound += cursor.maxScore
+			if upperBound > threshold:
+				pivot = cursorIndex
+				break
+		if pivot is None: break
+		pivotDocId = cursors[pivot].docId
+
+		if cursors[0].docId == pivotDocId:
+			documentLength = documentLengths.getDocumentLength(pivotDocId)
+			score = 0.0
+			for cursor in cursors:
+				if cursor.docId != pivotDocId: break
+				score += bm25TermScore(cursor.termFrequency,documentLength,averageDocumentLength,cursor.inverseDocumentFrequency,k1,b)
+				cursor.next()
+			if len(topK) < k:
+				heapq.heappush(topK,(score,pivotDocId))
+			elif score > topK[0][0]:
+				heapq.heapreplace(topK,(score,pivotDocId))
+			if len(topK) == k: threshold = topK[0][0]
+		else:
+			for cursor in cursors[:pivot]:
+				cursor.advanceTo(pivotDocId)
+
+	return sorted(topK,reverse=True)
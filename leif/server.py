@@ -0,0 +1,286 @@
+"""
+A concurrent query server over a shared ReverseIndex
+
+Clients send one JSON object per line:
+	{"id": 1, "query": "(And,(Term,\\"cat\\"),(Term,\\"rat\\"))"}
+	{"id": 1, "query": "...", "mode": "count"}    mode is "matches" (default), "count", "exists" or "explain"
+	{"id": 1, "query": "...", "limit": 100}
+	{"id": 1, "query": "...", "maxSeconds": 0.5, "maxPostings": 100000, "maxMatches": 10000}
+	{"id": 1, "cancel": true}
+	{"stats": true}
+and receive one JSON object per line, tagged with the request id:
+	{"id": 1, "docIds": [...]}                  matches are streamed in chunks as they are found
+	{"id": 1, "done": true, "count": 42, "seconds": 0.01}
+	{"id": 1, "done": true, "count": 7, "seconds": 0.5, "budgetExceeded": "..."}    a partial result
+	{"id": 1, "done": true, "count": 42, "seconds": 0.01, "plan": ["..."]}    for explain, the annotated plan tree
+	{"id": 1, "cancelled": true, "count": 7}
+	{"id": 1, "error": "..."}
+A query must carry an id no other query of the connection still running has.
+
+Every connection has its own reader thread, so cancellations are seen while a
+query is still streaming. Queries are evaluated by a fixed pool of worker threads.
+Replies go through a bounded queue to a writer thread of the connection, a client
+that leaves SendQueueSize messages unread for SendTimeout seconds is disconnected
+and its queries are cancelled, so it cannot hold a worker.
+"""
+import collections
+import data
+import json
+import query
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+MatchChunkSize = 64 # docIds sent per message while streaming
+SendQueueSize = 256 # messages a connection may fall behind by
+SendTimeout = 10.0 # seconds a worker waits for room in that queue before dropping the client
+LatencySampleCount = 4096 # samples kept per operator type
+
+class OperatorLatencyStats(object):
+	"""Keeps the most recent query latencies for each top level operator type"""
+	__slots__ = ["samples","counts","lock"]
+	def __init__(self):
+		self.samples = dict() # rator -> deque of seconds
+		self.counts = collections.defaultdict(int)
+		self.lock = threading.Lock()
+
+	def record(self,rator,seconds):
+		self.lock.acquire()
+		try:
+			if rator not in self.samples: self.samples[rator] = collections.deque(maxlen=LatencySampleCount)
+			self.samples[rator].append(seconds)
+			self.counts[rator] += 1
+		finally:
+			self.lock.release()
+
+	def percentiles(self):
+		"""returns {rator: {"count":..,"p50":..,"p90":..,"p99":..,"max":..}}, latencies in seconds"""
+		self.lock.acquire()
+		try:
+			samples = dict([(rator,sorted(latencies)) for rator,latencies in self.samples.iteritems()])
+			counts = dict(self.counts)
+		finally:
+			self.lock.release()
+		_percentile = lambda latencies,p: latencies[min(len(latencies) - 1,int(p * len(latencies)))]
+		stats = dict()
+		for rator,latencies in samples.iteritems():
+			stats[rator] = {
+				"count": counts[rator],
+				"p50": _percentile(latencies,0.50),
+				"p90": _percentile(latencies,0.90),
+				"p99": _percentile(latencies,0.99),
+				"max": latencies[-1],
+			}
+		return stats
+
+class QueryRequestHandler(SocketServer.StreamRequestHandler):
+	"""Reads requests off one connection, queries are handed to the server's worker pool"""
+	def setup(self):
+		SocketServer.StreamRequestHandler.setup(self)
+		self.cancelEvents = dict() # request id -> threading.Event
+		self.isOpen = True
+		self.sendQueue = Queue.Queue(SendQueueSize)
+		self.writerThread = threading.Thread(target = self._writeMessages,name = "QueryReplyWriter")
+		self.writerThread.setDaemon(True)
+		self.writerThread.start()
+
+	def handle(self):
+		while 1:
+			try:
+				line = self.rfile.readline()
+			except socket.error:
+				break # shut down by close()
+			if not line: break
+			line = line.strip()
+			if not line: continue
+			try:
+				request = json.loads(line)
+				if not isinstance(request,dict): raise ValueError("requests must be JSON objects")
+			except ValueError, e:
+				self.send({"error": "Bad request: %s" % e})
+				continue
+
+			requestId = request.get("id")
+			if request.get("cancel"):
+				if requestId in self.cancelEvents: self.cancelEvents[requestId].set()
+			elif request.get("stats"):
+				self.send({"id": requestId,"stats": self.server.latencyStats.percentiles()})
+			elif "query" in request:
+				# replies and cancellations are matched to queries by id alone
+				if not isinstance(requestId,(int,long,float,basestring)):
+					self.send({"error": "Bad request: a query needs an id, a number or a string"})
+					continue
+				if requestId in self.cancelEvents:
+					self.send({"id": requestId,"error": "Bad request: id %s is still in use" % json.dumps(requestId)})
+					continue
+				cancelEvent = threading.Event()
+				self.cancelEvents[requestId] = cancelEvent
+				self.server.jobQueue.put((self,requestId,request,cancelEvent))
+			else:
+				self.send({"id": requestId,"error": "Bad request: expected query, cancel or stats"})
+
+		# the client has gone, nothing it asked for is worth finishing
+		self.close(False)
+
+	def send(self,message):
+		"""queues message for the client, returns False once the connection can no longer be written to"""
+		if not self.isOpen: return False
+		try:
+			self.sendQueue.put(json.dumps(message) + "\n",True,SendTimeout)
+			return True
+		except Queue.Full:
+			self.close(True)
+			return False
+
+	def _writeMessages(self):
+		willBlock = True
+		while 1:
+			line = self.sendQueue.get(willBlock)
+			if line is None or not self.isOpen: break
+			try:
+				self.wfile.write(line)
+				self.wfile.flush()
+			except (IOError,socket.error,ValueError):
+				self.close(True)
+				break
+
+	def close(self,disconnect):
+		"""stops sending, cancels every query of the connection and stops the writer thread
+		disconnect also shuts the socket down, which ends a write blocked on a client that stopped reading"""
+		self.isOpen = False
+		for cancelEvent in self.cancelEvents.values(): cancelEvent.set()
+		try:
+			self.sendQueue.put_nowait(None)
+		except Queue.Full:
+			pass # the writer sees isOpen once its write ends
+		if disconnect:
+			try:
+				self.connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+	def finish(self):
+		# the file is closed under the writer only if its last write does not end in time
+		self.writerThread.join(SendTimeout)
+		if self.writerThread.isAlive(): self.close(True)
+		try:
+			SocketServer.StreamRequestHandler.finish(self)
+		except socket.error:
+			pass # what the writer left unflushed can no longer be sent
+
+	def finishRequest(self,requestId,cancelEvent):
+		"""frees requestId, before the last message of its query is sent so the client may reuse it once it has that"""
+		if self.cancelEvents.get(requestId) is cancelEvent: del self.cancelEvents[requestId]
+
+class QueryServer(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+	"""Serves queries against reverseIndex, whose termIds come from the alphabet termWords"""
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self,address,reverseIndex,termWords,workerCount=4,budgetLimits=(None,None,None)):
+		"""budgetLimits are the default (seconds,postings,intermediate matches) of every query, requests may lower them"""
+		SocketServer.TCPServer.__init__(self,address,QueryRequestHandler)
+		self.reverseIndex = reverseIndex
+		self.termWords = termWords
+		self.budgetLimits = tuple(budgetLimits)
+		self.latencyStats = OperatorLatencyStats()
+		self.jobQueue = Queue.Queue(-1)
+		self.workerThreads = list()
+		for workerIndex in xrange(workerCount):
+			workerThread = threading.Thread(target = self._queryWorker)
+			workerThread.setDaemon(True)
+			workerThread.start()
+			self.workerThreads.append(workerThread)
+
+	def _queryWorker(self):
+		willBlock = True
+		while 1:
+			job = self.jobQueue.get(willBlock)
+			if job is None: break
+			handler,requestId,request,cancelEvent = job
+			try:
+				lastMessage = self.runQuery(handler,requestId,request,cancelEvent)
+			except Exception, e:
+				lastMessage = {"id": requestId,"error": "%s: %s" % (e.__class__.__name__,e)}
+			handler.finishRequest(requestId,cancelEvent)
+			if lastMessage is not None: handler.send(lastMessage)
+
+	def makeQueryBudget(self,request):
+		"""returns a data.QueryBudget for request, or None when nothing limits it"""
+		budgetLimits = list()
+		for defaultLimit,requestKey,limitType in zip(self.budgetLimits,("maxSeconds","maxPostings","maxMatches"),(float,int,int)):
+			limit = defaultLimit
+			if request.get(requestKey) is not None:
+				limit = limitType(request[requestKey])
+				if defaultLimit is not None: limit = min(limit,defaultLimit)
+			budgetLimits.append(limit)
+		if budgetLimits == [None,None,None]: return None
+		return data.QueryBudget(*budgetLimits)
+
+	def runQuery(self,handler,requestId,request,cancelEvent):
+		"""streams the matches of request to handler, returns the message that ends the query, None
+		when the client can no longer be written to"""
+		startTime = time.time()
+		if cancelEvent.isSet(): return {"id": requestId,"cancelled": True,"count": 0}
+		try:
+			preparedQuery = query.prepareQuery(request["query"])
+		except SyntaxError, e:
+			return {"id": requestId,"error": str(e)}
+		if preparedQuery is None: return {"id": requestId,"error": "Empty query"}
+
+		environment = query.makeInitialEnvironmentFromReverseIndex(self.reverseIndex,self.termWords)
+		budget = self.makeQueryBudget(request)
+		mode = request.get("mode","matches")
+		if mode == "count":
+			doneMessage = {"id": requestId,"done": True,"count": preparedQuery.count(environment,budget)}
+		elif mode == "exists":
+			doneMessage = {"id": requestId,"done": True,"exists": preparedQuery.exists(environment,budget)}
+		elif mode == "explain":
+			analyzedPlan = preparedQuery.explainAnalyze(environment,"matches",budget)
+			doneMessage = {"id": requestId,"done": True,"count": analyzedPlan.rowsOut,"plan": analyzedPlan.format()}
+		elif mode == "matches":
+			matchCount = 0
+			docIdChunk = list()
+			computedMatches = preparedQuery.execute(environment,budget)
+			if "limit" in request: computedMatches = computedMatches.page(0,int(request["limit"]))
+			for computedMatch in computedMatches:
+				if cancelEvent.isSet(): return {"id": requestId,"cancelled": True,"count": matchCount}
+				docIdChunk.append(self.reverseIndex.externalDocId(computedMatch.docId))
+				matchCount += 1
+				if len(docIdChunk) == MatchChunkSize:
+					if not handler.send({"id": requestId,"docIds": docIdChunk}): return None
+					docIdChunk = list()
+			if docIdChunk and not handler.send({"id": requestId,"docIds": docIdChunk}): return None
+			doneMessage = {"id": requestId,"done": True,"count": matchCount}
+		else:
+			return {"id": requestId,"error": "Unknown mode %s" % mode}
+		doneMessage["seconds"] = time.time() - startTime
+		if budget is not None and budget.exceeded: doneMessage["budgetExceeded"] = budget.exceededReason
+
+		rator = preparedQuery.expressionTree[0]
+		self.latencyStats.record(rator,time.time() - startTime)
+		return doneMessage
+
+	def server_close(self):
+		for workerThread in self.workerThreads: self.jobQueue.put(None)
+		SocketServer.TCPServer.server_close(self)
+
+def parseAddress(address):
+	"""HOST:PORT -> (host,port)"""
+	host,port = address.rsplit(":",1)
+	return (host,int(port))
+
+def serveReverseIndex(address,reverseIndex,termWords,workerCount=4,budgetLimits=(None,None,None)):
+	"""Runs a QueryServer on address (HOST:PORT) until interrupted"""
+	server = QueryServer(parseAddress(address),reverseIndex,termWords,workerCount,budgetLimits)
+	print >> sys.stderr, "LEIF: serving queries on %s:%d with %d workers" % (server.server_address + (workerCount,))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	for rator,stats in sorted(server.latencyStats.percentiles().iteritems()):
+		print >> sys.stderr, "%-8s %8d queries p50 %.4fs p90 %.4fs p99 %.4fs max %.4fs" % (rator,stats["count"],stats["p50"],stats["p90"],stats["p99"],stats["max"])
@@ -0,0 +1,191 @@
+"""
+Ingestion and merge telemetry for a ReverseIndex
+
+IngestStatistics is updated by the ingress threads with plain counter increments,
+everything that costs more (rates, partition sizes, the MMP fill level) is worked
+out only when ReverseIndex.stats() is called. StatisticsDumper appends stats() to
+a file as JSON lines, SamplingProfiler samples the stacks of chosen threads.
+"""
+import collections
+import json
+import sys
+import threading
+import time
+
+MergeHistoryLength = 64 # merges remembered in detail
+
+class IngestStatistics(object):
+	"""Counters kept by the document and posting ingress threads of a ReverseIndex"""
+	__slots__ = ["startTime","documentsPosted","postingsIndexed","mergesStarted","mergeCount","mergeSeconds","mergeBytesRead","mergeBytesWritten","bytesIngested","mergeHistory","mergesByLevel","previousSample","lock"]
+	def __init__(self):
+		self.startTime = time.time()
+		self.documentsPosted = 0
+		self.postingsIndexed = 0
+		self.mergesStarted = 0 # ahead of mergeCount while a merge is running
+		self.mergeCount = 0
+		self.mergeSeconds = 0.0
+		self.mergeBytesRead = 0
+		self.mergeBytesWritten = 0
+		self.bytesIngested = 0 # estimated size of every MMP that was merged out to disk
+		self.mergeHistory = collections.deque(maxlen=MergeHistoryLength)
+		self.mergesByLevel = dict() # level -> {"count","seconds","bytesRead","bytesWritten"} over every merge
+		self.previousSample = (self.startTime,0,0) # (time,documentsPosted,postingsIndexed) of the last rates() call
+		self.lock = threading.Lock()
+
+	def recordMergeStart(self):
+		self.mergesStarted += 1
+
+	def recordMerge(self,mergeIntoPartitionK,seconds,bytesIngested,bytesRead,bytesWritten):
+		self.lock.acquire()
+		try:
+			self.mergeCount += 1
+			self.mergeSeconds += seconds
+			self.mergeBytesRead += bytesRead
+			self.mergeBytesWritten += bytesWritten
+			self.bytesIngested += bytesIngested
+			self.mergeHistory.append({
+				"time": time.time(),
+				"level": mergeIntoPartitionK,
+				"seconds": seconds,
+				"bytesIngested": bytesIngested,
+				"bytesRead": bytesRead,
+				"bytesWritten": bytesWritten,
+			})
+			if mergeIntoPartitionK not in self.mergesByLevel:
+				self.mergesByLevel[mergeIntoPartitionK] = {"count": 0,"seconds": 0.0,"bytesRead": 0,"bytesWritten": 0}
+			levelTotals = self.mergesByLevel[mergeIntoPartitionK]
+			levelTotals["count"] += 1
+			levelTotals["seconds"] += seconds
+			levelTotals["bytesRead"] += bytesRead
+			levelTotals["bytesWritten"] += bytesWritten
+		finally:
+			self.lock.release()
+
+	@property
+	def writeAmplification(self):
+		"""bytes written by merges for every byte that left the MMP"""
+		if not self.bytesIngested: return 0.0
+		return float(self.mergeBytesWritten) / self.bytesIngested
+
+	def rates(self):
+		"""returns documents and postings per second, since the start and since the previous call"""
+		now = time.time()
+		self.lock.acquire()
+		try:
+			sampleTime,sampleDocuments,samplePostings = self.previousSample
+			self.previousSample = (now,self.documentsPosted,self.postingsIndexed)
+		finally:
+			self.lock.release()
+		elapsed = max(now - self.startTime,1e-9)
+		interval = max(now - sampleTime,1e-9)
+		return {
+			"documentsPerSecond": self.documentsPosted / elapsed,
+			"postingsPerSecond": self.postingsIndexed / elapsed,
+			"recentDocumentsPerSecond": (self.documentsPosted - sampleDocuments) / interval,
+			"recentPostingsPerSecond": (self.postingsIndexed - samplePostings) / interval,
+		}
+
+	def stats(self):
+		stats = {
+			"uptime": time.time() - self.startTime,
+			"documentsPosted": self.documentsPosted,
+			"postingsIndexed": self.postingsIndexed,
+			"merges": {
+				"count": self.mergeCount,
+				"seconds": self.mergeSeconds,
+				"bytesRead": self.mergeBytesRead,
+				"bytesWritten": self.mergeBytesWritten,
+				"bytesIngested": self.bytesIngested,
+				"writeAmplification": self.writeAmplification,
+				"levels": dict([(str(level),dict(levelTotals)) for level,levelTotals in self.mergesByLevel.items()]),
+				"recent": list(self.mergeHistory),
+			},
+		}
+		stats.update(self.rates())
+		return stats
+
+class StatisticsDumper(object):
+	"""Appends reverseIndex.stats() to outputFile as one JSON line every interval seconds"""
+	__slots__ = ["reverseIndex","outputFile","interval","stopEvent","thread"]
+	def __init__(self,_reverseIndex,_outputFile,_interval=10.0):
+		self.reverseIndex = _reverseIndex
+		self.outputFile = _outputFile
+		self.interval = _interval
+		self.stopEvent = threading.Event()
+		self.thread = threading.Thread(target = self._dumpThread)
+		self.thread.setDaemon(True)
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		"""stops the thread, after writing one last line"""
+		self.stopEvent.set()
+		self.thread.join()
+
+	def dump(self):
+		self.outputFile.write(json.dumps(self.reverseIndex.stats()) + "\n")
+		self.outputFile.flush()
+
+	def _dumpThread(self):
+		while not self.stopEvent.isSet():
+			self.stopEvent.wait(self.interval)
+			try:
+				self.dump()
+			except (IOError,ValueError), e:
+				print >> sys.stderr, "StatisticsDumper stopped: %s" % e
+				return
+
+class SamplingProfiler(object):
+	"""Samples the stacks of threads every interval seconds using sys._current_frames()
+	Unlike the profile module it costs the sampled threads nothing beyond the GIL
+	handoffs, so it can be left running on ingest threads for a whole update"""
+	__slots__ = ["threads","interval","stackDepth","sampleCount","functionCounts","stackCounts","stopEvent","thread"]
+	def __init__(self,_threads,_interval=0.005,_stackDepth=8):
+		self.threads = list(_threads)
+		self.interval = _interval
+		self.stackDepth = _stackDepth
+		self.sampleCount = 0
+		self.functionCounts = collections.defaultdict(int) # (thread name,filename,lineno,function) -> samples
+		self.stackCounts = collections.defaultdict(int) # (thread name,stack) -> samples
+		self.stopEvent = threading.Event()
+		self.thread = threading.Thread(target = self._sampleThread)
+		self.thread.setDaemon(True)
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopEvent.set()
+		self.thread.join()
+
+	def _sampleThread(self):
+		threadNames = dict([(thread.ident,thread.getName()) for thread in self.threads])
+		while not self.stopEvent.isSet():
+			frames = sys._current_frames()
+			for threadIdent,threadName in threadNames.iteritems():
+				frame = frames.get(threadIdent)
+				if frame is None: continue
+				code = frame.f_code
+				self.functionCounts[(threadName,code.co_filename,frame.f_lineno,code.co_name)] += 1
+				stack = list()
+				while frame is not None and len(stack) < self.stackDepth:
+					stack.append(frame.f_code.co_name)
+					frame = frame.f_back
+				self.stackCounts[(threadName,tuple(stack))] += 1
+			self.sampleCount += 1
+			del frames
+			self.stopEvent.wait(self.interval)
+
+	def report(self,top=20):
+		"""returns the most sampled lines and stacks, as a list of text lines"""
+		lines = ["%d samples every %.3fs" % (self.sampleCount,self.interval)]
+		_byCount = lambda item: -item[1]
+		for (threadName,filename,lineno,function),count in sorted(self.functionCounts.items(),key=_byCount)[:top]:
+			lines.append("%6d %-20s %s:%d %s" % (count,threadName,filename,lineno,function))
+		lines.append("stacks (innermost first):")
+		for (threadName,stack),count in sorted(self.stackCounts.items(),key=_byCount)[:top]:
+			lines.append("%6d %-20s %s" % (count,threadName," < ".join(stack)))
+		return lines
@@ -0,0 +1,263 @@
+"""
+A sorted term dictionary, mmapped from disk
+
+The alphabet (termWord -> termId) is stored sorted and front coded in blocks of
+BlockSize terms: the first term of a block is stored whole, every other term as
+the length of the prefix it shares with the term before it and the rest. An
+array of block offsets follows the header, so an exact lookup is a binary search
+over the first terms of the blocks and a scan of one block, and prefix and range
+lookups scan forward from there. Opening the dictionary reads only the header.
+
+termWords are stored as UTF-8 and compared bytewise, lookups take str or unicode.
+Beside the dictionary is an ngram.MappedTrigramIndex over the same termWords,
+which finds the candidates of fuzzy and substring lookups, and an index of the
+padded bigrams of every termWord by its length, for fuzzy lookups of termWords too
+short for the trigrams to bound.
+"""
+import cPickle as pickle
+import mmap
+import ngram
+import os
+import struct
+
+TermDictionaryMagic = "LEIFTD\x01\x00"
+TermDictionaryHeader = struct.Struct("<III") # termCount,blockSize,blockCount
+TermEntryHeader = struct.Struct("<HHI") # shared prefix length,suffix length,termId
+BlockSize = 16
+TrigramIndexSuffix = ".trigrams"
+LengthBigramIndexSuffix = ".bigrams"
+MaxFuzzyCandidates = 2048 # termWords whose edit distance is worked out for one fuzzy lookup
+
+def _encodeTermWord(termWord):
+	if isinstance(termWord,unicode): return termWord.encode("utf-8")
+	return termWord
+
+def prefixUpperBound(prefix):
+	"""the least string greater than every string starting with prefix, None if there is none"""
+	prefix = _encodeTermWord(prefix).rstrip("\xff")
+	if not prefix: return None
+	return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def writeTermDictionary(termWords,path,blockSize=BlockSize):
+	"""writes the termWord -> termId dict termWords to path"""
+	sortedTermWords = sorted([(_encodeTermWord(termWord),termId) for termWord,termId in termWords.iteritems()])
+	blocks = list()
+	for blockStart in xrange(0,len(sortedTermWords),blockSize):
+		entries = list()
+		previousTermWord = ""
+		for termWord,termId in sortedTermWords[blockStart:blockStart + blockSize]:
+			if len(termWord) > 0xffff: raise ValueError("termWord of %d bytes is too long for a TermDictionary" % len(termWord))
+			shared = 0
+			sharedLimit = min(len(termWord),len(previousTermWord))
+			while shared < sharedLimit and termWord[shared] == previousTermWord[shared]: shared += 1
+			entries.append(TermEntryHeader.pack(shared,len(termWord) - shared,termId))
+			entries.append(termWord[shared:])
+			previousTermWord = termWord
+		blocks.append("".join(entries))
+
+	blockOffsets = list()
+	offset = len(TermDictionaryMagic) + TermDictionaryHeader.size + 4 * (len(blocks) + 1)
+	for block in blocks:
+		blockOffsets.append(offset)
+		offset += len(block)
+	blockOffsets.append(offset) # the end of the last block
+
+	outputFile = open(path,"wb")
+	outputFile.write(TermDictionaryMagic)
+	outputFile.write(TermDictionaryHeader.pack(len(sortedTermWords),blockSize,len(blocks)))
+	outputFile.write(struct.pack("<%dI" % len(blockOffsets),*blockOffsets))
+	outputFile.writelines(blocks)
+	outputFile.close()
+
+class TermDictionary(object):
+	"""A read only termWord -> termId mapping over a file written by writeTermDictionary
+	Supports what the query path asks of an alphabet dict: in, [], get(), len() and iteritems()"""
+	__slots__ = ["path","buffer","termCount","blockSize","blockCount","_trigramIndex","_lengthBigramIndex"]
+	def __init__(self,_path):
+		self.path = _path
+		dictionaryFile = open(_path,"rb")
+		try:
+			self.buffer = mmap.mmap(dictionaryFile.fileno(),0,access=mmap.ACCESS_READ)
+		finally:
+			dictionaryFile.close()
+		if self.buffer[:len(TermDictionaryMagic)] != TermDictionaryMagic: raise ValueError("%s is not a TermDictionary" % _path)
+		self.termCount,self.blockSize,self.blockCount = TermDictionaryHeader.unpack_from(self.buffer,len(TermDictionaryMagic))
+		self._trigramIndex = None
+		self._lengthBigramIndex = None
+
+	def _blockOffset(self,blockIndex):
+		return struct.unpack_from("<I",self.buffer,len(TermDictionaryMagic) + TermDictionaryHeader.size + 4 * blockIndex)[0]
+
+	def _firstTermWord(self,blockIndex):
+		offset = self._blockOffset(blockIndex)
+		shared,suffixLength,termId = TermEntryHeader.unpack_from(self.buffer,offset)
+		offset += TermEntryHeader.size
+		return self.buffer[offset:offset + suffixLength]
+
+	def _findBlock(self,termWord):
+		"""the last block whose first termWord is <= termWord, 0 when there is none"""
+		low,high = 0,self.blockCount
+		while high - low > 1:
+			middle = (low + high) // 2
+			if self._firstTermWord(middle) <= termWord:
+				low = middle
+			else:
+				high = middle
+		return low
+
+	def _iterBlocks(self,blockIndex):
+		"""generates (termWord,termId) from the start of blockIndex to the end of the dictionary
+		the first entry of a block shares nothing with the one before, so blocks simply run on"""
+		offset = self._blockOffset(blockIndex)
+		endOffset = self._blockOffset(self.blockCount)
+		termWord = ""
+		while offset < endOffset:
+			shared,suffixLength,termId = TermEntryHeader.unpack_from(self.buffer,offset)
+			offset += TermEntryHeader.size
+			termWord = termWord[:shared] + self.buffer[offset:offset + suffixLength]
+			offset += suffixLength
+			yield (termWord,termId)
+
+	def iterRange(self,low=None,high=None):
+		"""generates (termWord,termId) in termWord order for low <= termWord < high, either bound can be None"""
+		if not self.termCount: return
+		if low is None:
+			blockIndex = 0
+		else:
+			low = _encodeTermWord(low)
+			blockIndex = self._findBlock(low)
+		if high is not None: high = _encodeTermWord(high)
+		for termWord,termId in self._iterBlocks(blockIndex):
+			if low is not None and termWord < low: continue
+			if high is not None and termWord >= high: return
+			yield (termWord,termId)
+
+	def termWordOfOrdinal(self,ordinal):
+		"""the termWord at position ordinal in termWord order"""
+		blockIndex,skip = divmod(ordinal,self.blockSize)
+		for termWord,termId in self._iterBlocks(blockIndex):
+			if not skip: return termWord
+			skip -= 1
+		raise IndexError(ordinal)
+
+	@property
+	def trigramIndex(self):
+		"""the trigram index written beside the dictionary, built in memory when there is none
+		or when it does not belong to this dictionary (it was replaced in between the two opens)"""
+		if self._trigramIndex is None:
+			trigramIndex = None
+			if os.path.exists(self.path + TrigramIndexSuffix):
+				trigramIndex = ngram.MappedTrigramIndex(self.path + TrigramIndexSuffix)
+			if trigramIndex is None or trigramIndex.termCount != self.termCount:
+				trigramIndex = ngram.MemoryTrigramIndex(list(self))
+			self._trigramIndex = trigramIndex
+		return self._trigramIndex
+
+	@property
+	def lengthBigramIndex(self):
+		"""the length and bigram index written beside the dictionary, built in memory like trigramIndex"""
+		if self._lengthBigramIndex is None:
+			lengthBigramIndex = None
+			if os.path.exists(self.path + LengthBigramIndexSuffix):
+				lengthBigramIndex = ngram.MappedTrigramIndex(self.path + LengthBigramIndexSuffix,ngram.LengthBigramIndexMagic)
+			if lengthBigramIndex is None or lengthBigramIndex.termCount != self.termCount:
+				lengthBigramIndex = ngram.MemoryTrigramIndex(list(self),ngram.buildLengthBigramPostings)
+			self._lengthBigramIndex = lengthBigramIndex
+		return self._lengthBigramIndex
+
+	def iterPrefix(self,prefix):
+		"""generates (termWord,termId) for every termWord starting with prefix"""
+		return self.iterRange(prefix,prefixUpperBound(prefix))
+
+	def get(self,termWord,default=None):
+		termWord = _encodeTermWord(termWord)
+		for foundTermWord,termId in self.iterRange(termWord):
+			if foundTermWord == termWord: return termId
+			break
+		return default
+
+	def __getitem__(self,termWord):
+		termId = self.get(termWord)
+		if termId is None: raise KeyError(termWord)
+		return termId
+
+	def __contains__(self,termWord):
+		return self.get(termWord) is not None
+
+	def __len__(self):
+		return self.termCount
+
+	def iteritems(self):
+		return self.iterRange()
+
+	def __iter__(self):
+		for termWord,termId in self.iterRange():
+			yield termWord
+
+	def __repr__(self): return "#TD(%s):%d terms" % (self.path,self.termCount)
+
+def termWordsInRange(termWords,low=None,high=None):
+	"""returns the sorted termWords of the alphabet termWords (a TermDictionary or a dict) with low <= termWord < high"""
+	if isinstance(termWords,TermDictionary):
+		return [termWord for termWord,termId in termWords.iterRange(low,high)]
+	if low is not None: low = _encodeTermWord(low)
+	if high is not None: high = _encodeTermWord(high)
+	return sorted([termWord for termWord in termWords if (low is None or _encodeTermWord(termWord) >= low) and (high is None or _encodeTermWord(termWord) < high)],key=_encodeTermWord)
+
+def termWordsWithPrefix(termWords,prefix):
+	return termWordsInRange(termWords,prefix,prefixUpperBound(prefix))
+
+def termWordsNear(termWords,termWord,maxDistance,limit):
+	"""returns up to limit termWords of the alphabet termWords within maxDistance edits of termWord,
+	nearest first. A TermDictionary finds candidates through its trigram index (see
+	ngram.fuzzyCandidates), or for termWords too short for that through its length and bigram
+	index (see ngram.lengthBigramCandidates). A dict, i.e. an alphabet that was pickled, is scanned"""
+	termWord = _encodeTermWord(termWord)
+	if isinstance(termWords,TermDictionary):
+		ordinals = ngram.fuzzyCandidates(termWords.trigramIndex,termWord,maxDistance,MaxFuzzyCandidates)
+		if ordinals is None: ordinals = ngram.lengthBigramCandidates(termWords.lengthBigramIndex,termWord,maxDistance,MaxFuzzyCandidates)
+		candidates = [termWords.termWordOfOrdinal(ordinal) for ordinal in ordinals]
+	else:
+		candidates = map(_encodeTermWord,termWords)
+	nearTermWords = list()
+	for candidate in candidates:
+		distance = ngram.editDistance(termWord,candidate,maxDistance)
+		if distance <= maxDistance: nearTermWords.append((distance,candidate))
+	nearTermWords.sort()
+	return [candidate for distance,candidate in nearTermWords[:limit]]
+
+def termWordsContaining(termWords,fragment,limit):
+	"""returns the first limit termWords, in termWord order, of the alphabet termWords holding fragment
+	fragment must be at least 3 long, a dict alphabet is scanned"""
+	fragment = _encodeTermWord(fragment)
+	if isinstance(termWords,TermDictionary):
+		candidates = (termWords.termWordOfOrdinal(ordinal) for ordinal in ngram.substringCandidates(termWords.trigramIndex,fragment))
+	else:
+		candidates = iter(sorted(map(_encodeTermWord,termWords)))
+	containingTermWords = list()
+	for candidate in candidates:
+		if len(containingTermWords) == limit: break
+		if fragment in candidate: containingTermWords.append(candidate)
+	return containingTermWords
+
+def openAlphabet(path):
+	"""returns the alphabet at path, a TermDictionary, or a dict for an alphabet that was pickled"""
+	alphabetFile = open(path,"rb")
+	try:
+		if alphabetFile.read(len(TermDictionaryMagic)) == TermDictionaryMagic: return TermDictionary(path)
+		alphabetFile.seek(0)
+		return pickle.load(alphabetFile)
+	finally:
+		alphabetFile.close()
+
+def saveAlphabet(termWords,path):
+	"""writes termWords as a TermDictionary and its trigram and length and bigram indexes beside path
+	and renames them into place, so readers never see part of one"""
+	temporaryPath = path + ".tmp"
+	writeTermDictionary(termWords,temporaryPath)
+	sortedTermWords = list(TermDictionary(temporaryPath))
+	ngram.writeTrigramIndex(sortedTermWords,temporaryPath + TrigramIndexSuffix)
+	ngram.writeTrigramIndex(sortedTermWords,temporaryPath + LengthBigramIndexSuffix,ngram.LengthBigramIndexMagic,ngram.buildLengthBigramPostings)
+	os.rename(temporaryPath + TrigramIndexSuffix,path + TrigramIndexSuffix)
+	os.rename(temporaryPath + LengthBigramIndexSuffix,path + LengthBigramIndexSuffix)
+	os.rename(temporaryPath,path)
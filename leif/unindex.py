@@ -1,51 +1,185 @@
 """
 Classes and functions used to unindex an index
+
+An index with a forward index is unindexed document by document. Otherwise the
+postings of every term are streamed out as (docId,position,termId) records,
+sorted in runs of bounded size that are spilled to disk, and the runs are
+merged back in docId order so every document is written in one sequential
+write. The merge is split into docId ranges, each merged and written by a
+worker process over all the runs.
 """
 import data
+import forward
+import heapq
 import index
+import multiprocessing
 import os
+import shutil
+import struct
 import sys
+import tempfile
+
+UnindexRecord = struct.Struct("<qII") # docId,position,termId
+EstimatedRecordBytes = 128 # memory held by one (docId,position,termId) tuple of a run being sorted
+DefaultSortMemory = 64 * 1024 * 1024
+RunReadRecords = 4096 # records read at a time from each run while merging
+RangesPerWorker = 4
+MaxMergedRuns = 128 # runs open at once in a merge, more are first merged into longer runs
+
+# the termId -> termWord dict and the data.DocIdMap of the index (None until an optimize
+# reassigned docIds), set before the worker pool starts so forked workers inherit them
+_unindexTermWords = None
+_unindexDocIdMap = None
+
+def _externalDocId(docIdMap,docId):
+	if docIdMap is None: return docId
+	return docIdMap.externalDocId(docId)
 
-def unindexReverseIndex(alphabet,reverseIndex,path):
-	"""Generates a set of documents in path that roughly represent the original documents in the Index"""
-	def _deleteDocumentTermCounterString(docCount,termCount):
-		deleteString = "[Document %8d Terms %8d]" % (docCount,termCount)
-		sys.stdout.write("\b" * len(deleteString))
-	def _writeDocumentTermCounterString(docCount,termCount):
-		sys.stdout.write("[Document %8d Terms %8d]" % (docCount,termCount))
-	outputFileHash = dict()
+def unindexForwardIndex(alphabet,forwardIndex,path,docIdMap=None):
+	"""Writes the documents of forwardIndex to path as unindexReverseIndex does, reading each
+	document once in position order instead of scanning the postings of every term
+	Files are named after the external docIds of docIdMap when there is one"""
+	termWordOfTermId = forward.invertAlphabet(alphabet)
+	for docCounter,docId in enumerate(forwardIndex.docIds()):
+		fileTerms = forward.documentTermWords(forwardIndex.lookupDocument(docId),termWordOfTermId)
+		_writeDocument(path,_externalDocId(docIdMap,docId),fileTerms)
+		if (docCounter + 1) % 1000 == 0: print >> sys.stdout, "Unindexed %d documents" % (docCounter + 1)
+	print >> sys.stdout, "Unindexed %d documents from the forward index" % len(forwardIndex)
+
+def _writeRun(records,path):
+	records.sort()
+	runFile = open(path,"wb")
+	runFile.write("".join([UnindexRecord.pack(*record) for record in records]))
+	runFile.close()
+
+def writeSortedRuns(alphabet,reverseIndex,runDirectory,memoryLimit=DefaultSortMemory):
+	"""writes the postings of every termId of alphabet as sorted runs of UnindexRecords in runDirectory
+	holding no more than about memoryLimit bytes of records at a time, returns the paths of the runs"""
+	runLength = max(1,memoryLimit // EstimatedRecordBytes)
+	runPaths = list()
+	records = list()
 	for termWord,termId in alphabet.iteritems():
-		docCounter = 0
-		displayTermWord = termWord[0:14]
-		if len(displayTermWord) == 14: displayTermWord = "".join(["<",displayTermWord[:-2],">"])
-		sys.stdout.write("Unindexing term %14s " % displayTermWord)
-		_writeDocumentTermCounterString(0,0)
 		for docIdTermInstanceVector in reverseIndex.lookupTermId(termId):
-			termCounter = 0
-			_deleteDocumentTermCounterString(docCounter,termCounter)
-			docCounter += 1
-			_writeDocumentTermCounterString(docCounter,termCounter)
 			docId = docIdTermInstanceVector.docId
-			if docId not in outputFileHash:
-				outputFileName = os.sep.join([path,str(docId) + ".fwd"])
-				outputFileHash[docId] = outputFileName
-			fp = open(outputFileHash[docId],"ab")
-
 			for termInstance in docIdTermInstanceVector.termInstancesGenerator:
-				_deleteDocumentTermCounterString(docCounter,termCounter)
-				termCounter += 1
-				_writeDocumentTermCounterString(docCounter,termCounter)
-				print >> fp, "%d %s" % (termInstance.position,termWord)
-			fp.close()
-
-		sys.stdout.write(" DONE\n")
-	
-	for fileName in outputFileHash.values():
-		fp = open(fileName,"rb")
-		fileTerms = sorted([(int(position),word[:-1]) for position,word in [line.split(" ",1) for line in fp]])
-		fp.close()
-		print >> sys.stdout, "Reorganizing: %s" % fileName
-		fp = open(fileName,"wb")
-		for termPosition,termWord in fileTerms:
-			fp.write(termWord + " ")
-		fp.close()
+				records.append((docId,termInstance.position,termId))
+				if len(records) == runLength:
+					runPaths.append(os.sep.join([runDirectory,"run%d" % len(runPaths)]))
+					_writeRun(records,runPaths[-1])
+					records = list()
+	if records:
+		runPaths.append(os.sep.join([runDirectory,"run%d" % len(runPaths)]))
+		_writeRun(records,runPaths[-1])
+	mergedRunCount = 0
+	while len(runPaths) > MaxMergedRuns:
+		mergedRunPath = os.sep.join([runDirectory,"merged%d" % mergedRunCount])
+		_mergeRuns(runPaths[:MaxMergedRuns],mergedRunPath)
+		mergedRunCount += 1
+		runPaths = runPaths[MaxMergedRuns:] + [mergedRunPath]
+	return runPaths
+
+def _readRun(path,lowDocId,highDocId):
+	"""generates the records of the run at path with lowDocId <= docId < highDocId"""
+	runFile = open(path,"rb")
+	try:
+		low,high = 0,os.path.getsize(path) // UnindexRecord.size
+		while low < high:
+			middle = (low + high) // 2
+			runFile.seek(middle * UnindexRecord.size)
+			if UnindexRecord.unpack(runFile.read(UnindexRecord.size))[0] < lowDocId: low = middle + 1
+			else: high = middle
+		runFile.seek(low * UnindexRecord.size)
+		while 1:
+			chunk = runFile.read(RunReadRecords * UnindexRecord.size)
+			if not chunk: return
+			for offset in xrange(0,len(chunk),UnindexRecord.size):
+				record = UnindexRecord.unpack_from(chunk,offset)
+				if highDocId is not None and record[0] >= highDocId: return
+				yield record
+	finally:
+		runFile.close()
+
+def _mergeRuns(runPaths,mergedRunPath):
+	"""merges runPaths into a single run at mergedRunPath and deletes them"""
+	mergedRunFile = open(mergedRunPath,"wb")
+	records = list()
+	for record in heapq.merge(*[_readRun(runPath,0,None) for runPath in runPaths]):
+		records.append(UnindexRecord.pack(*record))
+		if len(records) == RunReadRecords:
+			mergedRunFile.write("".join(records))
+			records = list()
+	mergedRunFile.write("".join(records))
+	mergedRunFile.close()
+	for runPath in runPaths: os.remove(runPath)
+
+def _writeDocument(path,docId,fileTerms):
+	fileTerms.sort()
+	fp = open(os.sep.join([path,str(docId) + ".fwd"]),"wb")
+	fp.write("".join([termWord + " " for termPosition,termWord in fileTerms]))
+	fp.close()
+
+def _unindexDocIdRange(docIdRange):
+	"""runs in the workers of unindexReverseIndexBySorting, merges the runs over
+	lowDocId <= docId < highDocId and writes those documents, returns how many there were"""
+	runPaths,lowDocId,highDocId,path = docIdRange
+	documentCount = 0
+	previousDocId = None
+	fileTerms = list()
+	for docId,position,termId in heapq.merge(*[_readRun(runPath,lowDocId,highDocId) for runPath in runPaths]):
+		if docId != previousDocId:
+			if previousDocId is not None:
+				_writeDocument(path,_externalDocId(_unindexDocIdMap,previousDocId),fileTerms)
+				documentCount += 1
+			previousDocId = docId
+			fileTerms = list()
+		fileTerms.append((position,_unindexTermWords[termId]))
+	if previousDocId is not None:
+		_writeDocument(path,_externalDocId(_unindexDocIdMap,previousDocId),fileTerms)
+		documentCount += 1
+	return documentCount
+
+def splitDocIdRanges(documentLengths,rangeCount):
+	"""returns up to rangeCount (lowDocId,highDocId) ranges holding about as many documents
+	each, the last highDocId is None. A single open range when no lengths were recorded"""
+	docIds = documentLengths.docIds()
+	if not docIds: return [(0,None)]
+	boundaries = sorted(set([docIds[len(docIds) * k // rangeCount] for k in xrange(1,rangeCount)]))
+	return zip([0] + boundaries,boundaries + [None])
+
+def unindexReverseIndexBySorting(alphabet,reverseIndex,path,memoryLimit=DefaultSortMemory,workerCount=1):
+	"""Same documents as unindexForwardIndex, from the postings of reverseIndex through an external
+	sort in about memoryLimit bytes. workerCount processes merge and write the documents (None means one per CPU)"""
+	global _unindexTermWords,_unindexDocIdMap
+	runDirectory = tempfile.mkdtemp(prefix=".unindex-",dir=path)
+	try:
+		runPaths = writeSortedRuns(alphabet,reverseIndex,runDirectory,memoryLimit)
+		print >> sys.stdout, "Sorted the postings into %d runs" % len(runPaths)
+		if workerCount is None: workerCount = multiprocessing.cpu_count()
+		docIdRanges = [(runPaths,lowDocId,highDocId,path) for lowDocId,highDocId in splitDocIdRanges(reverseIndex.documentLengths,workerCount * RangesPerWorker)]
+		_unindexTermWords = forward.invertAlphabet(alphabet)
+		_unindexDocIdMap = reverseIndex.docIdMap
+		pool = None
+		try:
+			if workerCount <= 1:
+				documentCounts = map(_unindexDocIdRange,docIdRanges)
+			else:
+				pool = multiprocessing.Pool(workerCount)
+				documentCounts = pool.map(_unindexDocIdRange,docIdRanges,1)
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+			_unindexTermWords = None
+			_unindexDocIdMap = None
+		print >> sys.stdout, "Unindexed %d documents" % sum(documentCounts)
+	finally:
+		shutil.rmtree(runDirectory)
+
+def unindexReverseIndex(alphabet,reverseIndex,path,memoryLimit=DefaultSortMemory,workerCount=1):
+	"""Generates a set of documents in path that roughly represent the original documents in the Index
+	Reads the forward index of reverseIndex when it has one holding every document, see unindexForwardIndex,
+	and otherwise sorts the postings, see unindexReverseIndexBySorting"""
+	forwardIndex = reverseIndex.forwardIndex
+	if forwardIndex is not None and len(forwardIndex) == len(reverseIndex.documentLengths):
+		return unindexForwardIndex(alphabet,forwardIndex,path,reverseIndex.docIdMap)
+	return unindexReverseIndexBySorting(alphabet,reverseIndex,path,memoryLimit,workerCount)